@@ -0,0 +1,268 @@
+"""
+Single threaded event loop for provider ops, python 2 has no asyncio.
+
+Coroutines are generators yielding futures (or other coroutines), a
+value is returned with raise Return(value). kamaki calls block, they
+are offloaded to a small executor, all waiting and polling between
+calls happens on the loop so hundreds of ops in flight hold no thread.
+"""
+
+import collections
+import errno
+import heapq
+import itertools
+import logging
+import os
+from Queue import Queue
+import select
+import threading
+import time
+import types
+
+from juju_okeanos.wait import Poll
+
+
+log = logging.getLogger("juju.okeanos")
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Future(object):
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError("Future is not done")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, value):
+        self._result = value
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        if self._done:
+            raise RuntimeError("Future already done")
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Task(Future):
+    """Drives a coroutine, resolving to its return value."""
+
+    def __init__(self, loop, coro):
+        super(Task, self).__init__()
+        self.loop = loop
+        self.coro = coro
+        loop.call_soon(self._step)
+
+    def _step(self, value=None, exception=None):
+        try:
+            if exception is not None:
+                yielded = self.coro.throw(exception)
+            else:
+                yielded = self.coro.send(value)
+        except Return, e:
+            self.set_result(e.value)
+        except StopIteration:
+            self.set_result(None)
+        except Exception, e:
+            self.set_exception(e)
+        else:
+            if isinstance(yielded, types.GeneratorType):
+                yielded = Task(self.loop, yielded)
+            if not isinstance(yielded, Future):
+                self.loop.call_soon(self._step, None, TypeError(
+                    "Coroutine yielded %r, not a future" % (yielded,)))
+                return
+            yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        exception = future.exception()
+        if exception is not None:
+            self.loop.call_soon(self._step, None, exception)
+        else:
+            self.loop.call_soon(self._step, future.result())
+
+
+class EventLoop(object):
+    """Timers, ready callbacks and executor completions on one thread.
+
+    Other threads (the executor's included) hand back callbacks with
+    call_soon_threadsafe, waking the loop through a pipe it selects on.
+    """
+
+    # Max seconds to block in select, keeps the loop responsive to
+    # signals.
+    poll_interval = 0.5
+
+    def __init__(self, executor_size=4):
+        self.executor_size = executor_size
+        self._ready = collections.deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._jobs = Queue()
+        self._workers = []
+        self._wake_read, self._wake_write = os.pipe()
+        self.closed = False
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        if self.closed:
+            return
+        self._ready.append((callback, args))
+        os.write(self._wake_write, "x")
+
+    def call_later(self, delay, callback, *args):
+        heapq.heappush(self._timers, (
+            time.time() + delay, next(self._sequence), callback, args))
+
+    def sleep(self, delay, value=None):
+        future = Future()
+        self.call_later(delay, future.set_result, value)
+        return future
+
+    def create_task(self, coro):
+        return Task(self, coro)
+
+    def run_in_executor(self, func, *args, **kw):
+        """Run a blocking call on an executor thread, returns a future.
+        """
+        future = Future()
+        if len(self._workers) < self.executor_size:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            self._workers.append(worker)
+            worker.start()
+        self._jobs.put((future, func, args, kw))
+        return future
+
+    def gather(self, coros, return_exceptions=False):
+        """Future for the results of all coros, in order.
+
+        Unless return_exceptions is set the first failure fails the
+        gather, the other coros carry on regardless.
+        """
+        gathered = Future()
+        tasks = [isinstance(c, Future) and c or self.create_task(c)
+                 for c in coros]
+        pending = [len(tasks)]
+
+        def done(task):
+            if gathered.done():
+                return
+            if task.exception() is not None and not return_exceptions:
+                gathered.set_exception(task.exception())
+                return
+            pending[0] -= 1
+            if not pending[0]:
+                gathered.set_result([
+                    t.exception() or t.result() for t in tasks])
+
+        if not tasks:
+            gathered.set_result([])
+        for task in tasks:
+            task.add_done_callback(done)
+        return gathered
+
+    def run_until_complete(self, coro):
+        if not isinstance(coro, Future):
+            coro = self.create_task(coro)
+        while not coro.done():
+            self._run_once()
+        return coro.result()
+
+    def close(self):
+        self.closed = True
+        for worker in self._workers:
+            self._jobs.put(None)
+        self._workers = []
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, func, args, kw = job
+            try:
+                result = func(*args, **kw)
+            except Exception, e:
+                self.call_soon_threadsafe(future.set_exception, e)
+            else:
+                self.call_soon_threadsafe(future.set_result, result)
+
+    def _run_once(self):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, min(
+                self._timers[0][0] - time.time(), self.poll_interval))
+        else:
+            timeout = self.poll_interval
+        try:
+            readable, _, _ = select.select([self._wake_read], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = ()
+        if readable:
+            os.read(self._wake_read, 4096)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            self._ready.append((callback, args))
+
+        for i in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+
+def wait_for(loop, check, name, target=None, timeout=300, delay=1.0,
+             max_delay=15.0, factor=2.0, jitter=0.25, retry_on=()):
+    """Coroutine version of wait.wait_for, check runs on the executor.
+    """
+    poll = Poll(name, target, timeout, delay, max_delay, factor, jitter)
+    while True:
+        try:
+            result = yield loop.run_in_executor(check)
+        except retry_on, e:
+            poll.retry(e)
+            result = None
+        if poll.done(result):
+            raise Return(result)
+        yield loop.sleep(poll.next_delay())
@@ -0,0 +1,103 @@
+"""
+Persistent cache of slow changing provider catalogs (flavors, images..)
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger("juju.okeanos")
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+class Catalog(object):
+    """A json file of catalog entries, each expiring after its own ttl.
+
+    With no path the catalog is only kept in memory. With refresh set,
+    every entry is fetched again the first time it is asked for.
+    """
+
+    DEFAULT_TTL = DAY
+    TTLS = {
+        'endpoints': 7 * DAY,
+        'flavors': DAY,
+        'images': DAY,
+        'projects': 6 * HOUR}
+
+    def __init__(self, path=None, refresh=False, ttls=None):
+        self.path = path
+        self.refresh = refresh
+        self.ttls = dict(self.TTLS)
+        self.ttls.update(ttls or {})
+        self.lock = threading.Lock()
+        self.refreshed = set()
+        self._data = None
+
+    def get(self, key, fetch):
+        """Return the cached value for key, calling fetch when stale.
+        """
+        with self.lock:
+            entry = self._load().get(key)
+            if entry is not None and not self._stale(key, entry):
+                return entry['value']
+
+        t = time.time()
+        value = fetch()
+        log.debug("Fetched %s catalog in %0.2f seconds", key, time.time() - t)
+        with self.lock:
+            self.refreshed.add(key)
+            self._data[key] = {'updated': time.time(), 'value': value}
+            self._save()
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self._load().clear()
+            else:
+                self._load().pop(key, None)
+            self._save()
+
+    def _stale(self, key, entry):
+        if self.refresh and key not in self.refreshed:
+            return True
+        age = time.time() - entry.get('updated', 0)
+        return not (0 <= age < self.ttls.get(key, self.DEFAULT_TTL))
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        self._data = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as fh:
+                    self._data = json.load(fh)
+            except (IOError, ValueError), e:
+                log.warning("Ignoring unreadable catalog %s: %s",
+                            self.path, e)
+        return self._data
+
+    def _save(self):
+        """Atomically replace the catalog file, readers never see a partial.
+        """
+        if not self.path:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=cache_dir, prefix='.catalog-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(self._data, fh)
+            os.chmod(tmp_path, 0600)
+            os.rename(tmp_path, self.path)
+        except:
+            os.remove(tmp_path)
+            raise
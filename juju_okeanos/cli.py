@@ -5,8 +5,9 @@ import sys
 from juju_okeanos.config import Config
 from juju_okeanos.constraints import SERIES_MAP
 from juju_okeanos.exceptions import (
-    ConfigError, PrecheckError, ProviderAPIError)
-from juju_okeanos import commands
+    ConfigError, ConstraintError, PrecheckError, ProviderAPIError)
+from juju_okeanos import ssh
+from juju_okeanos.wait import stats as wait_stats
 
 
 def _default_opts(parser):
@@ -14,6 +15,12 @@ def _default_opts(parser):
         "-e", "--environment", help="Juju environment to operate on")
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose output")
+    parser.add_argument(
+        "--refresh-catalog", action="store_true", default=False,
+        help="Refetch cached provider flavors, images and projects")
+    parser.add_argument(
+        "-p", "--parallel", type=int, default=None,
+        help="Number of machine operations to run concurrently")
 
 
 def _machine_opts(parser):
@@ -44,7 +51,7 @@ def setup_parser():
         "--upload-tools",
         action="store_true", default=False,
         help="upload local version of tools before bootstrapping")
-    bootstrap.set_defaults(command=commands.Bootstrap)
+    bootstrap.set_defaults(command='Bootstrap')
 
     add_machine = subparsers.add_parser(
         'add-machine',
@@ -57,7 +64,13 @@ def setup_parser():
     add_machine.add_argument(
         "-k", "--ssh-key", default="",
         help="Use specified key when adding machines")
-    add_machine.set_defaults(command=commands.AddMachine)
+    add_machine.add_argument(
+        "--replace-failed", action="store_true", default=False,
+        help="Replace machines that fail to come up with new ones, once")
+    add_machine.add_argument(
+        "--event-loop", action="store_true", default=False,
+        help="Create machines from one event loop instead of threads")
+    add_machine.set_defaults(command='AddMachine')
 
     list_machines = subparsers.add_parser(
         'list-machines',
@@ -66,14 +79,14 @@ def setup_parser():
     list_machines.add_argument(
         "-a", "--all", action="store_true", default=False,
         help="Display all droplets in digital ocean.")
-    list_machines.set_defaults(command=commands.ListMachines)
+    list_machines.set_defaults(command='ListMachines')
 
     terminate_machine = subparsers.add_parser(
         "terminate-machine",
         help="Terminate machine")
     terminate_machine.add_argument("machines", nargs="+")
     _default_opts(terminate_machine)
-    terminate_machine.set_defaults(command=commands.TerminateMachine)
+    terminate_machine.set_defaults(command='TerminateMachine')
 
     destroy_environment = subparsers.add_parser(
         'destroy-environment',
@@ -82,11 +95,22 @@ def setup_parser():
     destroy_environment.add_argument(
         "--force", action="store_true", default=False,
         help="Irrespective of environment state, destroy all env machines")
-    destroy_environment.set_defaults(command=commands.DestroyEnvironment)
+    destroy_environment.set_defaults(command='DestroyEnvironment')
 
     return parser
 
 
+def get_command(name):
+    """Command class by name.
+
+    Commands pull in the provider and juju client stacks, they are only
+    imported to run one, juju calls us with --description on every
+    `juju help plugins`.
+    """
+    from juju_okeanos import commands
+    return getattr(commands, name)
+
+
 def main():
     parser = setup_parser()
     options = parser.parse_args()
@@ -110,7 +134,7 @@ def main():
         print("Configuration error: %s" % str(e))
         sys.exit(1)
 
-    cmd = options.command(
+    cmd = get_command(options.command)(
         config,
         config.connect_provider(),
         config.connect_environment())
@@ -124,6 +148,12 @@ def main():
     except PrecheckError, e:
         print("Precheck error: %s" % str(e))
         sys.exit(1)
+    except ConstraintError, e:
+        print("Constraint error: %s" % str(e))
+        sys.exit(1)
+    finally:
+        ssh.sessions.close()
+        wait_stats.report()
 
 if __name__ == '__main__':
     main()
@@ -1,96 +1,198 @@
 import os
+import threading
 
 from juju_okeanos.exceptions import ProviderAPIError
+from juju_okeanos.ratelimit import IDEMPOTENT_METHODS, limiter
+from juju_okeanos.runner import Runner
 
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class Entity(object):
+    """Fixed field api record, fields are listed in __slots__.
+
+    Fields not given default to None.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("Unknown %s fields: %s" % (
+                self.__class__.__name__, ", ".join(sorted(fields))))
 
     @classmethod
     def from_dict(cls, data):
-        i = cls()
-        i.__dict__.update(data)
-        i.json_keys = data.keys()
+        """Build from a dict of fields, unknown keys are ignored."""
+        i = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(i, name, data.get(name))
         return i
 
     def to_json(self):
-        return dict([(k, getattr(self, k)) for k in self.json_keys])
+        return dict([(k, getattr(self, k)) for k in self.__slots__])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+            self.to_json() == other.to_json()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s %s %s>" % (
+            self.__class__.__name__, self.id, getattr(self, 'name', ''))
 
 
 class SSHKey(Entity):
     """SSH Key on digital ocean
-
-    Attributes: id, name
     """
+    __slots__ = ('id', 'name')
 
 
 class Droplet(Entity):
     """Instance on digital ocean.
+    """
+    __slots__ = ('id', 'name', 'ip_address', 'created_at', 'status',
+                 'size_id', 'region_id', 'image_id', 'event_id', 'machine_id')
 
-    Attributes: id, name, ip_address, created_at, status, size_id, region_id,
-                image_id, event_id
+
+class Instance(Entity):
+    """Server on ~okeanos, the fields commands need of it.
     """
+    __slots__ = ('id', 'name', 'fqdn', 'ip_addresses', 'status',
+                 'flavor_id', 'created', 'machine_id', 'role')
+
+    @property
+    def ip_address(self):
+        return self.ip_addresses and self.ip_addresses[0] or None
 
 
 class Image(Entity):
-    """
-    Attributes: id, slug, name, distribution, public, regions
-    """
+
+    __slots__ = ('id', 'slug', 'name', 'distribution', 'public', 'regions')
 
 
 class Size(Entity):
     """
-    Attributes: id, name, slug, memory (mb), cpus, disk (gb), transfer (tb),
-                price (/mth), regions (v2 only)
+    memory (mb), disk (gb), transfer (tb), price (/mth), regions (v2 only)
     """
+    __slots__ = ('id', 'name', 'slug', 'memory', 'cpus', 'disk', 'transfer',
+                 'price', 'regions')
 
 
 class Region(Entity):
     """
-    Attributes: id, slug, name, sizes (v2 only), features (v2 only)
+    sizes (v2 only), features (v2 only)
     """
+    __slots__ = ('id', 'slug', 'name', 'sizes', 'features')
 
 
 class Client(object):
 
+    # Connect and read timeouts (seconds) for api calls.
+    timeout = (10, 60)
+
+    # Items requested per page on paginated listings.
+    page_size = 200
+
+    def init_session(self, pool_size=None):
+        """Keep-alive connection pool, sized to the runner's workers.
+        """
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size or Runner.DEFAULT_NUM_RUNNER)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """A session per thread, all sharing the (thread safe) pool.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            session.headers.update({
+                'User-Agent': 'juju/client',
+                'Accept-Encoding': 'gzip, deflate'})
+            self._local.session = session
+        return session
+
+    def request(self, target, method='GET', idempotent=None, **kw):
+        """Api call through the limiter, only idempotent ones are retried.
+
+        idempotent defaults by http method, v1 also creates with a GET.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        call = idempotent and limiter.call or limiter.call_once
+        return call(self._request, target, method, **kw)
+
     def get_url(self, target):
         if target.startswith('/'):
             return "%s%s" % (self.api_url_base, target)
         assert target.startswith('https://')
         return target
 
+    def iter_pages(self, target, key, params=None):
+        """Yield the items of a listing, fetching pages as consumed.
+        """
+        data = self.request(target, params=params)
+        for item in data.get(key, ()):
+            yield item
+
+    def iter_sizes(self):
+        for info in self.iter_pages("/sizes", 'sizes'):
+            size = self.make_size(info)
+            if size is not None:
+                yield size
+
+    def iter_regions(self):
+        for info in self.iter_pages("/regions", 'regions'):
+            region = self.make_region(info)
+            if region is not None:
+                yield region
+
+    def iter_images(self):
+        for info in self.iter_pages("/images", 'images'):
+            image = self.make_image(info)
+            if image is not None:
+                yield image
+
+    def iter_droplets(self):
+        for info in self.iter_pages("/droplets", 'droplets'):
+            yield self.make_droplet(info)
+
     def get_sizes(self):
-        data = self.request("/sizes")
-        return filter(None, map(self.make_size, data.get('sizes', [])))
+        return list(self.iter_sizes())
 
     def get_regions(self):
-        data = self.request("/regions")
-        return filter(None, map(self.make_region, data.get("regions", [])))
+        return list(self.iter_regions())
 
     def get_images(self):
-        data = self.request("/images")
-        return filter(None, map(self.make_image, data.get("images", [])))
+        return list(self.iter_images())
 
     def get_droplets(self):
-        data = self.request("/droplets")
-        return map(self.make_droplet, data.get('droplets', []))
+        return list(self.iter_droplets())
 
     def get_droplet(self, droplet_id):
         data = self.request("/droplets/%s" % droplet_id)
         return self.make_droplet(data.get('droplet', {}))
 
     @classmethod
-    def connect(cls, config=os.environ):
+    def connect(cls, config=os.environ, pool_size=None):
         oauth_token = config.get('DO_OAUTH_TOKEN')
         if oauth_token:
-            return Client_v2(oauth_token)
+            return Client_v2(oauth_token, pool_size)
         client_id = config.get('DO_CLIENT_ID')
         key = config.get('DO_API_KEY')
         if client_id or key:
             if not client_id or not key:
                 raise KeyError("Missing api credentials")
-            return Client_v1(client_id, key)
+            return Client_v1(client_id, key, pool_size)
         else:
             raise KeyError("Missing api credentials")
 
@@ -103,41 +205,42 @@ class Client_v1(Client):
         '512mb': 1, '1gb': 2, '2gb': 3, '4gb': 4, '8gb': 5,
         '16gb': 6, '32gb': 7, '48gb': 8, '64gb': 9}
 
-    def __init__(self, client_id, api_key):
+    def __init__(self, client_id, api_key, pool_size=None):
         self.client_id = client_id
         self.api_key = api_key
         self.api_url_base = 'https://api.digitalocean.com/v1'
+        self.init_session(pool_size)
 
     def get_ssh_keys(self):
         data = self.request("/ssh_keys")
-        return map(SSHKey.from_dict, data.get('ssh_keys', []))
+        return map(self.make_ssh_key, data.get('ssh_keys', []))
+
+    def make_ssh_key(self, info):
+        return SSHKey(id=info['id'], name=info['name'])
 
     def make_image(self, info):
-        return Image.from_dict(
-            dict(id=info['id'], slug=info['slug'], name=info['name'],
-                 distribution=info['distribution'], public=info['public'],
-                 regions=info['region_slugs']))
+        return Image(
+            id=info['id'], slug=info['slug'], name=info['name'],
+            distribution=info['distribution'], public=info['public'],
+            regions=info['region_slugs'])
 
     def make_region(self, info):
-        return Region.from_dict(
-            dict(id=info['id'], name=info['name'], slug=info['slug']))
+        return Region(id=info['id'], name=info['name'], slug=info['slug'])
 
     def make_size(self, info):
-        return Size.from_dict(
-            dict(id=info['id'], name=info['name'], slug=info['slug'],
-                 memory=info['memory'],
-                 cpus=info['cpu'], disk=info['disk'],
-                 transfer=self.Transfers_for_sizes[info['slug']],
-                 price=float(info['cost_per_month'])))
+        return Size(
+            id=info['id'], name=info['name'], slug=info['slug'],
+            memory=info['memory'], cpus=info['cpu'], disk=info['disk'],
+            transfer=self.Transfers_for_sizes[info['slug']],
+            price=float(info['cost_per_month']))
 
     def make_droplet(self, info):
-        attributes = dict(id=info['id'], name=info['name'],
-                          image_id=info['image_id'], size_id=info['size_id'])
-        for name in ('event_id', 'ip_address', 'created_at', 'status',
-                     'region_id', 'event_id'):
-            if name in info:
-                attributes[name] = info[name]
-        return Droplet.from_dict(attributes)
+        get = info.get
+        return Droplet(
+            id=info['id'], name=info['name'], image_id=info['image_id'],
+            size_id=info['size_id'], event_id=get('event_id'),
+            ip_address=get('ip_address'), created_at=get('created_at'),
+            status=get('status'), region_id=get('region_id'))
 
     def create_droplet(self, name, size_id, image_id, region_id,
                        ssh_key_ids=None, private_networking=False,
@@ -151,7 +254,8 @@ class Client_v1(Client):
 
         if ssh_key_ids:
             params['ssh_key_ids'] = ','.join(ssh_key_ids)
-        data = self.request('/droplets/new', params=params)
+        data = self.request(
+            '/droplets/new', params=params, idempotent=False)
         return self.make_droplet(data.get('droplet', {}))
 
     def create_done(self, event_id, name):
@@ -168,19 +272,21 @@ class Client_v1(Client):
             params=dict(scrub_data=int(bool(scrub))))
         return data.get('event_id')
 
-    def request(self, target, method='GET', params=None):
+    def _request(self, target, method='GET', params=None):
         p = params and dict(params) or {}
         p['client_id'] = self.client_id
         p['api_key'] = self.api_key
 
-        headers = {'User-Agent': 'juju/client'}
+        headers = {}
         url = self.get_url(target)
 
         if method == 'POST':
             headers['Content-Type'] = "application/json"
-            response = requests.post(url, headers=headers, params=p)
+            response = self.session.post(
+                url, headers=headers, params=p, timeout=self.timeout)
         else:
-            response = requests.get(url, headers=headers, params=p)
+            response = self.session.get(
+                url, headers=headers, params=p, timeout=self.timeout)
 
         data = response.json()
         if not data:
@@ -197,54 +303,64 @@ class Client_v2(Client):
 
     version = 2.0
 
-    def __init__(self, oauth_token):
+    def __init__(self, oauth_token, pool_size=None):
         self.oauth_token = oauth_token
         self.api_url_base = 'https://api.digitalocean.com/v2'
+        self.init_session(pool_size)
 
     def get_ssh_keys(self):
-        data = self.request("/account/keys")
-        return map(self.make_ssh_key, data.get('ssh_keys', []))
+        return map(self.make_ssh_key,
+                   self.iter_pages("/account/keys", 'ssh_keys'))
+
+    def iter_pages(self, target, key, params=None):
+        """Yield the items of a listing, following links.pages.next.
+
+        Only the current page is held in memory, the next one is fetched
+        once its items have been consumed.
+        """
+        params = dict(params or {}, per_page=self.page_size)
+        while target:
+            data = self.request(target, params=params)
+            for item in data.get(key, ()):
+                yield item
+            target = data.get('links', {}).get('pages', {}).get('next')
+            # The next link carries its own paging query.
+            params = None
 
     def make_ssh_key(self, info):
-        return SSHKey.from_dict(
-            dict(id=info['id'], name=info['name']))
+        return SSHKey(id=info['id'], name=info['name'])
 
     def make_image(self, info):
-        return Image.from_dict(
-            dict(id=info['id'], slug=info['slug'], name=info['name'],
-                 distribution=info['distribution'], public=info['public'],
-                 regions=info['regions']))
+        return Image(
+            id=info['id'], slug=info['slug'], name=info['name'],
+            distribution=info['distribution'], public=info['public'],
+            regions=info['regions'])
 
     def make_region(self, info):
         if info['available']:
-            return Region.from_dict(
-                dict(id=info['slug'], name=info['name'], slug=info['slug'],
-                     sizes=info['sizes'], features=info['features']))
+            return Region(
+                id=info['slug'], name=info['name'], slug=info['slug'],
+                sizes=info['sizes'], features=info['features'])
 
     def make_size(self, info):
         if info['available']:
-            return Size.from_dict(
-                dict(id=info['slug'], name=info['slug'], slug=info['slug'],
-                     memory=info['memory'],
-                     cpus=info['vcpus'], disk=info['disk'],
-                     transfer=info['transfer'],
-                     price=info['price_monthly'],
-                     regions=info['regions']))
+            return Size(
+                id=info['slug'], name=info['slug'], slug=info['slug'],
+                memory=info['memory'], cpus=info['vcpus'], disk=info['disk'],
+                transfer=info['transfer'], price=info['price_monthly'],
+                regions=info['regions'])
 
     def make_droplet(self, info):
-        attributes = dict(id=info['id'], name=info['name'],
-                          status=info['status'], size_id=info['size_slug'],
-                          created_at=info['created_at'])
-        if 'v4' in info['networks']:
-            for network in info['networks']['v4']:
-                if network['type'] == 'public':
-                    attributes['ip_address'] = network['ip_address']
-                    break
-        if 'slug' in info['region']:
-            attributes['region_id'] = info['region']['slug']
-        if 'id' in info['image']:
-            attributes['image_id'] = info['image']['id']
-        return Droplet.from_dict(attributes)
+        ip_address = None
+        for network in info['networks'].get('v4', ()):
+            if network['type'] == 'public':
+                ip_address = network['ip_address']
+                break
+        return Droplet(
+            id=info['id'], name=info['name'], status=info['status'],
+            size_id=info['size_slug'], created_at=info['created_at'],
+            ip_address=ip_address, region_id=info['region'].get('slug'),
+            image_id=info['image'].get('id'))
 
     def create_droplet(self, name, size_id, image_id, region_id,
                        ssh_key_ids=None, private_networking=False,
@@ -278,19 +394,19 @@ class Client_v2(Client):
     def destroy_droplet(self, droplet_id, scrub=True):
         self.request("/droplets/%s" % droplet_id, 'DELETE')
 
-    def request(self, target, method='GET', params=None, data=None):
+    def _request(self, target, method='GET', params=None, data=None):
         p = params and dict(params) or {}
-        p['per_page'] = 1000
 
-        headers = {'User-Agent': 'juju/client',
-                   'Authorization': 'Bearer ' + self.oauth_token}
+        headers = {'Authorization': 'Bearer ' + self.oauth_token}
         url = self.get_url(target)
 
         if data is not None:
-            response = requests.request(method, url, headers=headers, params=p,
-                                        json=data)
+            response = self.session.request(
+                method, url, headers=headers, params=p, json=data,
+                timeout=self.timeout)
         else:
-            response = requests.request(method, url, headers=headers, params=p)
+            response = self.session.request(
+                method, url, headers=headers, params=p, timeout=self.timeout)
 
         if not (200 <= response.status_code < 300):
             raise ProviderAPIError(response, response.json())
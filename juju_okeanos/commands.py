@@ -1,10 +1,10 @@
 import logging
+import sys
 import time
 import uuid
-import yaml
 
 from juju_okeanos import constraints
-from juju_okeanos.exceptions import ConfigError, PrecheckError
+from juju_okeanos.exceptions import ConfigError, MachineFailed, PrecheckError
 from juju_okeanos import ops
 from juju_okeanos.runner import Runner
 
@@ -18,14 +18,10 @@ class BaseCommand(object):
         self.config = config
         self.provider = provider
         self.env = environment
-        self.runner = Runner()
+        self.runner = Runner(config.parallel)
 
     def solve_constraints(self):
-        size, region = constraints.solve_constraints(self.config.constraints)
-        t = time.time()
-        image_map = constraints.get_images(self.provider.client)
-        log.debug("Looked up docean images in %0.2f seconds", time.time() - t)
-        return image_map[self.config.series], size, region
+        return constraints.parse_constraints(self.config.constraints)
 
     def get_do_ssh_keys(self):
         return [k.id for k in self.provider.get_ssh_keys()]
@@ -34,23 +30,22 @@ class BaseCommand(object):
         """Check for provider ssh key, and configured environments.yaml.
         """
         env_name = self.config.get_env_name()
-        with open(self.config.get_env_conf()) as fh:
-            conf = yaml.safe_load(fh.read())
-            if not 'environments' in conf:
-                raise ConfigError(
-                    "Invalid environments.yaml, no 'environments' section")
-            if not env_name in conf['environments']:
-                raise ConfigError(
-                    "Environment %r not in environments.yaml" % env_name)
-            env = conf['environments'][env_name]
-            if not env['type'] in ('null', 'manual'):
-                raise ConfigError(
-                    "Environment %r provider type is %r must be 'null'" % (
-                        env_name, env['type']))
-            if env['bootstrap-host']:
-                raise ConfigError(
-                    "Environment %r already has a bootstrap-host" % (
-                        env_name))
+        conf = self.config.get_env_data()
+        if not 'environments' in conf:
+            raise ConfigError(
+                "Invalid environments.yaml, no 'environments' section")
+        if not env_name in conf['environments']:
+            raise ConfigError(
+                "Environment %r not in environments.yaml" % env_name)
+        env = conf['environments'][env_name]
+        if not env['type'] in ('null', 'manual'):
+            raise ConfigError(
+                "Environment %r provider type is %r must be 'null'" % (
+                    env_name, env['type']))
+        if env['bootstrap-host']:
+            raise ConfigError(
+                "Environment %r already has a bootstrap-host" % (
+                    env_name))
         return True
 
 
@@ -71,13 +66,13 @@ class Bootstrap(BaseCommand):
     """
     def run(self):
         self.check_preconditions()
-        #TODO: fix constraints
-        #image, size, region = self.solve_constraints()
+        machine_constraints = self.solve_constraints()
         log.info("Launching bootstrap host (eta 5m)...")        
         params = dict(
-            name="%s-0" % self.config.get_env_name())
+            name="%s-0" % self.config.get_env_name(),
+            constraints=machine_constraints)
         net = self.provider.add_private_network(recreate=False)
-        instance = self.provider.add_machine(params)
+        instance = self.provider.add_machine(params, is_gateway=True)
         self.provider.attach_public_ip_to_machine(instance)
         self.provider.attach_private_ip_to_machine(net, instance)
         self.provider.set_nat(instance)
@@ -88,6 +83,7 @@ class Bootstrap(BaseCommand):
         except:
             self.provider.terminate_instance(instance['id'])
             raise
+        self.provider.register_machine(instance['id'], '0')
         log.info("Bootstrap complete.")
         
 
@@ -103,66 +99,151 @@ class Bootstrap(BaseCommand):
 class ListMachines(BaseCommand):
 
     def run(self):
-        env_name = self.config.get_env_name()
-        header = "{:<8} {:<18} {:<5} {:<8} {:<12} {:<6} {:<10}".format(
-            "Id", "Name", "Size", "Status", "Created", "Region", "Address")
+        header = "{:<8} {:<18} {:<7} {:<7} {:<8} {:<12} {:<8} {:<10}".format(
+            "Id", "Name", "Machine", "Flavor", "Status", "Created", "Role",
+            "Address")
 
         allmachines = self.config.options.all
-        for m in self.provider.get_instances():
-            if not allmachines and not m.name.startswith('%s-' % env_name):
-                continue
-
+        # Rows are printed as each page of instances arrives.
+        for m in self.provider.iter_instances(all_servers=allmachines):
             if header:
                 print(header)
                 header = None
 
-            for r in constraints.REGIONS:
-                if m.region_id == r.id:
-                    break
             name = m.name
             if len(name) > 18:
                 name = name[:15] + "..."
-            size = constraints.SIZE_MAP.get(m.size_id)
-            if size is None:
-                size_name = "Unknown"
-            else:
-                size_name = getattr(size, 'name', "Unknown")
-            print("{:<8} {:<18} {:<5} {:<8} {:<12} {:<6} {:<10}".format(
+            print("{:<8} {:<18} {:<7} {:<7} {:<8} {:<12} {:<8} {:<10}".format(
                 m.id,
                 name,
-                size_name,
+                m.machine_id or '',
+                m.flavor_id or '',
                 m.status,
-                m.created_at[:-10],
-                r.slug,
-                m.ip_address).strip())
+                (m.created or '')[:10],
+                m.role or '',
+                m.fqdn or m.ip_address or '').strip())
+            sys.stdout.flush()
 
 
 class AddMachine(BaseCommand):
 
     def run(self):
         self.check_preconditions()
-        #TODO: fix constraints
-        #image, size, region = self.solve_constraints()
+        machine_constraints = self.solve_constraints()
         log.info("Launching %d instances...", self.config.num_machines)
 
-
         #op_class = self.provider.version == 2.0 and \
         #    ops.MachineUserDataRegister or ops.MachineRegister
 
         net = self.provider.get_private_network()
+        try:
+            if self.config.event_loop:
+                instances = self._provision_async(net, machine_constraints)
+            else:
+                instances = self._provision(net, machine_constraints)
+            registered = len(self._register(instances))
+        finally:
+            self.env.close()
+        if registered != self.config.num_machines:
+            log.error("%d of %d machines failed to provision",
+                      self.config.num_machines - registered,
+                      self.config.num_machines)
+
+    def _provision(self, net, machine_constraints):
+        """Create the machines with runner ops, returns the instances."""
         for n in range(self.config.num_machines):
-            machine_name="%s-%s" % (self.config.get_env_name(), uuid.uuid4().hex)
-            params = dict(
-                      name=machine_name
-                     )
+            self._queue_provision(net, machine_constraints)
 
-            # This should be flagged in case we use only ipv6
-            instance = self.provider.add_machine(params, private_net=net)
-            self.provider.set_internal_gw(instance)
-            self.env.add_machine("ssh:root@%s" % instance['fqdn'])
-            # TODO if the above fail kill the machine.
-            log.info("Registered id:%s name:%s %s as juju machine",
-                     instance['fqdn'], machine_name, instance['ip_address'][0])
+        instances = []
+        for result in self.runner.iter_outcomes():
+            if result.ok:
+                instances.append(result.value)
+                continue
+            log.error("Failed to provision %s after %0.2fs: %s",
+                      result.op.params['name'], result.duration,
+                      result.exception)
+            # A machine in a terminal state gets one fresh retry.
+            if self.config.replace_failed and \
+                    isinstance(result.exception, MachineFailed) and \
+                    not result.op.options.get('replaces'):
+                name = self._queue_provision(
+                    net, machine_constraints,
+                    replaces=result.op.params['name'])
+                log.info("Replacing %s with %s",
+                         result.op.params['name'], name)
+        return instances
+
+    def _provision_async(self, net, machine_constraints):
+        """Create the machines as coroutines on the provider's loop."""
+        names = [self._machine_name()
+                 for n in range(self.config.num_machines)]
+        replacements = set()
+        instances = []
+        while names:
+            results = self.provider.run_all([
+                self.provider.async_provision_machine(
+                    dict(name=name, constraints=machine_constraints),
+                    private_net=net) for name in names])
+            retry = []
+            for name, result in zip(names, results):
+                if not isinstance(result, Exception):
+                    instances.append(result)
+                    continue
+                log.error("Failed to provision %s: %s", name, result)
+                if self.config.replace_failed and \
+                        isinstance(result, MachineFailed) and \
+                        name not in replacements:
+                    retry.append(self._machine_name())
+                    replacements.add(retry[-1])
+                    log.info("Replacing %s with %s", name, retry[-1])
+            names = retry
+        return instances
+
+    def _register(self, instances):
+        """Register instances with juju in one api call, and provision them.
+
+        Instances that fail to register or provision are terminated.
+        """
+        if not instances:
+            return {}
+        try:
+            provisioned = self.env.add_machines(
+                [(i['fqdn'], i.get('hardware')) for i in instances])
+        except:
+            # Nothing else knows about these servers, don't leave them.
+            exc_info = sys.exc_info()
+            log.error("Failed to register %d machines, terminating them",
+                      len(instances))
+            for instance in instances:
+                try:
+                    self.provider.terminate_instance(instance['id'])
+                except Exception, e:
+                    log.error("Failed to terminate id:%s %s: %s",
+                              instance['id'], instance['fqdn'], e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for instance in instances:
+            machine_id = provisioned.get(instance['fqdn'])
+            if machine_id is None:
+                self.provider.terminate_instance(instance['id'])
+                continue
+            log.info("Registered id:%s %s %s as juju machine %s",
+                     instance['id'], instance['fqdn'],
+                     instance['ip_address'][0], machine_id)
+            self.provider.register_machine(instance['id'], machine_id)
+        return provisioned
+
+    def _machine_name(self):
+        return "%s-%s" % (self.config.get_env_name(), uuid.uuid4().hex)
+
+    def _queue_provision(self, net, machine_constraints, **options):
+        machine_name = self._machine_name()
+        # This should be flagged in case we use only ipv6
+        self.runner.queue_op(
+            ops.MachineProvision(
+                self.provider, self.env,
+                dict(name=machine_name, constraints=machine_constraints),
+                private_net=net, **options))
+        return machine_name
 
 
 class TerminateMachine(BaseCommand):
@@ -183,57 +264,115 @@ class TerminateMachine(BaseCommand):
         machines = status.get('machines', {})
 
         machine_filter = machine_filter or self._machine_filter
-        # Using the api instance-id can be the provider id, but
-        # else it defaults to ip, and we have to disambiguate.
-        remove = []
-        for m in machines:
-            if machine_filter(m, machines[m]):
-                remove.append(
-                    {'address': machines[m].get('dns-name'),
-                     'instance_id': machines[m]['instance-id'],
-                     'machine_id': m})
-
-        address_map = dict([(d.ip_address, d) for
-                            d in self.provider.get_instances()])
+        remove = [self._machine_info(m, machines[m]) for m in sorted(machines)
+                  if machine_filter(m, machines[m])]
         if not remove:
-            return status, address_map
+            return status
 
         log.info("Terminating machines %s",
                  " ".join([m['machine_id'] for m in remove]))
 
-        for m in remove:
+        # One juju call removes all machines from state, then the
+        # instances are deleted concurrently.
+        self.env.terminate_machines([m['machine_id'] for m in remove])
+        self._destroy_machines(remove)
+        return status
+
+    @staticmethod
+    def _machine_info(mid, m):
+        return {'address': m.get('dns-name'),
+                'instance_id': m.get('instance-id'),
+                'machine_id': mid}
+
+    def _resolve_instances(self, machines):
+        """Map juju machine ids to provider instance ids.
+
+        The inventory resolves the machines we created, the provider's
+        instances are only listed for machines it doesn't know.
+        """
+        inventory = self.provider.inventory
+        resolved, unknown = {}, []
+        for m in machines:
+            record = inventory.find(machine_id=m['machine_id'])
+            if record is None and m['address']:
+                record = inventory.find(address=m['address'])
+            if record is None:
+                unknown.append(m)
+            else:
+                resolved[m['machine_id']] = record['server_id']
+        if not unknown:
+            return resolved
+
+        # Using the api instance-id can be the provider id, but
+        # else it defaults to an address, and we have to disambiguate.
+        address_map = {}
+        for d in self.provider.get_instances():
+            for address in [d.fqdn] + d.ip_addresses:
+                address_map[address] = d
+        for m in unknown:
             instance = None
             if m['address']:
                 instance = address_map.get(m['address'])
             else:
-                instances = [
-                    i for i in address_map.values()
-                    if m['instance_id'] == i.name]
+                instances = dict([
+                    (i.id, i) for i in address_map.values()
+                    if m['instance_id'] == i.name]).values()
                 if len(instances) == 1:
                     instance = instances[0]
-                    #instances['instance'] =
-            env_only = False  # Remove from only env or also provider.
-            if instance is None:
+            if instance is not None:
+                resolved[m['machine_id']] = instance.id
+        return resolved
+
+    def _destroy_machines(self, machines):
+        instances = self._resolve_instances(machines)
+        destroy = []
+        for m in machines:
+            instance_id = instances.get(m['machine_id'])
+            if instance_id is None:
+                # We have a machine in juju state that we couldn't
+                # find in provider, removing it from state is enough
+                # for destroy to proceed.
                 log.warning(
                     "Couldn't resolve machine %s's address %s to instance" % (
                         m['machine_id'], m['address']))
-                # We have a machine in juju state that we couldn't
-                # find in provider. Remove it from state so destroy
-                # can proceed.
-                env_only = True
-                instance_id = None
-            else:
-                instance_id = instance.id
+                continue
+            destroy.append({
+                'machine_id': m['machine_id'], 'instance_id': instance_id})
+        self._destroy_instances(destroy)
+
+    def _destroy_instances(self, instances):
+        """Delete instances concurrently and confirm the servers are gone.
+
+        instances are MachineDestroy params, the deletes are watched
+        before they are made.
+        """
+        instance_ids = [i['instance_id'] for i in instances]
+        waiters = dict(zip(
+            instance_ids, self.provider.watch_instances_gone(instance_ids)))
+        for params in instances:
             self.runner.queue_op(
                 ops.MachineDestroy(
-                    self.provider, self.env, {
-                        'machine_id': m['machine_id'],
-                        'instance_id': instance_id},
-                    env_only=env_only))
-        for result in self.runner.iter_results():
-            pass
-
-        return status, address_map
+                    self.provider, self.env, params, iaas_only=True))
+        deleted = []
+        for result in self.runner.iter_outcomes():
+            instance_id = result.op.params['instance_id']
+            if result.ok:
+                deleted.append(instance_id)
+                continue
+            # Nothing will delete it, don't wait out the timeout.
+            self.provider.delete_watcher.discard(
+                instance_id, waiters.pop(instance_id))
+            log.error("Failed to delete instance %s: %s",
+                      instance_id, result.exception)
+        if not deleted:
+            return
+        remaining = self.provider.wait_instances_gone(
+            deleted, waiters=[waiters[i] for i in deleted])
+        if remaining:
+            log.error("Instances still not deleted: %s",
+                      " ".join(map(str, remaining)))
+        self.provider.forget_instances(
+            [i for i in deleted if i not in remaining])
 
 
 class DestroyEnvironment(TerminateMachine):
@@ -253,8 +392,7 @@ class DestroyEnvironment(TerminateMachine):
         if force:
             return self.force_environment_destroy()
 
-        env_status, instance_map = self._terminate_machines(
-            state_service_filter)
+        env_status = self._terminate_machines(state_service_filter)
 
         # sadness, machines are marked dead, but juju is async to
         # reality. either sleep (racy) or retry loop, 10s seems to
@@ -265,29 +403,26 @@ class DestroyEnvironment(TerminateMachine):
         self.env.destroy_environment()
 
         # Remove the state server.
-        bootstrap_host = env_status.get(
-            'machines', {}).get('0', {}).get('dns-name')
-        instance = instance_map.get(bootstrap_host)
-        if instance:
+        state_server = env_status.get('machines', {}).get('0')
+        if state_server:
             log.info("Terminating state server")
-            self.provider.terminate_instance(instance.id)
+            self._destroy_machines([self._machine_info('0', state_server)])
+        self.provider.inventory.clear()
         log.info("Environment Destroyed")
 
     def force_environment_destroy(self):
-        env_name = self.config.get_env_name()
-        env_machines = [m for m in self.provider.get_instances()
-                        if m.name.startswith("%s-" % env_name)]
+        instance_ids = [
+            m['server_id'] for m in self.provider.inventory.machines()]
+        # Servers tagged with the environment but recorded elsewhere,
+        # ie. created from another host.
+        for instance in self.provider.iter_instances():
+            if instance.id not in instance_ids:
+                instance_ids.append(instance.id)
 
         log.info("Destroying environment")
-        for m in env_machines:
-            self.runner.queue_op(
-                ops.MachineDestroy(
-                    self.provider, self.env, {'instance_id': m.id},
-                    iaas_only=True))
-
-        for result in self.runner.iter_results():
-            pass
+        self._destroy_instances([{'instance_id': i} for i in instance_ids])
 
         # Fast destroy the client cache by removing the jenv file.
         self.env.destroy_environment_jenv()
+        self.provider.inventory.clear()
         log.info("Environment Destroyed")
@@ -1,31 +1,49 @@
 import os
-import yaml
 import sys
 
-from juju_okeanos.env import Environment
 from juju_okeanos.exceptions import ConfigError
-from juju_okeanos import provider
 
 
 class Config(object):
 
     def __init__(self, options):
         self.options = options
+        self._env_data = None
+        self._kamaki_config = None
+
+    # The provider (kamaki), environment (jujuclient) and yaml stacks are
+    # imported when first used, the cli loads this module for --help.
 
     def connect_provider(self):
         """Connect to digital ocean.
         """
-        return provider.factory()
+        from juju_okeanos import provider
+        return provider.factory(
+            pool_size=self.parallel, catalog_dir=self.juju_home,
+            refresh_catalog=self.refresh_catalog,
+            inventory_path=self.get_inventory_path(),
+            env_name=self.get_env_name(),
+            kamaki_config=self.get_kamaki_config(),
+            async_ops=self.event_loop)
 
     def connect_environment(self):
         """Return a websocket connection to the environment.
         """
+        from juju_okeanos.env import Environment
         return Environment(self)
 
     def validate(self):
-        provider.validate()
+        self.get_kamaki_config()
         self.get_env_name()
 
+    def get_kamaki_config(self):
+        """Get the parsed kamaki config, read once per process.
+        """
+        if self._kamaki_config is None:
+            from juju_okeanos import provider
+            self._kamaki_config = provider.validate()
+        return self._kamaki_config
+
     @property
     def verbose(self):
         return self.options.verbose
@@ -46,6 +64,22 @@ class Config(object):
     def num_machines(self):
         return getattr(self.options, 'num_machines', 0)
 
+    @property
+    def replace_failed(self):
+        return getattr(self.options, 'replace_failed', False)
+
+    @property
+    def event_loop(self):
+        return getattr(self.options, 'event_loop', False)
+
+    @property
+    def parallel(self):
+        return getattr(self.options, 'parallel', None)
+
+    @property
+    def refresh_catalog(self):
+        return getattr(self.options, 'refresh_catalog', False)
+
     @property
     def juju_home(self):
         jhome = os.environ.get("JUJU_HOME")
@@ -56,6 +90,10 @@ class Config(object):
                 os.path.join('APPDATA'), "Juju")
         return os.path.expanduser("~/.juju")
 
+    def get_inventory_path(self):
+        return os.path.join(
+            self.juju_home, "okeanos-%s.db" % self.get_env_name())
+
     def get_env_name(self):
         """Get the environment name.
         """
@@ -69,11 +107,19 @@ class Config(object):
             with open(env_ptr) as fh:
                 return fh.read().strip()
 
-        with open(self.get_env_conf()) as fh:
-            conf = yaml.safe_load(fh.read())
-            if not 'default' in conf:
-                raise ConfigError("No Environment specified")
-            return conf['default']
+        conf = self.get_env_data()
+        if not 'default' in conf:
+            raise ConfigError("No Environment specified")
+        return conf['default']
+
+    def get_env_data(self):
+        """Get the parsed environments.yaml, read once per process.
+        """
+        if self._env_data is None:
+            from juju_okeanos import yamlio
+            with open(self.get_env_conf()) as fh:
+                self._env_data = yamlio.load(fh) or {}
+        return self._env_data
 
     def get_env_conf(self):
         """Get the environment config file.
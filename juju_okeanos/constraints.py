@@ -1,3 +1,5 @@
+from bisect import bisect_left
+
 from juju_okeanos.exceptions import ConstraintError
 
 DEFAULT_REGION = 'nyc3'
@@ -22,6 +24,9 @@ SUFFIX_SIZES = {
     "t": 1024 * 1024,
     "p": 1024 * 1024 * 1024}
 
+# Used for any of cpus, memory (mb) unset in --constraints.
+DEFAULT_CONSTRAINTS = {'cpus': 1, 'memory': 2048}
+
 
 def init(client, data=None):
     global SIZE_MAP, SIZES_SORTED, REGIONS, DEFAULT_REGION
@@ -61,6 +66,13 @@ def size_to_resources(size_id):
             'RootDisk': size.disk}
 
 
+def flavor_to_resources(flavor):
+    return {'Mem': flavor['ram'],
+            'CpuCores': flavor['vcpus'],
+            'Arch': 'amd64',
+            'RootDisk': flavor['disk'] * 1024}
+
+
 def converted_size(s):
     q = s[-1].lower()
     size_factor = SUFFIX_SIZES.get(q)
@@ -83,7 +95,7 @@ def parse_constraints(constraints):
         c[k.strip()] = v.strip()
 
     unknown = set(c).difference(
-        set(['cpu-cores', 'disk', 'mem']))
+        set(['cpu-cores', 'disk', 'mem', 'root-disk']))
     if unknown:
         raise ConstraintError("Unknown constraints %s" % (" ".join(unknown)))
 
@@ -132,6 +144,71 @@ def solve_constraints(constraints):
         ", ".join(["%s=%s" % (k, v in constraints.items())])))
 
 
+class FlavorIndex(object):
+    """Okeanos flavors indexed by (vcpus, ram, disk).
+
+    Each dimension is kept sorted and the smallest flavor covering every
+    (vcpus, ram, disk) level is computed up front, so a lookup bisects
+    vcpus, ram and disk once each instead of scanning flavor levels.
+    """
+
+    def __init__(self, flavors):
+        self.flavors = {}
+        for f in flavors:
+            key = (f['vcpus'], f['ram'], f['disk'], f['id'])
+            self.flavors[key] = f
+        cells = {}
+        for key in self.flavors:
+            cells[key[:3]] = min(cells.get(key[:3], key), key)
+        self.cpus = sorted(set(c[0] for c in cells))
+        self.rams = sorted(set(c[1] for c in cells))
+        self.disks = sorted(set(c[2] for c in cells))
+
+        # best[i][j][k] is the smallest flavor with at least cpus[i],
+        # rams[j] and disks[k], filled in from the largest levels down.
+        # The extra trailing level matches nothing.
+        best = [[[None] * (len(self.disks) + 1)
+                 for _ in range(len(self.rams) + 1)]
+                for _ in range(len(self.cpus) + 1)]
+        for i in reversed(range(len(self.cpus))):
+            for j in reversed(range(len(self.rams))):
+                for k in reversed(range(len(self.disks))):
+                    candidates = filter(None, [
+                        cells.get((self.cpus[i], self.rams[j],
+                                   self.disks[k])),
+                        best[i + 1][j][k], best[i][j + 1][k],
+                        best[i][j][k + 1]])
+                    if candidates:
+                        best[i][j][k] = min(candidates)
+        self.best = best
+
+    def __len__(self):
+        return len(self.flavors)
+
+    def solve(self, cpus=0, memory=0, disk=0):
+        """Smallest flavor with at least cpus, memory (mb) and disk (gb).
+        """
+        key = self.best[bisect_left(self.cpus, cpus)][
+            bisect_left(self.rams, memory)][bisect_left(self.disks, disk)]
+        if key is None:
+            return None
+        return self.flavors[key]
+
+
+def solve_flavor(index, constraints):
+    """Return the flavor for parsed constraints (see parse_constraints).
+    """
+    c = dict(DEFAULT_CONSTRAINTS)
+    c.update(constraints)
+    # Juju sizes disks in mb, okeanos flavors in gb.
+    disk = (c.get('disk', 0) + 1023) // 1024
+    flavor = index.solve(c['cpus'], c['memory'], disk)
+    if flavor is None:
+        raise ConstraintError("Could not match constraints %s" % (
+            ", ".join(["%s=%s" % (k, v) for k, v in sorted(c.items())])))
+    return flavor
+
+
 def get_images(client):
     images = {}
     for i in client.get_images():
@@ -3,22 +3,35 @@ import logging
 import shutil
 import subprocess
 import socket
+import threading
+import time
+import uuid
 
 import os
-import yaml
 
 log = logging.getLogger("juju.okeanos")
 
 from jujuclient import Environment as Client
 from juju_okeanos.constraints import SERIES_MAP
+from juju_okeanos.runner import Runner
+from juju_okeanos import ops, ssh, yamlio
 
 
 class Environment(object):
 
     _client = None
+    _status = None
+    _status_time = 0
+
+    # Seconds a fetched status is reused for, state changes made through
+    # this object invalidate it immediately.
+    status_ttl = 15
 
     def __init__(self, config):
         self.config = config
+        # The api connection is shared by all runner threads, calls on it
+        # are serialized.
+        self._client_lock = threading.RLock()
 
     def _run(self, command, env=None, capture_err=False):
         if env is None:
@@ -45,12 +58,115 @@ class Environment(object):
         return Client.connect(self.config.get_env_name())
 
     def close(self):
-        if self._client:
-            self._client.close()
-            self._client = None
+        with self._client_lock:
+            if self._client:
+                self._client.close()
+                self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = self.connect()
+        return self._client
+
+    def _machine_params(self, host, hardware=None):
+        return {
+            'Series': self.config.series,
+            'InstanceId': "manual:%s" % host,
+            'Jobs': ['JobHostUnits'],
+            'HardwareCharacteristics': hardware or {},
+            'Addrs': [],
+            'Nonce': "manual:%s" % uuid.uuid4().get_hex()}
+
+    def register_machines(self, machines):
+        """Register (host, hardware) pairs as manual machines.
+
+        Uses a single api call on the shared connection, returns a list of
+        (host, machine_id, provisioning script) for each registered host.
+        """
+        params = [self._machine_params(host, hw) for host, hw in machines]
+        registered = []
+        with self._client_lock:
+            self._status = None
+            client = self._get_client()
+            result = client.register_machines(params)
+            for (host, _), p, r in zip(machines, params, result['Machines']):
+                if r.get('Error'):
+                    log.error("Could not register %s: %s", host, r['Error'])
+                    continue
+                script = client.provisioning_script(r['Machine'], p['Nonce'])
+                registered.append((host, r['Machine'], script['Script']))
+        return registered
+
+    def provision_machine(self, host, machine_id, script):
+        """Run a registered machine's provisioning script on it over ssh.
+        """
+        try:
+            ssh.run_script(host, script)
+        except subprocess.CalledProcessError, e:
+            log.error("Failed to provision machine %s on %s\n%s",
+                      machine_id, host, e.output)
+            self.terminate_machines([machine_id])
+            raise
+        return machine_id
+
+    def add_machines(self, machines):
+        """Add (host, hardware) pairs, provisioning them concurrently.
+
+        Registers all hosts in one api call. Returns {host: machine id}
+        of the machines that provisioned successfully.
+        """
+        runner = Runner(self.config.parallel)
+        for host, machine_id, script in self.register_machines(machines):
+            runner.queue_op(ops.MachineProvisionScript(
+                None, self, dict(
+                    name=host, machine_id=machine_id, script=script)))
+        provisioned = {}
+        for result in runner.iter_outcomes():
+            if result.ok:
+                provisioned[result.op.params['name']] = result.value
+        return provisioned
+
+    def status(self, refresh=False):
+        """Return machines status, {'machines': {id: {'instance-id', ..}}}.
 
-    def status(self):
-        return yaml.safe_load(self._run(['status']))
+        Fetched via the api, falling back to the juju cli, and cached for
+        status_ttl seconds.
+        """
+        with self._client_lock:
+            if (not refresh and self._status is not None and
+                    time.time() - self._status_time < self.status_ttl):
+                return self._status
+            t = time.time()
+            try:
+                status = self._api_status()
+            except Exception, e:
+                log.debug("Api status failed, using juju status: %s", e)
+                status = self._cli_status()
+            log.debug("Fetched status in %0.2f seconds", time.time() - t)
+            self._status, self._status_time = status, time.time()
+            return status
+
+    def _api_status(self):
+        """Status via FullStatus, reduced to the machine fields we use.
+        """
+        result = self._get_client().status()
+        machines = {}
+        for mid, m in (result.get('Machines') or {}).items():
+            machines[mid] = {
+                'instance-id': m.get('InstanceId'),
+                'dns-name': m.get('DNSName')}
+        return {'machines': machines}
+
+    def _cli_status(self):
+        """Status via the juju cli, reduced like _api_status.
+        """
+        result = yamlio.load(self._run(['status'])) or {}
+        machines = {}
+        for mid, m in (result.get('machines') or {}).items():
+            machines[mid] = {
+                'instance-id': m.get('instance-id'),
+                'dns-name': m.get('dns-name')}
+        return {'machines': machines}
 
     def is_running(self):
         """Try to connect the api server websocket to see if env is running.
@@ -61,7 +177,7 @@ class Environment(object):
         if not os.path.exists(jenv):
             return False
         with open(jenv) as fh:
-            data = yaml.safe_load(fh.read())
+            data = yamlio.load(fh)
             if not data:
                 return False
             conf = data.get('bootstrap-config')
@@ -76,6 +192,7 @@ class Environment(object):
             return False
 
     def add_machine(self, location, debug=False):
+        self._status = None
         ops = ['add-machine', location]
         if debug:
             ops.append('--debug')
@@ -83,11 +200,13 @@ class Environment(object):
         return self._run(ops, capture_err=debug)
 
     def terminate_machines(self, machines):
+        self._status = None
         cmd = ['terminate-machine', '--force']
         cmd.extend(machines)
         return self._run(cmd)
 
     def destroy_environment(self):
+        self._status = None
         cmd = [
             'destroy-environment', "-y", self.config.get_env_name()]
         return self._run(cmd)
@@ -143,13 +262,12 @@ class Environment(object):
             os.path.join(boot_home, 'ssh'))
 
         # Updated env config with the bootstrap host.
-        with open(self.config.get_env_conf()) as fh:
-            data = yaml.safe_load(fh.read())
-            env_conf = data['environments'].get(env_name)
+        data = self.config.get_env_data()
+        env_conf = dict(data['environments'].get(env_name))
         env_conf['bootstrap-host'] = host
         with open(os.path.join(
                 boot_home, 'environments.yaml'), 'w') as fh:
-            fh.write(yaml.safe_dump({'environments': {env_name: env_conf}}))
+            yamlio.dump({'environments': {env_name: env_conf}}, fh)
 
         # Change JUJU_ENV
         env = dict(os.environ)
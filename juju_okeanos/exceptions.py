@@ -24,11 +24,29 @@ class TimeoutError(ValueError):
     """
 
 
+class OpCancelled(Exception):
+    """An op was cancelled, before it ran or while running.
+    """
+
+
 class ProviderError(Exception):
     """Instance could not be provisioned.
     """
 
 
+class MachineFailed(ProviderError):
+    """An instance reached a state it will not recover from.
+    """
+
+
+class RemoteScriptError(ProviderError):
+    """A configuration script failed on an instance.
+    """
+    def __init__(self, message, results):
+        super(RemoteScriptError, self).__init__(message)
+        self.results = results
+
+
 class ProviderAPIError(Exception):
     """
     """
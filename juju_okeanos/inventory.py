@@ -0,0 +1,115 @@
+"""
+Local record of an environment's servers, juju machines, ports and ips.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+
+log = logging.getLogger("juju.okeanos")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS machines (
+    server_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    fqdn TEXT,
+    machine_id TEXT UNIQUE,
+    created REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS machines_fqdn ON machines (fqdn);
+CREATE TABLE IF NOT EXISTS ports (
+    port_id TEXT PRIMARY KEY,
+    server_id TEXT NOT NULL REFERENCES machines (server_id),
+    network_id TEXT,
+    ip_address TEXT,
+    floating_ip_id TEXT);
+CREATE INDEX IF NOT EXISTS ports_server ON ports (server_id);
+CREATE INDEX IF NOT EXISTS ports_ip ON ports (ip_address);
+"""
+
+
+class Inventory(object):
+    """sqlite tables of the machines and ports created for an environment.
+
+    Lets commands resolve juju machines, addresses and servers with an
+    indexed lookup instead of listing the whole account. With no path
+    the inventory is only kept in memory. Ids are stored as text.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        # Runner workers share the connection, serialized by the lock.
+        self.db = sqlite3.connect(
+            path or ':memory:', check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def _execute(self, query, *args):
+        with self.lock, self.db:
+            return self.db.execute(query, args).fetchall()
+
+    def add_machine(self, server_id, name, fqdn=None):
+        self._execute(
+            "INSERT OR REPLACE INTO machines (server_id, name, fqdn, created)"
+            " VALUES (?, ?, ?, ?)", str(server_id), name, fqdn, time.time())
+
+    def set_machine_id(self, server_id, machine_id):
+        # Juju reuses machine ids, a row left by a server that is gone
+        # mustn't keep it.
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE machines SET machine_id = NULL WHERE machine_id = ?",
+                (machine_id,))
+            self.db.execute(
+                "UPDATE machines SET machine_id = ? WHERE server_id = ?",
+                (machine_id, str(server_id)))
+
+    def add_port(self, server_id, port_id, network_id=None, ip_address=None,
+                 floating_ip_id=None):
+        self._execute(
+            "INSERT OR REPLACE INTO ports (port_id, server_id, network_id, "
+            "ip_address, floating_ip_id) VALUES (?, ?, ?, ?, ?)",
+            str(port_id), str(server_id), network_id and str(network_id),
+            ip_address, floating_ip_id and str(floating_ip_id))
+
+    def get(self, server_id):
+        rows = self._execute(
+            "SELECT * FROM machines WHERE server_id = ?", str(server_id))
+        return rows and dict(rows[0]) or None
+
+    def find(self, machine_id=None, address=None):
+        """Machine record by juju machine id, or by fqdn or port ip."""
+        if machine_id is not None:
+            rows = self._execute(
+                "SELECT * FROM machines WHERE machine_id = ?", machine_id)
+        else:
+            rows = self._execute(
+                "SELECT * FROM machines WHERE fqdn = ? UNION "
+                "SELECT machines.* FROM machines JOIN ports USING "
+                "(server_id) WHERE ports.ip_address = ?", address, address)
+        return rows and dict(rows[0]) or None
+
+    def machines(self):
+        return [dict(r) for r in self._execute(
+            "SELECT * FROM machines ORDER BY created")]
+
+    def ports(self, server_id):
+        return [dict(r) for r in self._execute(
+            "SELECT * FROM ports WHERE server_id = ?", str(server_id))]
+
+    def remove(self, server_id):
+        self._execute("DELETE FROM ports WHERE server_id = ?", str(server_id))
+        self._execute(
+            "DELETE FROM machines WHERE server_id = ?", str(server_id))
+
+    def clear(self):
+        """Forget every machine, once the environment is destroyed."""
+        self._execute("DELETE FROM ports")
+        self._execute("DELETE FROM machines")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
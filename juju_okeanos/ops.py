@@ -1,10 +1,12 @@
 import logging
 import subprocess
+import threading
 import time
 import uuid
 
 
-from juju_okeanos.exceptions import TimeoutError, ProviderAPIError
+from juju_okeanos.exceptions import (
+    MachineFailed, OpCancelled, TimeoutError)
 from juju_okeanos import ssh, constraints
 
 
@@ -13,16 +15,33 @@ log = logging.getLogger("juju.docean")
 
 class MachineOp(object):
 
+    # Seconds run may take before the runner reports the op as failed.
+    deadline = None
+
     def __init__(self, provider, env, params, **options):
         self.provider = provider
         self.env = env
         self.params = params
         self.created = time.time()
         self.options = options
+        self.cancelled = threading.Event()
 
     def run(self):
         raise NotImplementedError()
 
+    def cancel(self):
+        """Called by the runner when it abandons the op.
+
+        The run keeps going on its thread but its result is dropped, so
+        a run still in progress must undo what it creates.
+        """
+        self.cancelled.set()
+
+    def __str__(self):
+        return "%s %s" % (
+            self.__class__.__name__,
+            self.params.get('name') or self.params.get('instance_id'))
+
 
 class MachineUserDataRegister(MachineOp):
 
@@ -64,6 +83,11 @@ class MachineAdd(MachineOp):
         max_time = self.timeout + time.time()
         running = False
         while max_time > time.time():
+            # Only start an ssh process once sshd sends its banner.
+            if not ssh.probe_banners([instance.ip_address])[
+                    instance.ip_address]:
+                time.sleep(0.5)
+                continue
             try:
                 if ssh.check_ssh(instance.ip_address):
                     running = True
@@ -83,6 +107,10 @@ class MachineAdd(MachineOp):
                         "Could not ssh to instance name: %s id: %s ip: %s\n%s",
                         instance.name, instance.id, instance.ip_address,
                         e.output)
+                    error = ssh.fatal_error(e.output)
+                    if error:
+                        raise MachineFailed("ssh to %s failed: %s" % (
+                            instance.ip_address, error))
                     raise
 
         if running is False:
@@ -105,24 +133,52 @@ class MachineRegister(MachineAdd):
         return instance, machine_id
 
 
+class MachineProvisionScript(MachineOp):
+    """Run the provisioning script of a registered manual machine.
+    """
+
+    def run(self):
+        return self.env.provision_machine(
+            self.params['name'], self.params['machine_id'],
+            self.params['script'])
+
+
+class MachineProvision(MachineOp):
+    """Create an instance and route it via the gateway.
+
+    The per machine pipeline runs in a single op so a batch of machines
+    can be created concurrently by the runner, AddMachine then registers
+    all of them with juju at once.
+    """
+
+    deadline = 1800
+
+    def run(self):
+        if self.cancelled.is_set():
+            raise OpCancelled("%s cancelled" % self)
+        instance = self.provider.add_machine(
+            self.params, private_net=self.options.get('private_net'))
+        try:
+            self.provider.set_internal_gw(instance)
+            if self.cancelled.is_set():
+                raise OpCancelled(
+                    "%s cancelled, terminating id:%s" % (
+                        self, instance['id']))
+        except:
+            self.provider.terminate_instance(instance['id'])
+            raise
+        return instance
+
+
 class MachineDestroy(MachineOp):
 
+    deadline = 600
+
     def run(self):
         if not self.options.get('iaas_only'):
             self.env.terminate_machines([self.params['machine_id']])
         if self.options.get('env_only'):
             return
         log.debug("Destroying instance %s", self.params['instance_id'])
-        while True:
-            try:
-                self.provider.terminate_instance(self.params['instance_id'])
-                break
-            except ProviderAPIError, e:
-                # The vm has a pending event, sleep and try again.
-                if e.message['id'] == 'unprocessable_entity':
-                    log.debug(
-                        "Waiting for pending instance action to complete.")
-                    time.sleep(6)
-                    continue
-                raise
-            break
+        # The provider retries deletes refused for a pending action.
+        self.provider.terminate_instance(self.params['instance_id'])
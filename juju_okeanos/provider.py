@@ -1,5 +1,8 @@
+import hashlib
 import logging
+import operator
 import os
+import threading
 import time
 
 from kamaki.clients import ClientError
@@ -10,44 +13,134 @@ from kamaki import defaults
 from kamaki.clients.utils import https
 from kamaki.clients.cyclades import CycladesNetworkClient
 
-from juju_okeanos.exceptions import ConfigError, ProviderError
-from juju_okeanos.client import Client
-from juju_okeanos.constraints import init
+from juju_okeanos import aio
+from juju_okeanos.aio import Return
+from juju_okeanos.catalog import Catalog
+from juju_okeanos.inventory import Inventory
+from juju_okeanos.exceptions import (
+    ConfigError, MachineFailed, ProviderError, TimeoutError)
+from juju_okeanos.client import Instance
+from juju_okeanos.ratelimit import RateLimitedClient, limiter
+from juju_okeanos.constraints import (
+    init, FlavorIndex, flavor_to_resources, solve_flavor)
+from juju_okeanos.runner import Runner
+from juju_okeanos import remote, ssh
+from juju_okeanos.wait import wait_for
+from juju_okeanos.watcher import Watcher, changes_since
 from kamaki.cli.config import Config
 from base64 import b64encode
-from time import sleep
 import subprocess
 
 log = logging.getLogger("juju.okeanos")
 
-
-def factory():
-    cfg = Okeanos.get_config()
-    okeanos = Okeanos(cfg)
+# Server metadata tagging the machines of a juju environment.
+META_ENV = 'juju-env'
+META_MACHINE_ID = 'juju-machine-id'
+META_ROLE = 'juju-role'
+
+
+def factory(pool_size=None, catalog_dir=None, refresh_catalog=False,
+            async_ops=False, inventory_path=None, env_name=None,
+            kamaki_config=None):
+    cfg = kamaki_config or Okeanos.get_config()
+    provider_class = async_ops and AsyncOkeanos or Okeanos
+    okeanos = provider_class(
+        cfg, pool_size=pool_size, catalog_dir=catalog_dir,
+        refresh_catalog=refresh_catalog,
+        inventory=Inventory(inventory_path), env_name=env_name)
     return okeanos
 
 
 def validate():
-    Okeanos.get_config()
+    """Check the kamaki configuration, returns it parsed."""
+    return Okeanos.get_config()
 
 
 class Okeanos(object):
 
-    def __init__(self, config):
+    # Servers per page of a listing.
+    page_size = 500
+
+    # Seconds a delete is retried while the server has a pending action.
+    delete_conflict_timeout = 120
+
+    def __init__(self, config, pool_size=None, catalog_dir=None,
+                 refresh_catalog=False, inventory=None, env_name=None):
         self.config = config
+        # Servers we create are tagged with it.
+        self.env_name = env_name
+        # What we created, so lookups don't need account listings.
+        self.inventory = inventory or Inventory()
+        # Floating ip ids of terminated servers, released once they are
+        # confirmed gone.
+        self._floating_ips = {}
+        # Keep-alive connections per endpoint, shared by all threads.
+        self.pool_size = pool_size or Runner.DEFAULT_NUM_RUNNER
+        # kamaki clients keep per request state on the instance, so each
+        # thread gets its own set, built from the endpoints resolved below.
+        self._clients = threading.local()
+        self._flavor_index = None
+        # Every pending server (port) is polled by a single list call.
+        self.server_watcher = Watcher(
+            'server-active', self._changed_servers, self._ready_status)
+        self.port_watcher = Watcher(
+            'port-active', self._changed_ports, self._ready_status,
+            interval=1.0)
+        self.delete_watcher = Watcher(
+            'server-deleted', self._changed_servers,
+            lambda srv: srv['status'] == 'DELETED')
+        # One banner probe round for all hosts waiting on sshd, each
+        # host is resolved once and probed by address afterwards.
+        self._ssh_addresses = {}
+        self.ssh_watcher = Watcher(
+            'ssh-banner', self._probe_ssh, operator.itemgetter('banner'),
+            interval=0.5)
         cloud_name = self.config.get('global', 'default_cloud')
         self.auth_token = self.config.get_cloud(cloud_name, 'token')
         cacerts_path = self.config.get('global', 'ca_certs')
         https.patch_with_certs(cacerts_path)
-        auth_url = self.config.get_cloud(cloud_name, 'url')
-        auth = AstakosClient(auth_url, self.auth_token)
-        self.endpoints = dict(
+        self.auth_url = self.config.get_cloud(cloud_name, 'url')
+        catalog_path = None
+        if catalog_dir:
+            # Catalogs are per cloud and per user (projects).
+            catalog_path = os.path.join(
+                catalog_dir, "okeanos-catalog-%s.json" % hashlib.sha1(
+                    "%s %s" % (self.auth_url, self.auth_token)
+                ).hexdigest()[:12])
+        self.catalog = Catalog(catalog_path, refresh=refresh_catalog)
+        # Endpoints are discovered when a client first needs one, so
+        # commands that never reach the api don't authenticate.
+        self._discovered = None
+        self._discover_lock = threading.Lock()
+
+    def _discover(self):
+        with self._discover_lock:
+            if self._discovered is None:
+                self._discovered = self.catalog.get(
+                    'endpoints',
+                    lambda: self.discover_endpoints(self.auth_url))
+        return self._discovered
+
+    @property
+    def endpoints(self):
+        return self._discover()['endpoints']
+
+    @property
+    def user_id(self):
+        return self._discover()['user_id']
+
+    def discover_endpoints(self, auth_url):
+        auth = RateLimitedClient(AstakosClient(auth_url, self.auth_token),
+                                 limiter)
+        endpoints = dict(
             astakos=auth_url,
             cyclades=auth.get_endpoint_url(CycladesComputeClient.service_type),
             network=auth.get_endpoint_url(CycladesNetworkClient.service_type),
             plankton=auth.get_endpoint_url(ImageClient.service_type)
             )
-        self.user_id = auth.user_info['id']
+        auth.poolsize = self.pool_size
+        self._clients.astakos = auth
+        return dict(endpoints=endpoints, user_id=auth.user_info['id'])
 
     @property
     def version(self):
@@ -77,41 +170,43 @@ class Okeanos(object):
         if env is None:
             env = dict(os.environ)
         
-        args = ['ssh', '-oStrictHostKeyChecking=no', 'root@{}'.format(vm['fqdn'])]
+        args = ssh.sessions.command(vm['fqdn'])
         args.extend(command)
         log.debug("Running juju command: %s", " ".join(args))
         try:
             if capture_err:
                 return subprocess.check_call(
                     args, env=env, stderr=subprocess.STDOUT)
-            return subprocess.check_output(
-                args, env=env, stderr=subprocess.STDOUT)
+            return ssh.check_output(args, env=env)
         except subprocess.CalledProcessError, e:
             log.error(
                 "Failed to run command %s\n%s",
                 ' '.join(args), e.output)
             raise
 
+    def _get_client(self, service, client_class):
+        client = getattr(self._clients, service, None)
+        if client is None:
+            # Authenticating needs no discovery.
+            url = service == 'astakos' and self.auth_url or \
+                self.endpoints[service]
+            client = RateLimitedClient(
+                client_class(url, self.auth_token), limiter)
+            client.poolsize = self.pool_size
+            setattr(self._clients, service, client)
+        return client
+
     def get_image_client(self):
-        astakos = AstakosClient(self.endpoints['astakos'], self.auth_token)
-        image_url = astakos.get_endpoint_url(ImageClient.service_type)
-        plankton = ImageClient(image_url, self.auth_token)
-        return plankton
+        return self._get_client('plankton', ImageClient)
 
     def get_compute_client(self):
-        astakos = AstakosClient(self.endpoints['astakos'], self.auth_token)
-        cyclades_url = astakos.get_endpoint_url(CycladesComputeClient.service_type)
-        compute_client = CycladesComputeClient(cyclades_url, self.auth_token)
-        return compute_client
-    
+        return self._get_client('cyclades', CycladesComputeClient)
+
     def get_network_client(self):
-        astakos = AstakosClient(self.endpoints['astakos'], self.auth_token)
-        network_url = astakos.get_endpoint_url(CycladesNetworkClient.service_type)
-        network_client = CycladesNetworkClient(network_url, self.auth_token)
-        return network_client
-    
+        return self._get_client('network', CycladesNetworkClient)
+
     def get_identity_client(self):
-        return AstakosClient(self.endpoints['astakos'], self.auth_token)
+        return self._get_client('astakos', AstakosClient)
 
     def add_private_network(self, recreate=True):
         existing_net = self.get_private_network()
@@ -126,7 +221,10 @@ class Okeanos(object):
         network.create_subnet(net['id'], '192.168.1.0/24')
         #network.create_subnet(net['id'], '192.168.1.0/24' , gateway_ip='192.168.1.1', 
         #                      allocation_pools={"start": "192.168.1.2", "end": "192.168.1.254"},  enable_dhcp=True)
-        sleep(10)
+        net['status'] = wait_for(
+            lambda: self._ready_status(
+                network.get_network_details(net['id'])),
+            'network-active', net['id'], timeout=120)
         return net
 
     def get_private_network(self):
@@ -144,8 +242,9 @@ class Okeanos(object):
         print("****** Private port for vm  with id {} *******".format(vm['id']))
         print(port)
         print("****** port *******")
-        port['status'] = network.wait_port(port['id'], port['status'])
-        sleep(10)
+        self.inventory.add_port(
+            vm['id'], port['id'], net['id'], self._port_ip(port))
+        port['status'] = self.wait_port_active(port)
         return port
 
     def attach_public_ip_to_machine(self, vm):
@@ -160,35 +259,132 @@ class Okeanos(object):
         print("****** Public port for vm  with id {} *******".format(vm['id']))
         print(port)
         print("****** port *******")
-        port['status'] = network.wait_port(port['id'], port['status'])
-        sleep(10)
+        self.inventory.add_port(
+            vm['id'], port['id'], ip['floating_network_id'],
+            ip['floating_ip_address'], ip['id'])
+        port['status'] = self.wait_port_active(port)
         return port
 
+    @staticmethod
+    def _port_ip(port):
+        for fixed_ip in port.get('fixed_ips') or ():
+            return fixed_ip.get('ip_address')
+
+    def forget_instances(self, instance_ids):
+        """Release the floating ips of deleted servers, drop their records.
+        """
+        network = self.get_network_client()
+        for instance_id in instance_ids:
+            ports = self._floating_ips.pop(str(instance_id), []) + [
+                p for p in self.inventory.ports(instance_id)
+                if p['floating_ip_id']]
+            for port in ports:
+                try:
+                    network.delete_floatingip(port['floating_ip_id'])
+                except ClientError, e:
+                    log.warning("Could not release floating ip %s: %s",
+                                port['ip_address'], e)
+            self.inventory.remove(instance_id)
+
+    @staticmethod
+    def _ready_status(resource):
+        if resource['status'] == 'ACTIVE':
+            return resource['status']
+        if resource['status'] in ('ERROR', 'DELETED'):
+            raise MachineFailed("%s entered %s state" % (
+                resource['id'], resource['status']))
+
+    @staticmethod
+    def _check_ssh(vm):
+        try:
+            return ssh.check_ssh(vm['fqdn'])
+        except subprocess.CalledProcessError, e:
+            error = ssh.fatal_error(e.output)
+            if error:
+                raise MachineFailed("ssh to %s failed: %s" % (
+                    vm['fqdn'], error))
+            raise
+
+    def _changed_servers(self, since, ids):
+        return self.get_compute_client().list_servers(
+            detail=True, changes_since=changes_since(since))
+
+    def _changed_ports(self, since, ids):
+        # The ports api has no changes-since filter.
+        return self.get_network_client().list_ports(detail=True)
+
+    def _probe_ssh(self, since, hosts):
+        banners = ssh.probe_banners(
+            hosts, timeout=0.5, addresses=self._ssh_addresses)
+        for host, banner in banners.items():
+            if banner:
+                self._ssh_addresses.pop(host, None)
+        return [dict(id=host, banner=banner)
+                for host, banner in banners.items()]
+
+    def wait_server_active(self, srv):
+        return self.server_watcher.wait(srv['id'], timeout=600)
+
+    def watch_instances_gone(self, instance_ids):
+        """Start watching servers about to be deleted.
+
+        The watcher only lists recent changes, deletes older than its
+        skew would never be seen, so watch before deleting.
+        """
+        return [self.delete_watcher.watch(i) for i in instance_ids]
+
+    def wait_instances_gone(self, instance_ids, timeout=300, waiters=None):
+        """Wait on deleted servers, returns the ids still around.
+
+        Servers not seen deleted by the deadline are looked up one by
+        one, those missing or DELETED are gone.
+        """
+        deadline = time.time() + timeout
+        if waiters is None:
+            waiters = self.watch_instances_gone(instance_ids)
+        remaining = []
+        for waiter in waiters:
+            try:
+                waiter.result(max(0, deadline - time.time()))
+            except TimeoutError:
+                self.delete_watcher.discard(waiter.resource_id, waiter)
+                if not self._server_gone(waiter.resource_id):
+                    remaining.append(waiter.resource_id)
+        return remaining
+
+    def _server_gone(self, instance_id):
+        try:
+            srv = self.get_compute_client().get_server_details(instance_id)
+        except ClientError, e:
+            if e.status == 404:
+                return True
+            log.debug("Could not check server %s: %s", instance_id, e)
+            return False
+        return srv['status'] == 'DELETED'
+
+    def wait_port_active(self, port):
+        return self.port_watcher.wait(port['id'], timeout=120)
+
+    def wait_ssh(self, vm):
+        # Cheap banner probes until sshd answers, then one real login.
+        self.ssh_watcher.wait(vm['fqdn'], timeout=300)
+        return wait_for(
+            lambda: self._check_ssh(vm),
+            'ssh', vm['fqdn'], timeout=60, delay=2,
+            retry_on=(subprocess.CalledProcessError,))
+
     def set_internal_gw(self, vm):
-        self.remote_run(vm, ["route del default"])
         # get this from param
-        # make this permanent
-        sleep(10)
-        self.remote_run(vm, ["route add default gw 192.168.1.2 eth1"])
-        sleep(10)
+        return remote.gateway_script("192.168.1.2", "eth1").run(vm['fqdn'])
 
     def set_nat(self, vm):
-        self.remote_run(vm, ["echo 1 > /proc/sys/net/ipv4/ip_forward"])
-        sleep(10)
-        self.remote_run(vm, ["iptables -F"])
-        sleep(10)
-        self.remote_run(vm, ["iptables -t nat -F"])
-        sleep(10)
         # get this from param
-        # make this permanent
-        self.remote_run(vm, ["iptables -t nat -A POSTROUTING -o eth1 -j MASQUERADE"])
-        sleep(10)
+        return remote.nat_script("eth1").run(vm['fqdn'])
 
 
-    def add_machine(self, params, private_net=None, is_gateway=False, public_net=None):
-        print(self.config)
-        compute_client = self.get_compute_client()
-
+    def _server_args(self, params, private_net=None, public_net=None,
+                     is_gateway=False):
+        """Flavor and create_server arguments for a machine."""
         #Prepare ssh keys
         okeanos_ssh_key_path = os.environ.get('OKEANOS_SSH_KEY')
         ssh_keys = dict(
@@ -196,16 +392,7 @@ class Okeanos(object):
                 path='/root/.ssh/authorized_keys',
                 owner='root', group='root', mode=0600)
 
-        #TODO(get from params)
-        constraints = dict(
-               ram=2048,
-               vcpus=1,
-               max_disk=10,
-               min_disk=1)
-
-        flv = self.get_flavor(constraints)
-        if not flv:
-            raise ConfigError("No flavor found")
+        flv = self.get_flavor(params.get('constraints', {}))
 
         img = self.get_ubuntu_image()
 
@@ -217,36 +404,78 @@ class Okeanos(object):
         if public_net:
             networks.append({'uuid':public_net['id']})
 
-        srv = compute_client.create_server(
-                       params['name'],
-                       flavor_id=flv['id'], 
-                       image_id=img['id'], 
-                       personality=[ssh_keys],
-                       project_id=project,
-                       networks=networks)
-
-        print("Waiting for server....")    
-        compute_client.wait_server(srv['id'], srv['status'])
-
-        conn_info = dict(fqdn=srv['SNF:fqdn'], ip_address=[], id=srv['id'])
-        nics = compute_client.get_server_nics(srv['id'])
+        metadata = {META_ROLE: is_gateway and 'gateway' or 'worker'}
+        if self.env_name:
+            metadata[META_ENV] = self.env_name
+
+        return flv, dict(flavor_id=flv['id'],
+                         image_id=img['id'],
+                         personality=[ssh_keys],
+                         project_id=project,
+                         networks=networks,
+                         metadata=metadata)
+
+    @staticmethod
+    def _conn_info(srv, flv, nics):
+        conn_info = dict(fqdn=srv['SNF:fqdn'], ip_address=[], id=srv['id'],
+                         hardware=flavor_to_resources(flv))
         for port in nics['attachments']:
             if port['ipv4']:
                 conn_info['ip_address'].append(port['ipv4'])
             if port['ipv6']:
                 conn_info['ip_address'].append(port['ipv6'])
+        return conn_info
+
+    def add_machine(self, params, private_net=None, is_gateway=False, public_net=None):
+        print(self.config)
+        compute_client = self.get_compute_client()
+        flv, server_args = self._server_args(
+            params, private_net, public_net, is_gateway)
+        srv = compute_client.create_server(params['name'], **server_args)
+        self.inventory.add_machine(
+            srv['id'], params['name'], srv.get('SNF:fqdn'))
+
+        print("Waiting for server....")    
+        try:
+            srv['status'] = self.wait_server_active(srv)
 
-        print(conn_info)
-        print(srv)
-        print(nics)
-        sleep(30)
+            nics = compute_client.get_server_nics(srv['id'])
+            conn_info = self._conn_info(srv, flv, nics)
+
+            print(conn_info)
+            print(srv)
+            print(nics)
+            self.wait_ssh(conn_info)
+        except MachineFailed, e:
+            self._discard_server(srv, e)
+            raise
         return conn_info
 
+    def register_machine(self, instance_id, machine_id):
+        """Record and tag the juju machine id of a server."""
+        self.inventory.set_machine_id(instance_id, machine_id)
+        try:
+            self.get_compute_client().update_server_metadata(
+                instance_id, **{META_MACHINE_ID: machine_id})
+        except ClientError, e:
+            log.warning("Could not tag server %s as machine %s: %s",
+                        instance_id, machine_id, e)
+
+    def _discard_server(self, srv, error):
+        """Delete a server that failed to come up, it won't recover."""
+        log.warning("Deleting failed server %s %s: %s",
+                    srv['id'], srv.get('name', ''), error)
+        try:
+            self.get_compute_client().delete_server(srv['id'])
+        except ClientError, e:
+            log.debug("Could not delete server %s: %s", srv['id'], e)
+        self.inventory.remove(srv['id'])
+
 
     def get_project_id(self):
         okeanos_project_name = os.environ.get('OKEANOS_PROJECT')
         identity_client = self.get_identity_client()
-        for p in identity_client.get_projects():
+        for p in self.catalog.get('projects', identity_client.get_projects):
             if okeanos_project_name == p['name']:
                 print(p)
                 return p['id']
@@ -256,64 +485,273 @@ class Okeanos(object):
 
     def get_ubuntu_image(self):
         image_client = self.get_image_client()
-        for img in image_client.list_public():
+        for img in self.catalog.get('images', image_client.list_public):
             image_path = img['name']
             if "Ubuntu Server LTS" in image_path:
                 print 'Image %s' % img
                 return img
  
 
-    def get_flavor(self, constraints):
-        compute_client = self.get_compute_client()
-
-        for flv in compute_client.list_flavors(detail=True):
-            if flv['ram'] == constraints['ram'] and flv['vcpus'] == constraints['vcpus'] and constraints['min_disk'] <= flv['disk'] <= constraints['max_disk']:
-                print 'Flavor', flv, 'matches'
-                return flv
+    def get_flavor_index(self):
+        if self._flavor_index is None:
+            compute_client = self.get_compute_client()
+            flavors = self.catalog.get(
+                'flavors', lambda: compute_client.list_flavors(detail=True))
+            self._flavor_index = FlavorIndex(flavors)
+        return self._flavor_index
 
-        return None
-
-
-    def get_instances(self):
-        return self.client.get_droplets()
+    def get_flavor(self, constraints):
+        """Smallest flavor satisfying parsed juju constraints.
+        """
+        flv = solve_flavor(self.get_flavor_index(), constraints)
+        log.debug("Flavor %s matches constraints", flv['name'])
+        return flv
+
+
+    def iter_servers(self, **filters):
+        """Detailed servers, fetched a page at a time with marker/limit.
+        """
+        compute = self.get_compute_client()
+        marker = None
+        while True:
+            page = compute.list_servers(
+                detail=True, marker=marker, limit=self.page_size, **filters)
+            if marker is not None and page and page[-1]['id'] == marker:
+                # The api ignores marker, we've had the whole listing.
+                return
+            for srv in page:
+                yield srv
+            # A short page is the last, a long one means limit is ignored
+            # and the listing is complete.
+            if len(page) != self.page_size:
+                return
+            marker = page[-1]['id']
+
+    @staticmethod
+    def make_instance(srv):
+        """Compact record of a detailed server."""
+        metadata = srv.get('metadata') or {}
+        ip_addresses = []
+        for network_id, addresses in sorted(
+                (srv.get('addresses') or {}).items()):
+            for address in addresses:
+                ip_addresses.append(address['addr'])
+        return Instance(
+            id=str(srv['id']), name=srv['name'], fqdn=srv.get('SNF:fqdn'),
+            ip_addresses=ip_addresses, status=srv['status'],
+            flavor_id=(srv.get('flavor') or {}).get('id'),
+            created=srv.get('created'),
+            machine_id=metadata.get(META_MACHINE_ID),
+            role=metadata.get(META_ROLE))
+
+    def iter_instances(self, all_servers=False):
+        """Instances of the environment, or of the whole account.
+
+        Cyclades can't filter servers on metadata. The name filter
+        narrows the listing where the api supports it, the environment
+        tag is checked on what comes back so name collisions don't match.
+        Untagged servers, created before tagging, match by name prefix.
+        """
+        if all_servers:
+            servers = self.iter_servers()
+        elif not self.env_name:
+            raise ProviderError("No environment name to list servers of")
+        else:
+            servers = (srv for srv in self.iter_servers(name=self.env_name)
+                       if self._in_environment(srv))
+        for srv in servers:
+            yield self.make_instance(srv)
+
+    def _in_environment(self, srv):
+        env_name = (srv.get('metadata') or {}).get(META_ENV)
+        if env_name is not None:
+            return env_name == self.env_name
+        if srv['name'].startswith("%s-" % self.env_name):
+            log.debug("Matched untagged server %s %s by name",
+                      srv['id'], srv['name'])
+            return True
+        return False
+
+    def get_instances(self, all_servers=False):
+        return list(self.iter_instances(all_servers))
 
     def get_instance(self, instance_id):
-        return self.client.get_droplet(instance_id)
+        return self.make_instance(
+            self.get_compute_client().get_server_details(instance_id))
 
     def launch_instance(self, params):
-        if not 'virtio' in params:
-            params['virtio'] = True
-        if not 'private_networking' in params:
-            params['private_networking'] = True
-        if 'ssh_key_ids' in params:
-            params['ssh_key_ids'] = map(str, params['ssh_key_ids'])
-        return self.client.create_droplet(**params)
+        """Create a server without waiting on it, see wait_on.
+
+        Cyclades has no user data, a user_data script is not run.
+        """
+        compute_client = self.get_compute_client()
+        flv, server_args = self._server_args(params)
+        srv = compute_client.create_server(params['name'], **server_args)
+        self.inventory.add_machine(
+            srv['id'], params['name'], srv.get('SNF:fqdn'))
+        return self.make_instance(srv)
 
     def terminate_instance(self, instance_id):
-        self.client.destroy_droplet(instance_id)
+        # Cyclades refuses deletes (409) while the server has a pending
+        # action, e.g. still building, retry until it settles.
+        wait_for(lambda: self._delete_server(instance_id),
+                 'server-delete', instance_id,
+                 timeout=self.delete_conflict_timeout, delay=2)
+        # Its record goes now, so no lookup resolves to a dead server,
+        # forget_instances still releases its floating ips.
+        floating_ips = [p for p in self.inventory.ports(instance_id)
+                        if p['floating_ip_id']]
+        if floating_ips:
+            self._floating_ips.setdefault(str(instance_id), []).extend(
+                floating_ips)
+        self.inventory.remove(instance_id)
+
+    def _delete_server(self, instance_id):
+        try:
+            self.get_compute_client().delete_server(instance_id)
+        except ClientError, e:
+            if e.status == 409:
+                log.debug("Instance %s busy, retrying delete: %s",
+                          instance_id, e)
+                return False
+            if e.status != 404:
+                raise
+            log.debug("Instance %s already deleted", instance_id)
+            # It won't show up in the watcher's listing.
+            self.delete_watcher.resolve(instance_id, 'DELETED')
+        return True
 
     def wait_on(self, instance):
-        return self._wait_on(instance.event_id, instance.name)
-
-    def _wait_on(self, event, name, event_type=1):
-        loop_count = 0
-        while 1:
-            time.sleep(8)  # Takes on average 1m for a do instance.
-            done, result = self.client.create_done(event, name)
-            if done:
-                log.debug("Instance %s ready", name)
+        return self.server_watcher.wait(instance.id, timeout=600)
+
+
+class AsyncOkeanos(Okeanos):
+    """Okeanos with coroutine ops, all driven by one event loop.
+
+    The Okeanos methods are unchanged, async_* ones take the same
+    arguments as their namesakes but return coroutines, run them with
+    run or many at once with run_all. Api calls block on an executor of
+    pool_size threads, each with its own clients, while waits only hold
+    a timer on the loop. add-machine --event-loop creates its machines
+    this way.
+    """
+
+    def __init__(self, config, loop=None, **kw):
+        super(AsyncOkeanos, self).__init__(config, **kw)
+        self.loop = loop or aio.EventLoop(self.pool_size)
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def run_all(self, coros, return_exceptions=True):
+        return self.run(self.loop.gather(coros, return_exceptions))
+
+    def close(self):
+        self.loop.close()
+
+    def _call(self, get_client, method, *args, **kw):
+        """Future for a client call, made on an executor thread."""
+        return self.loop.run_in_executor(
+            lambda: getattr(get_client(), method)(*args, **kw))
+
+    def async_add_machine(self, params, private_net=None, is_gateway=False,
+                    public_net=None):
+        flv, server_args = yield self.loop.run_in_executor(
+            self._server_args, params, private_net, public_net, is_gateway)
+        srv = yield self._call(
+            self.get_compute_client, 'create_server', params['name'],
+            **server_args)
+        self.inventory.add_machine(
+            srv['id'], params['name'], srv.get('SNF:fqdn'))
+        try:
+            srv['status'] = yield self.async_wait_server_active(srv)
+            nics = yield self._call(
+                self.get_compute_client, 'get_server_nics', srv['id'])
+            conn_info = self._conn_info(srv, flv, nics)
+            yield self.async_wait_ssh(conn_info)
+        except MachineFailed, e:
+            yield self.loop.run_in_executor(self._discard_server, srv, e)
+            raise
+        raise Return(conn_info)
+
+    def async_provision_machine(self, params, private_net=None):
+        """Create a machine and route it via the gateway."""
+        instance = yield self.async_add_machine(
+            params, private_net=private_net)
+        try:
+            yield self.loop.run_in_executor(self.set_internal_gw, instance)
+        except:
+            yield self.async_terminate_instance(instance['id'])
+            raise
+        raise Return(instance)
+
+    def async_attach_private_ip_to_machine(self, net, vm):
+        port = yield self._call(
+            self.get_network_client, 'create_port', net['id'], vm['id'])
+        self.inventory.add_port(
+            vm['id'], port['id'], net['id'], self._port_ip(port))
+        port['status'] = yield self.async_wait_port_active(port)
+        raise Return(port)
+
+    def async_attach_public_ip_to_machine(self, vm):
+        project = yield self.loop.run_in_executor(self.get_project_id)
+        ip = yield self._call(
+            self.get_network_client, 'create_floatingip', project_id=project)
+        log.debug("Reserved new IP %s", ip['floating_ip_address'])
+        port = yield self._call(
+            self.get_network_client, 'create_port',
+            network_id=ip['floating_network_id'], device_id=vm['id'],
+            fixed_ips=[dict(ip_address=ip['floating_ip_address'])])
+        self.inventory.add_port(
+            vm['id'], port['id'], ip['floating_network_id'],
+            ip['floating_ip_address'], ip['id'])
+        port['status'] = yield self.async_wait_port_active(port)
+        raise Return(port)
+
+    def async_terminate_instance(self, instance_id):
+        yield self.loop.run_in_executor(
+            self.terminate_instance, instance_id)
+
+    def async_get_instances(self, all_servers=False):
+        instances = yield self.loop.run_in_executor(
+            self.get_instances, all_servers)
+        raise Return(instances)
+
+    def _watch(self, watcher, resource_id, timeout):
+        """Future for a watcher wait, resolved on the loop."""
+        future = aio.Future()
+        waiter = watcher.watch(resource_id)
+
+        def settle(waiter):
+            if future.done():
                 return
+            if waiter.exception is not None:
+                future.set_exception(waiter.exception)
             else:
-                log.debug("Waiting on instance %s", name)
-            if loop_count > 8:
-                # Its taking a long while (2m+), give the user some
-                # diagnostics if in debug mode.
-                log.debug("Diagnostics on instance %s event %s",
-                          name, result)
-            if loop_count > 25:
-                # After 3.5m for instance, just bail as provider error.
-                raise ProviderError(
-                    "Failed to get running instance %s event: %s" % (
-                        name, result))
-            loop_count += 1
-
+                future.set_result(waiter.value)
+
+        def expire():
+            if not future.done():
+                watcher.discard(resource_id, waiter)
+                future.set_exception(TimeoutError(
+                    "Timed out after %ds waiting on %s %s" % (
+                        timeout, watcher.name, resource_id)))
+
+        waiter.add_done_callback(
+            lambda waiter: self.loop.call_soon_threadsafe(settle, waiter))
+        self.loop.call_later(timeout, expire)
+        return future
+
+    def async_wait_server_active(self, srv):
+        return self._watch(self.server_watcher, srv['id'], 600)
+
+    def async_wait_port_active(self, port):
+        return self._watch(self.port_watcher, port['id'], 120)
+
+    def async_wait_ssh(self, vm):
+        yield self._watch(self.ssh_watcher, vm['fqdn'], 300)
+        result = yield aio.wait_for(
+            self.loop, lambda: self._check_ssh(vm),
+            'ssh', vm['fqdn'], timeout=60, delay=2,
+            retry_on=(subprocess.CalledProcessError,))
+        raise Return(result)
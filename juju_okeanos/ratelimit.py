@@ -0,0 +1,190 @@
+"""
+Process wide api rate limiting, shared by all runner workers.
+"""
+
+import logging
+import random
+import re
+import threading
+import time
+
+
+log = logging.getLogger("juju.okeanos")
+
+# Statuses the api uses to tell us to slow down. 413 is also how
+# cyclades reports exhausted quota, it only counts with a rate message.
+THROTTLE_STATUSES = (413, 429, 503)
+RATE_LIMITED = re.compile(r"\brate\b|too many requests|\bretry", re.I)
+RETRY_AFTER = re.compile(r"retry[ _-]?after\D{0,3}(\d+)", re.I)
+
+# Client calls safe to repeat, a create retried after the api accepted
+# it would make a second server, ip or port.
+IDEMPOTENT_PREFIXES = ('get_', 'list_', 'delete_')
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+
+
+def _error_text(e):
+    details = getattr(e, 'details', None) or []
+    if not isinstance(details, list):
+        details = [details]
+    return " ".join([str(e)] + map(str, details))
+
+
+def throttle_info(e):
+    """Return (status, retry after seconds) for an api error.
+
+    The Retry-After header is read from the response, kamaki errors
+    carry none so a retry after hint in their text is used instead.
+    """
+    response = getattr(e, 'response', None)
+    status = getattr(e, 'status', None) or getattr(
+        response, 'status_code', None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        status = None
+    retry_after = None
+    headers = getattr(response, 'headers', None) or {}
+    if headers.get('Retry-After', '').isdigit():
+        retry_after = int(headers['Retry-After'])
+    elif status in THROTTLE_STATUSES:
+        match = RETRY_AFTER.search(_error_text(e))
+        if match:
+            retry_after = int(match.group(1))
+    return status, retry_after
+
+
+def is_throttled(e, status):
+    if status == 413:
+        return bool(RATE_LIMITED.search(_error_text(e)))
+    return status in THROTTLE_STATUSES
+
+
+class RateLimiter(object):
+    """Token bucket request rate, with an AIMD concurrency limit.
+
+    Each throttled response halves the number of calls allowed in
+    flight and pauses all callers for its Retry-After (or an exponential
+    backoff), each successful call grows the limit back additively.
+    """
+
+    def __init__(self, rate=20.0, burst=20, max_concurrency=16,
+                 max_retries=8, base_delay=1.0, max_delay=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.limit):
+                    wait = 1.0
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                # Bounded, a condition wait without timeout can't be
+                # interrupted in python 2.
+                self.cond.wait(min(wait, 1.0))
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(
+                    self.max_concurrency, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def pause(self, seconds):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def call(self, func, *args, **kw):
+        """Call func when the limits allow it, retrying throttled calls.
+        """
+        return self._call(func, args, kw, self.max_retries)
+
+    def call_once(self, func, *args, **kw):
+        """Call func when the limits allow it, throttled calls raise.
+
+        For calls that aren't safe to repeat, a throttle still slows
+        down everyone else.
+        """
+        return self._call(func, args, kw, 0)
+
+    def _call(self, func, args, kw, max_retries):
+        attempt = 0
+        while True:
+            self.acquire()
+            throttled = False
+            try:
+                return func(*args, **kw)
+            except Exception, e:
+                status, retry_after = throttle_info(e)
+                if not is_throttled(e, status):
+                    raise
+                throttled = True
+                delay = retry_after or min(
+                    self.max_delay,
+                    self.base_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+                self.pause(delay)
+                if attempt >= max_retries:
+                    raise
+                log.debug("Api throttled (%s) on %s, retrying in %0.1fs",
+                          status, getattr(func, '__name__', func), delay)
+                attempt += 1
+            finally:
+                self.release(throttled)
+
+
+class RateLimitedClient(object):
+    """Proxy routing an api client's calls through a rate limiter.
+
+    wait_* methods poll for minutes, they aren't limited as a whole.
+    Only idempotent calls are retried when throttled.
+    """
+
+    def __init__(self, client, limiter):
+        self.__dict__['client'] = client
+        self.__dict__['limiter'] = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name.startswith(('_', 'wait_')):
+            return attr
+
+        if name.startswith(IDEMPOTENT_PREFIXES):
+            call = self.limiter.call
+        else:
+            call = self.limiter.call_once
+
+        def limited(*args, **kw):
+            return call(attr, *args, **kw)
+        limited.__name__ = name
+        return limited
+
+    def __setattr__(self, name, value):
+        setattr(self.client, name, value)
+
+
+limiter = RateLimiter()
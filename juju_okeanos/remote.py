@@ -0,0 +1,127 @@
+"""
+Ordered shell steps run on a machine in a single ssh session.
+"""
+
+from collections import namedtuple
+import logging
+import pipes
+import subprocess
+import time
+
+from juju_okeanos.exceptions import RemoteScriptError
+from juju_okeanos import ssh
+
+
+log = logging.getLogger("juju.okeanos")
+
+StepResult = namedtuple('StepResult', ['name', 'status', 'duration'])
+
+MARKER = "__juju_okeanos_step__"
+
+# Each step runs in a subshell with set -e, its exit status and duration
+# (ms) are echoed on a marker line, and a failing step ends the script.
+PREAMBLE = """set -e
+run_step() {
+    start=$(date +%%s%%N)
+    set +e
+    (set -e; eval "$2")
+    rc=$?
+    set -e
+    echo "%s $1 $rc $(( ($(date +%%s%%N) - start) / 1000000 ))"
+    return $rc
+}
+""" % MARKER
+
+
+class RemoteScript(object):
+    """An ordered list of named shell steps.
+
+    Steps should be idempotent, so a script can be rerun safely against a
+    machine that was already (partly) configured.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    def add(self, name, command):
+        self.steps.append((name, command))
+        return self
+
+    def render(self):
+        lines = [PREAMBLE]
+        for i, (name, command) in enumerate(self.steps):
+            lines.append("run_step %d %s" % (i, pipes.quote(command)))
+        return "\n".join(lines) + "\n"
+
+    def parse(self, output):
+        results = []
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) != 4 or parts[0] != MARKER:
+                continue
+            name = self.steps[int(parts[1])][0]
+            results.append(
+                StepResult(name, int(parts[2]), int(parts[3]) / 1000.0))
+        return results
+
+    def run(self, host, user="root"):
+        """Run all steps on host, returning a StepResult for each.
+
+        Raises RemoteScriptError, with the results so far, if a step fails.
+        """
+        t = time.time()
+        try:
+            output = ssh.run_script(host, self.render(), user=user)
+        except subprocess.CalledProcessError, e:
+            results = self.parse(e.output)
+            failed = [r for r in results if r.status]
+            step = failed and failed[0].name or "ssh"
+            log.error("%s failed at step %s on %s\n%s",
+                      self.name, step, host, e.output)
+            raise RemoteScriptError(
+                "%s failed at step %s on %s" % (self.name, step, host),
+                results)
+        results = self.parse(output)
+        log.debug("%s on %s in %0.2fs: %s", self.name, host, time.time() - t,
+                  ", ".join(["%s %0.2fs" % (r.name, r.duration)
+                             for r in results]))
+        return results
+
+
+def _write_file(path, lines, mode='644'):
+    """Step command (re)writing path with lines."""
+    return "printf '%%s\\n' %s > %s && chmod %s %s" % (
+        " ".join([pipes.quote(l) for l in lines]), path, mode, path)
+
+
+def nat_script(iface):
+    """Masquerade traffic leaving iface, persisted across reboots."""
+    rules = "/etc/iptables.juju-okeanos.rules"
+    script = RemoteScript("nat")
+    script.add("ip-forward", "sysctl -q -w net.ipv4.ip_forward=1")
+    script.add("ip-forward-persist", _write_file(
+        "/etc/sysctl.d/60-juju-okeanos.conf", ["net.ipv4.ip_forward=1"]))
+    script.add("flush", "iptables -F && iptables -t nat -F")
+    script.add("masquerade",
+               "iptables -t nat -A POSTROUTING -o %s -j MASQUERADE" % iface)
+    script.add("save", "iptables-save > %s" % rules)
+    script.add("persist", _write_file(
+        "/etc/network/if-pre-up.d/juju-okeanos-iptables",
+        ["#!/bin/sh", "iptables-restore < %s" % rules], mode='755'))
+    script.add("verify", "iptables -t nat -S POSTROUTING | grep -q MASQUERADE")
+    return script
+
+
+def gateway_script(gateway, iface):
+    """Route all traffic via gateway on iface, persisted across reboots."""
+    route = "ip route replace default via %s dev %s" % (gateway, iface)
+    script = RemoteScript("gateway")
+    script.add("route", route)
+    script.add("persist", _write_file(
+        "/etc/network/if-up.d/juju-okeanos-gateway",
+        ["#!/bin/sh", '[ "$IFACE" = "%s" ] || exit 0' % iface, route],
+        mode='755'))
+    script.add("verify",
+               "ip route show default | grep -q 'via %s '" % gateway)
+    return script
@@ -5,38 +5,107 @@ Thread based concurrency around bulk ops. do api is sync
 import logging
 from Queue import Queue, Empty
 import threading
+import time
+
+from juju_okeanos.exceptions import OpCancelled, TimeoutError
 
 
 log = logging.getLogger("juju.okeanos")
 
 
+class OpResult(object):
+    """Outcome of running an op, its return value or exception and timing.
+    """
+
+    def __init__(self, op):
+        self.op = op
+        self.value = None
+        self.exception = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def ok(self):
+        return self.exception is None and self.finished is not None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def __repr__(self):
+        return "<OpResult %s %s %0.2fs>" % (
+            self.op, self.ok and "ok" or self.exception, self.duration)
+
+
 class Runner(object):
+    """Run queued ops on a bounded set of worker threads.
+
+    An op's optional deadline attribute (or the runner timeout) bounds
+    how long its run may take, an op over its deadline is reported as
+    failed with a TimeoutError, its cancel method (if any) is called and
+    its worker is replaced so the rest of the queue still makes progress.
+    """
 
     DEFAULT_NUM_RUNNER = 4
 
-    def __init__(self):
+    # Max seconds to block on results, keeps the main thread responsive
+    # to signals (a plain Queue.get can't be interrupted).
+    poll_interval = 0.5
+
+    def __init__(self, num_runners=None, timeout=None):
+        self.num_runners = num_runners or self.DEFAULT_NUM_RUNNER
+        self.timeout = timeout
         self.jobs = Queue()
         self.results = Queue()
         self.job_count = 0
         self.runners = []
+        self.running = {}
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
         self.started = False
 
     def queue_op(self, op):
-        self.jobs.put(op)
-        self.job_count += 1
+        """Queue an op, also while results are being iterated.
+        """
+        with self.lock:
+            self.jobs.put(op)
+            self.job_count += 1
+            # Idle workers exit, replace them for ops queued late.
+            if self.started and not self.cancelled.is_set() and \
+                    len(self.runners) < self.num_runners:
+                self._add_runner()
 
     def iter_results(self):
+        """Yield the return values of successful ops as they complete.
+        """
+        for result in self.iter_outcomes():
+            if result.ok and not isinstance(result.value, Exception):
+                yield result.value
+
+    def iter_outcomes(self):
+        """Yield an OpResult for every queued op as it completes.
+        """
         auto = not self.started
 
         if auto:
-            self.start(min(self.DEFAULT_NUM_RUNNER, self.job_count))
-
-        for i in range(self.job_count):
-            self.job_count -= 1
-            result = self.gather_result()
-            if isinstance(result, Exception):
-                continue
-            yield result
+            self.start(min(self.num_runners, self.job_count))
+
+        try:
+            while self.job_count:
+                try:
+                    result = self.results.get(timeout=self._next_wait())
+                except Empty:
+                    for result in self._expire():
+                        self.job_count -= 1
+                        yield result
+                    continue
+                self.job_count -= 1
+                yield result
+        except (GeneratorExit, KeyboardInterrupt):
+            self.cancel()
+            raise
 
         if auto:
             self.stop()
@@ -45,37 +114,106 @@ class Runner(object):
         return self.results.get()
 
     def start(self, count):
+        self.cancelled.clear()
         for i in range(count):
-            runner = OpRunner(self.jobs, self.results)
-            runner.daemon = True
-            self.runners.append(runner)
-            runner.start()
+            self._add_runner()
         self.started = True
 
     def stop(self):
-        for runner in self.runners:
+        for runner in list(self.runners):
             runner.join()
+        self.runners = []
         self.started = False
 
+    def cancel(self):
+        """Stop starting queued ops, reporting them as cancelled.
+        """
+        self.cancelled.set()
+        while True:
+            try:
+                op = self.jobs.get(block=False)
+            except Empty:
+                break
+            result = OpResult(op)
+            result.exception = OpCancelled("Cancelled %s" % op)
+            self.results.put(result)
+
+    def _add_runner(self):
+        runner = OpRunner(self)
+        runner.daemon = True
+        self.runners.append(runner)
+        runner.start()
+
+    def _op_started(self, result, runner):
+        deadline = getattr(result.op, 'deadline', None) or self.timeout
+        with self.lock:
+            self.running[result] = (
+                deadline and result.started + deadline or None, runner)
+
+    def _op_finished(self, result, value, exception):
+        with self.lock:
+            if self.running.pop(result, None) is None:
+                # Expired op finishing late, already reported.
+                return
+        result.value = value
+        result.exception = exception
+        result.finished = time.time()
+        self.results.put(result)
+
+    def _next_wait(self):
+        now = time.time()
+        with self.lock:
+            deadlines = [d for d, _ in self.running.values() if d]
+        if not deadlines:
+            return self.poll_interval
+        return max(0, min(min(deadlines) - now, self.poll_interval))
+
+    def _expire(self):
+        now = time.time()
+        with self.lock:
+            expired = [(result, runner) for result, (deadline, runner)
+                       in self.running.items() if deadline and deadline <= now]
+            for result, runner in expired:
+                del self.running[result]
+                self.runners.remove(runner)
+                runner.abandoned = True
+        for result, runner in expired:
+            log.error("Op %s exceeded its deadline after %0.2fs",
+                      result.op, now - result.started)
+            result.exception = TimeoutError(
+                "%s did not complete before its deadline" % result.op)
+            result.finished = now
+            cancel = getattr(result.op, 'cancel', None)
+            if cancel is not None:
+                cancel()
+            if not self.cancelled.is_set() and not self.jobs.empty():
+                self._add_runner()
+            yield result
+
 
 class OpRunner(threading.Thread):
 
-    def __init__(self, ops, results):
-        self.ops = ops
-        self.results = results
+    def __init__(self, runner):
+        self.runner = runner
+        self.abandoned = False
         super(OpRunner, self).__init__()
 
     def run(self):
-        while 1:
+        while not self.abandoned and not self.runner.cancelled.is_set():
+            with self.runner.lock:
+                try:
+                    op = self.runner.jobs.get(block=False)
+                except Empty:
+                    if self in self.runner.runners:
+                        self.runner.runners.remove(self)
+                    return
+            result = OpResult(op)
+            result.started = time.time()
+            self.runner._op_started(result, self)
+            value = exception = None
             try:
-                op = self.ops.get(block=False)
-            except Empty:
-                op = None
-            if op is None:
-                return
-            try:
-                result = op.run()
+                value = op.run()
             except Exception, e:
                 log.exception("Error while processing op %s", op)
-                result = e
-            self.results.put(result)
+                exception = e
+            self.runner._op_finished(result, value, exception)
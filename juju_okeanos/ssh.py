@@ -1,5 +1,13 @@
+import errno
+import os
+import select
+import shutil
+import socket
 import subprocess
 import logging
+import tempfile
+import threading
+import time
 
 log = logging.getLogger('juju.docean')
 
@@ -11,23 +19,244 @@ SSH_CMD = ("/usr/bin/ssh",
            "-o", "UserKnownHostsFile=/dev/null")
 
 
-def check_ssh(host, user="root"):
-    cmd = list(SSH_CMD) + ["%s@%s" % (user, host), "ls"]
-    process = subprocess.Popen(
-        args=cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+class SessionManager(object):
+    """Multiplexed ssh, one ControlMaster connection per host.
+
+    The first command to a host opens a master connection, later ones
+    reuse its socket and skip the tcp handshake, key exchange and auth.
+    """
+
+    # Seconds an idle master connection is kept open.
+    persist = 300
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.control_dir = None
+
+    def command(self, host, user="root"):
+        """Return the ssh command line for a multiplexed session to host.
+        """
+        with self.lock:
+            if self.control_dir is None:
+                self.control_dir = tempfile.mkdtemp(prefix="juju-okeanos-")
+        return list(SSH_CMD) + [
+            "-o", "ControlPath=%s" % os.path.join(
+                self.control_dir, "%r@%h:%p"),
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPersist=%d" % self.persist,
+            "%s@%s" % (user, host)]
+
+    def close(self):
+        """Stop all master connections and remove their sockets.
+        """
+        with self.lock:
+            control_dir, self.control_dir = self.control_dir, None
+        if control_dir is None:
+            return
+        with open(os.devnull, 'w') as devnull:
+            for socket_name in os.listdir(control_dir):
+                target = socket_name.rsplit(":", 1)[0]
+                subprocess.call(
+                    list(SSH_CMD) + [
+                        "-o", "ControlPath=%s" % os.path.join(
+                            control_dir, socket_name),
+                        "-O", "exit", target],
+                    stdout=devnull, stderr=devnull)
+        shutil.rmtree(control_dir, ignore_errors=True)
+
+
+sessions = SessionManager()
+
+# ssh errors that retrying won't fix.
+FATAL_ERRORS = (
+    "Permission denied",
+    "No route to host",
+    "Host key verification failed",
+    "Could not resolve hostname")
+
+
+def fatal_error(output):
+    """Return the fatal error in ssh output, if any."""
+    for error in FATAL_ERRORS:
+        if error in (output or ''):
+            return error
+
+
+def resolve(host, port=22, addresses=None):
+    """Return (family, sockaddr) for host, from addresses if cached there.
+
+    Resolution is blocking, pass the same addresses dict across probe
+    rounds so each host is looked up once.
+    """
+    if addresses is not None and host in addresses:
+        return addresses[host]
+    family, _, _, _, address = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM)[0]
+    if addresses is not None:
+        addresses[host] = (family, address)
+    return family, address
+
+
+class Poller(object):
+    """Readiness of sockets, connecting (write) or reading.
+
+    Uses epoll where available, select is limited to FD_SETSIZE
+    descriptors.
+    """
 
-    output, err = process.communicate()
-    retcode = process.poll()
+    def __init__(self):
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self.socks = {}
+        self.writing = set()
 
-    if retcode:
-        raise subprocess.CalledProcessError(retcode, cmd, output + (err or ''))
+    def register(self, sock, write=False):
+        self.socks[sock.fileno()] = sock
+        if write:
+            self.writing.add(sock.fileno())
+        if self.epoll is not None:
+            self.epoll.register(sock.fileno(), self._mask(write))
+
+    def modify(self, sock, write=False):
+        if write:
+            self.writing.add(sock.fileno())
+        else:
+            self.writing.discard(sock.fileno())
+        if self.epoll is not None:
+            self.epoll.modify(sock.fileno(), self._mask(write))
+
+    def unregister(self, sock):
+        fd = sock.fileno()
+        self.socks.pop(fd, None)
+        self.writing.discard(fd)
+        if self.epoll is not None:
+            self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """Return (readable, writable) sockets, waiting up to timeout."""
+        if self.epoll is not None:
+            events = self.epoll.poll(timeout)
+            readable = [self.socks[fd] for fd, _ in events
+                        if fd not in self.writing]
+            writable = [self.socks[fd] for fd, _ in events
+                        if fd in self.writing]
+            return readable, writable
+        reading = [sock for fd, sock in self.socks.items()
+                   if fd not in self.writing]
+        writing = [self.socks[fd] for fd in self.writing]
+        readable, writable, _ = select.select(
+            reading, writing, [], timeout)
+        return readable, writable
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+    @staticmethod
+    def _mask(write):
+        # Errors and hangups are always reported, they show up as a
+        # failed connect or an empty read.
+        return select.EPOLLOUT if write else select.EPOLLIN
+
+
+def probe_banners(hosts, port=22, timeout=1.0, addresses=None):
+    """Return {host: ssh banner or None} for hosts, probed at once.
+
+    Connects are non blocking and multiplexed on one poller, so probing
+    many hosts costs one round of sockets instead of an ssh process
+    each. Hosts refusing, unreachable or not sending an SSH- banner
+    within timeout map to None. Name resolution is blocking, callers
+    probing repeatedly pass an addresses dict to cache it in.
+    """
+    results = dict.fromkeys(hosts)
+    connecting, reading, buffers = {}, {}, {}
+    poller = Poller()
+    try:
+        for host in hosts:
+            try:
+                family, address = resolve(host, port, addresses)
+            except socket.error, e:
+                log.debug("Probe of %s failed: %s", host, e)
+                continue
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                continue
+            connecting[sock] = host
+            poller.register(sock, write=True)
+
+        deadline = time.time() + timeout
+        while connecting or reading:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, writable = poller.poll(remaining)
+            for sock in writable:
+                host = connecting.pop(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    poller.unregister(sock)
+                    sock.close()
+                else:
+                    reading[sock] = host
+                    buffers[sock] = ''
+                    poller.modify(sock)
+            for sock in readable:
+                try:
+                    data = sock.recv(256)
+                except socket.error:
+                    data = ''
+                buffers[sock] += data
+                if data and '\n' not in buffers[sock]:
+                    continue
+                host = reading.pop(sock)
+                poller.unregister(sock)
+                sock.close()
+                banner = buffers.pop(sock).split('\n')[0].strip()
+                if banner.startswith('SSH-'):
+                    results[host] = banner
+    finally:
+        poller.close()
+        for sock in connecting.keys() + reading.keys():
+            sock.close()
+    return results
+
+
+def check_output(cmd, input=None, **kw):
+    """Run an ssh command, return its stdout and stderr output.
+
+    stderr goes to a temporary file rather than a pipe. The first
+    command to a host forks its ControlMaster, which keeps stderr open
+    until it idles out, reading a pipe to eof would wait for that.
+    Raises CalledProcessError on a non zero exit.
+    """
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(
+            args=cmd, stdin=input is not None and subprocess.PIPE or None,
+            stdout=subprocess.PIPE, stderr=errors, **kw)
+        output, _ = process.communicate(input)
+        errors.seek(0)
+        output += errors.read()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output)
+    return output
+
+
+def check_ssh(host, user="root"):
+    check_output(sessions.command(host, user) + ["ls"])
     return True
 
 
+def run_script(host, script, user="root"):
+    """Run a shell script on the host, piped over a single ssh session.
+    """
+    return check_output(
+        sessions.command(host, user) + ["bash", "-s"], input=script)
+
+
 def update_instance(host, user="root"):
-    base = list(SSH_CMD) + ["%s@%s" % (user, host)]
-    subprocess.check_output(
-        base + ["apt-get", "update"], stderr=subprocess.STDOUT)
+    base = sessions.command(host, user)
+    check_output(base + ["apt-get", "update"])
 # Don't really need to update the image, just the package lists.
 #    subprocess.check_output(base + [
 #        'DEBIAN_FRONTEND=noninteractive',
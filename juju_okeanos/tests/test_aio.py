@@ -0,0 +1,286 @@
+import BaseHTTPServer
+import json
+import mock
+import SocketServer
+import threading
+import time
+
+from kamaki.clients.cyclades import CycladesComputeClient
+
+from juju_okeanos import aio, wait
+from juju_okeanos.aio import EventLoop, Return
+from juju_okeanos.exceptions import TimeoutError
+from juju_okeanos.provider import AsyncOkeanos, Okeanos
+from juju_okeanos.ratelimit import RateLimiter
+from juju_okeanos.runner import Runner
+from juju_okeanos.tests.base import Base
+from juju_okeanos.tests.test_provider import ProviderBase
+
+
+class EventLoopTest(Base):
+
+    def setUp(self):
+        self.loop = EventLoop(2)
+        self.addCleanup(self.loop.close)
+
+    def test_sleep_order(self):
+        order = []
+
+        def sleeper(delay):
+            yield self.loop.sleep(delay)
+            order.append(delay)
+            raise Return(delay * 2)
+
+        t = time.time()
+        results = self.loop.run_until_complete(self.loop.gather(
+            [sleeper(0.2), sleeper(0.1), sleeper(0.15)]))
+        self.assertEqual(results, [0.4, 0.2, 0.3])
+        self.assertEqual(order, [0.1, 0.15, 0.2])
+        self.assertLess(time.time() - t, 0.4)
+
+    def test_nested_coroutine_and_errors(self):
+        def inner():
+            yield self.loop.sleep(0)
+            raise ValueError("inner")
+
+        def outer():
+            try:
+                yield inner()
+            except ValueError, e:
+                raise Return("caught %s" % e)
+
+        self.assertEqual(
+            self.loop.run_until_complete(outer()), "caught inner")
+        self.assertRaises(
+            ValueError, self.loop.run_until_complete, inner())
+
+    def test_run_in_executor(self):
+        main = threading.current_thread()
+
+        def blocking(value):
+            time.sleep(0.1)
+            return value, threading.current_thread() is main
+
+        futures = [self.loop.run_in_executor(blocking, i) for i in range(4)]
+        t = time.time()
+        results = self.loop.run_until_complete(self.loop.gather(futures))
+        self.assertEqual(results, [(i, False) for i in range(4)])
+        # Two executor threads, two rounds.
+        self.assertLess(time.time() - t, 0.35)
+
+    def test_gather_return_exceptions(self):
+        def fail():
+            yield self.loop.sleep(0)
+            raise ValueError("bad")
+
+        def ok():
+            yield self.loop.sleep(0.01)
+            raise Return(1)
+
+        results = self.loop.run_until_complete(
+            self.loop.gather([fail(), ok()], return_exceptions=True))
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual(results[1], 1)
+        self.assertRaises(
+            ValueError, self.loop.run_until_complete,
+            self.loop.gather([fail(), ok()]))
+
+
+class WaitForTest(Base):
+
+    def setUp(self):
+        self.loop = EventLoop(1)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(wait.stats.reset)
+
+    def test_wait_for_retry(self):
+        check = mock.Mock(side_effect=[OSError("refused"), None, 'ACTIVE'])
+        self.assertEqual(self.loop.run_until_complete(aio.wait_for(
+            self.loop, check, 'ssh', delay=0.01, retry_on=(OSError,))),
+            'ACTIVE')
+        self.assertEqual(wait.stats.timings['ssh'][3], 3)
+
+    def test_wait_for_timeout(self):
+        self.assertRaises(
+            TimeoutError, self.loop.run_until_complete, aio.wait_for(
+                self.loop, lambda: None, 'port', timeout=0.1, delay=0.02))
+
+
+class FakeCyclades(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Just enough of the compute api, servers build for build_time.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = body is not None and json.dumps(body) or ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def server_info(self, server_id):
+        info = dict(self.server.servers[server_id])
+        release_at = self.server.release_at
+        if time.time() - info.pop('created') >= self.server.build_time or \
+                release_at and len(self.server.servers) >= release_at:
+            info['status'] = 'ACTIVE'
+        return info
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts[-2] == 'images':
+            self.reply(200, {'image': {'id': parts[-1], 'metadata': {}}})
+        elif parts[-2:] == ['servers', 'detail']:
+            self.reply(200, {'servers': [
+                self.server_info(i) for i in sorted(self.server.servers)]})
+        elif parts[-2] == 'servers' and parts[-1] in self.server.servers:
+            self.reply(200, {'server': self.server_info(parts[-1])})
+        else:
+            self.reply(404, {'itemNotFound': {'message': self.path}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))['server']
+        with self.server.lock:
+            server_id = str(len(self.server.servers) + 1)
+            self.server.servers[server_id] = dict(
+                id=server_id, name=body['name'], status='BUILD',
+                created=time.time())
+        self.reply(202, {'server': self.server_info(server_id)})
+
+    def do_DELETE(self):
+        self.server.servers.pop(self.path.strip('/').split('/')[-1])
+        self.reply(204)
+
+
+class FakeCycladesServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, build_time):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), FakeCyclades)
+        self.build_time = build_time
+        # Servers also turn active once this many were created.
+        self.release_at = None
+        self.servers = {}
+        self.lock = threading.Lock()
+
+
+def create_server_op(provider, name):
+    srv = yield provider._call(
+        provider.get_compute_client, 'create_server', name, 1, 'img')
+    status = yield provider.async_wait_server_active(srv)
+    raise Return(status)
+
+
+class CreateServerOp(object):
+    """The same create and wait, blocking a runner worker throughout."""
+
+    def __init__(self, provider, name):
+        self.provider = provider
+        self.name = name
+
+    def run(self):
+        srv = self.provider.get_compute_client().create_server(
+            self.name, 1, 'img')
+        return self.provider.wait_server_active(srv)
+
+
+class AsyncProviderBase(ProviderBase):
+
+    build_time = 0.2
+
+    def setUp(self):
+        super(AsyncProviderBase, self).setUp()
+        self.server = FakeCycladesServer(self.build_time)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(wait.stats.reset)
+        url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.astakos.return_value.get_endpoint_url.side_effect = (
+            lambda service: '%s/%s/v2.0' % (url, service))
+        # The shared limiter would pace both backends alike.
+        mock.patch('juju_okeanos.provider.limiter', RateLimiter(
+            rate=10000, burst=10000, max_concurrency=256)).start()
+
+    def get_provider(self, **kw):
+        provider = AsyncOkeanos(self.kamaki_config, **kw)
+        provider.server_watcher.interval = 0.05
+        self.addCleanup(provider.close)
+        return provider
+
+
+class AsyncOkeanosTest(AsyncProviderBase):
+
+    def test_create_list_terminate(self):
+        provider = self.get_provider(pool_size=2)
+        statuses = provider.run_all(
+            [create_server_op(provider, 'env-%d' % i)
+             for i in range(3)])
+        self.assertEqual(statuses, ['ACTIVE'] * 3)
+        servers = provider.run(
+            provider.async_get_instances(all_servers=True))
+        self.assertEqual(
+            sorted([s.name for s in servers]), ['env-0', 'env-1', 'env-2'])
+        provider.run_all([provider.async_terminate_instance(s.id)
+                          for s in servers[:2]])
+        self.assertEqual(self.server.servers.keys(), [servers[2].id])
+
+
+class AsyncOkeanosScaleTest(AsyncProviderBase):
+
+    count = 64
+    workers = 8
+
+    def setUp(self):
+        super(AsyncOkeanosScaleTest, self).setUp()
+        # Nothing builds until every create is in, so each backend must
+        # have all of them in flight at once to finish.
+        self.server.build_time = 60
+        self.server.release_at = self.count
+        self.create_threads = set()
+        create_server = CycladesComputeClient.create_server
+
+        def record_thread(client, *args, **kw):
+            self.create_threads.add(threading.current_thread())
+            return create_server(client, *args, **kw)
+        mock.patch.object(
+            CycladesComputeClient, 'create_server', record_thread).start()
+
+    def test_creates_share_threads(self):
+        provider = self.get_provider(pool_size=self.workers)
+        threads = threading.active_count()
+        results = provider.run_all(
+            [create_server_op(provider, 'aio-%d' % i)
+             for i in range(self.count)])
+        self.assertEqual(results, ['ACTIVE'] * self.count)
+        self.assertEqual(len(self.server.servers), self.count)
+        # The executor and the server watcher, plus the stand-in's
+        # thread per keep-alive connection, not a thread per create.
+        self.assertLessEqual(len(provider.loop._workers), self.workers)
+        self.assertLessEqual(
+            threading.active_count() - threads, 2 * self.workers + 1)
+        self.assertLessEqual(len(self.create_threads), self.workers)
+        self.assertEqual(
+            wait.stats.timings['server-active'][0], self.count)
+
+    def test_runner_needs_thread_per_create(self):
+        provider = Okeanos(self.kamaki_config, pool_size=self.workers)
+        provider.server_watcher.interval = 0.05
+        runner = Runner(self.count)
+        for i in range(self.count):
+            runner.queue_op(CreateServerOp(provider, 'thread-%d' % i))
+        results = list(runner.iter_results())
+        self.assertEqual(results, ['ACTIVE'] * self.count)
+        # The same creates on the event loop use at most self.workers.
+        self.assertEqual(len(self.create_threads), self.count)
+        self.assertEqual(
+            wait.stats.timings['server-active'][0], self.count)
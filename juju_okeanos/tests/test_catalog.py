@@ -0,0 +1,60 @@
+import json
+import mock
+import os
+import time
+
+from juju_okeanos.catalog import Catalog
+from juju_okeanos.tests.base import Base
+
+
+class CatalogTest(Base):
+
+    def setUp(self):
+        self.path = os.path.join(self.mkdir(), 'cache', 'catalog.json')
+
+    def test_get_persists(self):
+        flavors = [{'id': 1, 'ram': 2048}]
+        fetch = mock.Mock(return_value=flavors)
+        catalog = Catalog(self.path)
+        self.assertEqual(catalog.get('flavors', fetch), flavors)
+        self.assertEqual(catalog.get('flavors', fetch), flavors)
+        self.assertEqual(fetch.call_count, 1)
+
+        # A new process reads the file instead of fetching.
+        self.assertEqual(Catalog(self.path).get('flavors', fetch), flavors)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         ['catalog.json'])
+
+    def test_get_ttl_expired(self):
+        catalog = Catalog(self.path, ttls={'images': 60})
+        catalog.get('images', lambda: ['old'])
+        with open(self.path) as fh:
+            data = json.load(fh)
+        data['images']['updated'] = time.time() - 120
+        with open(self.path, 'w') as fh:
+            json.dump(data, fh)
+        self.assertEqual(
+            Catalog(self.path, ttls={'images': 60}).get(
+                'images', lambda: ['new']), ['new'])
+
+    def test_refresh(self):
+        Catalog(self.path).get('projects', lambda: ['old'])
+        fetch = mock.Mock(return_value=['new'])
+        catalog = Catalog(self.path, refresh=True)
+        self.assertEqual(catalog.get('projects', fetch), ['new'])
+        self.assertEqual(catalog.get('projects', fetch), ['new'])
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as fh:
+            fh.write('{"flav')
+        self.assertEqual(
+            Catalog(self.path).get('flavors', lambda: [1]), [1])
+
+    def test_memory_only(self):
+        catalog = Catalog()
+        catalog.get('flavors', lambda: [1])
+        self.assertEqual(catalog.get('flavors', lambda: [2]), [1])
+        self.assertFalse(os.path.exists(self.path))
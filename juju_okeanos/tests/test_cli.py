@@ -0,0 +1,87 @@
+import json
+import subprocess
+import sys
+
+from juju_okeanos import cli
+from juju_okeanos.tests.base import Base
+
+
+# Times every first import, like python 3's -X importtime (cumulative),
+# then runs the cli with the given arguments.
+STARTUP_SCRIPT = r"""
+import __builtin__, json, sys, time
+
+imports = {}
+_import = __builtin__.__import__
+
+
+def timed_import(name, *args, **kw):
+    new = name not in sys.modules
+    t = time.time()
+    try:
+        return _import(name, *args, **kw)
+    finally:
+        if new and sys.modules.get(name) is not None:
+            imports[name] = time.time() - t
+
+__builtin__.__import__ = timed_import
+sys.argv = ['juju-okeanos'] + sys.argv[1:]
+start = time.time()
+try:
+    from juju_okeanos import cli
+    cli.main()
+except SystemExit:
+    pass
+sys.stderr.write("\n" + json.dumps(dict(
+    elapsed=time.time() - start, imports=imports,
+    modules=[m for m in sys.modules if sys.modules[m] is not None])))
+"""
+
+# Packages only commands need.
+HEAVY_MODULES = (
+    'kamaki', 'jujuclient', 'requests', 'yaml', 'juju_okeanos.commands',
+    'juju_okeanos.provider', 'juju_okeanos.env', 'juju_okeanos.client')
+
+
+class StartupTest(Base):
+
+    # Seconds from importing the cli to exiting, interpreter start aside.
+    budget = 0.25
+
+    def startup(self, *args):
+        process = subprocess.Popen(
+            [sys.executable, '-c', STARTUP_SCRIPT] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        return output, json.loads(errors.strip().splitlines()[-1])
+
+    def assertFastStartup(self, result):
+        breakdown = "\n".join([
+            "%8.1fms %s" % (t * 1000, name) for t, name in sorted(
+                [(t, n) for n, t in result['imports'].items()],
+                reverse=True)[:15]])
+        heavy = sorted([m for m in result['modules']
+                        if m.startswith(HEAVY_MODULES)])
+        self.assertEqual(
+            heavy, [], "Heavy modules imported:\n%s\n%s" % (
+                " ".join(heavy), breakdown))
+        self.assertLess(
+            result['elapsed'], self.budget,
+            "Startup took %0.3fs:\n%s" % (result['elapsed'], breakdown))
+
+    def test_description(self):
+        output, result = self.startup('--description')
+        self.assertEqual(output.strip(), cli.PLUGIN_DESCRIPTION)
+        self.assertFastStartup(result)
+
+    def test_help(self):
+        output, result = self.startup('--help')
+        self.assertIn('list-machines', output)
+        self.assertFastStartup(result)
+
+    def test_command_resolved_lazily(self):
+        parser = cli.setup_parser()
+        options = parser.parse_args(['list-machines', '-e', 'env'])
+        self.assertEqual(options.command, 'ListMachines')
+        self.assertEqual(
+            cli.get_command(options.command).__name__, 'ListMachines')
@@ -0,0 +1,146 @@
+import mock
+import sys
+import threading
+
+from requests import Response
+
+from juju_okeanos.client import Client, Client_v2, Droplet
+from juju_okeanos.exceptions import ProviderAPIError
+from juju_okeanos.ratelimit import RateLimiter
+from juju_okeanos.tests.base import Base
+
+
+def json_response(data, status=200):
+    r = Response()
+    r.status_code = status
+    r._content = __import__('json').dumps(data)
+    return r
+
+
+class ClientSessionTest(Base):
+
+    def test_connect_pool_size(self):
+        client = Client.connect({'DO_OAUTH_TOKEN': 'abc'}, pool_size=12)
+        self.assertIsInstance(client, Client_v2)
+        self.assertEqual(client.adapter._pool_maxsize, 12)
+
+    def test_session_per_thread_shared_pool(self):
+        client = Client_v2('abc')
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(client.session))
+        thread.start()
+        thread.join()
+        self.assertIs(client.session, client.session)
+        self.assertIsNot(client.session, sessions[0])
+        self.assertIs(
+            client.session.get_adapter('https://api.digitalocean.com'),
+            sessions[0].get_adapter('https://api.digitalocean.com'))
+        self.assertIn('gzip', client.session.headers['Accept-Encoding'])
+
+    def test_request_uses_session(self):
+        client = Client_v2('abc')
+        with mock.patch.object(
+                client.session, 'request',
+                return_value=json_response({'droplets': []})) as request:
+            self.assertEqual(client.get_droplets(), [])
+        args, kw = request.call_args
+        self.assertEqual(args, ('GET', 'https://api.digitalocean.com/v2/droplets'))
+        self.assertEqual(kw['timeout'], Client.timeout)
+        self.assertEqual(kw['headers']['Authorization'], 'Bearer abc')
+
+    def test_only_idempotent_requests_retried(self):
+        client = Client_v2('abc')
+        throttled = json_response({'id': 'service_unavailable'}, 503)
+        with mock.patch('juju_okeanos.client.limiter',
+                        RateLimiter(base_delay=0.01)), \
+                mock.patch.object(
+                    client.session, 'request',
+                    side_effect=[throttled, json_response({'droplets': []}),
+                                 throttled]) as request:
+            self.assertEqual(client.get_droplets(), [])
+            self.assertEqual(request.call_count, 2)
+            self.assertRaises(
+                ProviderAPIError, client.request, '/droplets', 'POST',
+                data={'name': 'env-1'})
+        self.assertEqual(request.call_count, 3)
+
+
+def droplet(i):
+    return {'id': i, 'name': 'env-%d' % i, 'status': 'active',
+            'size_slug': '512mb', 'created_at': '2014-01-01T00:00:00Z',
+            'networks': {}, 'region': {'slug': 'nyc2'}, 'image': {'id': 1}}
+
+
+class PaginationTest(Base):
+
+    def setUp(self):
+        self.client = Client_v2('abc')
+        base = 'https://api.digitalocean.com/v2/droplets?page=%d&per_page=2'
+        self.pages = [
+            {'droplets': [droplet(1), droplet(2)],
+             'links': {'pages': {'next': base % 2}}},
+            {'droplets': [droplet(3), droplet(4)],
+             'links': {'pages': {'next': base % 3, 'prev': base % 1}}},
+            {'droplets': [droplet(5)],
+             'links': {'pages': {'prev': base % 2}}}]
+        self.request = mock.patch.object(
+            self.client, 'request', side_effect=self.pages).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_iter_droplets_lazy(self):
+        droplets = self.client.iter_droplets()
+        self.assertEqual(droplets.next().id, 1)
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(droplets.next().id, 2)
+        self.assertEqual(droplets.next().id, 3)
+        self.assertEqual(self.request.call_count, 2)
+
+    def test_get_droplets_follows_next(self):
+        self.assertEqual(
+            [d.id for d in self.client.get_droplets()], [1, 2, 3, 4, 5])
+        calls = self.request.call_args_list
+        self.assertEqual(calls[0], mock.call(
+            '/droplets', params={'per_page': Client_v2.page_size}))
+        self.assertEqual(calls[2], mock.call(
+            'https://api.digitalocean.com/v2/droplets?page=3&per_page=2',
+            params=None))
+
+
+class EntityTest(Base):
+
+    def test_parse_v2_droplet(self):
+        info = droplet(7)
+        info['networks'] = {'v4': [
+            {'type': 'private', 'ip_address': '10.0.0.7'},
+            {'type': 'public', 'ip_address': '1.2.3.7'}]}
+        d = Client_v2('abc').make_droplet(info)
+        self.assertEqual(d.to_json(), {
+            'id': 7, 'name': 'env-7', 'status': 'active', 'size_id': '512mb',
+            'created_at': '2014-01-01T00:00:00Z', 'ip_address': '1.2.3.7',
+            'region_id': 'nyc2', 'image_id': 1, 'event_id': None,
+            'machine_id': None})
+        self.assertFalse(hasattr(d, '__dict__'))
+
+    def test_from_dict(self):
+        d = Droplet.from_dict({'id': 1, 'name': 'x', 'bogus': True})
+        self.assertEqual((d.id, d.name, d.ip_address), (1, 'x', None))
+        self.assertEqual(d, Droplet(id=1, name='x'))
+        self.assertRaises(TypeError, Droplet, id=1, bogus=True)
+        self.assertRaises(AttributeError, setattr, d, 'bogus', True)
+
+
+class EntityFootprintTest(Base):
+
+    def test_materialize_droplets(self):
+        client = Client_v2('abc')
+        droplets = [client.make_droplet(droplet(i)) for i in range(1000)]
+        self.assertEqual([d.id for d in droplets], range(1000))
+        self.assertEqual(droplets[999].to_json()['name'], 'env-999')
+        self.assertEqual(
+            Droplet.from_dict(droplets[5].to_json()), droplets[5])
+        # Fixed size records, no per instance dict of fields.
+        sizes = set(map(sys.getsizeof, droplets))
+        self.assertEqual(len(sizes), 1)
+        self.assertFalse(any(hasattr(d, '__dict__') for d in droplets))
+        self.assertLess(sizes.pop(), sys.getsizeof(droplets[0].to_json()))
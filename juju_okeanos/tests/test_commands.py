@@ -49,6 +49,7 @@ class CommandBase(Base):
                             'bootstrap-host': None}}}
             f.write(yaml.safe_dump(conf))
             f.flush()
+            self.config.get_env_data.return_value = conf
             self.addCleanup(lambda: os.remove(f.name))
 
     def capture_logging(self, name="", level=logging.INFO, log_file=None):
@@ -275,9 +276,7 @@ class DestroyEnvironmentTest(CommandBase):
         self.assertEqual(
             self.provider.terminate_instance.call_args_list,
             [mock.call(258), mock.call(221)])
-        self.assertEqual(
-            self.env.terminate_machines.call_args_list,
-            [mock.call(['1']), mock.call(['2'])])
+        self.env.terminate_machines.assert_called_once_with(['1', '2'])
 
 if __name__ == '__main__':
     unittest.main()
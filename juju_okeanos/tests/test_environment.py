@@ -21,6 +21,8 @@ class EnvironmentTest(Base):
         self.config.juju_home = juju_home = self.mkdir()
         self.config.get_env_conf.return_value = os.path.join(
             juju_home, "environments.yaml")
+        self.config.get_env_data.side_effect = lambda: yaml.safe_load(
+            open(os.path.join(juju_home, "environments.yaml")))
         # Setup juju home structure
         os.mkdir(os.path.join(juju_home, "environments"))
         os.mkdir(os.path.join(juju_home, "ssh"))
@@ -0,0 +1,109 @@
+import mock
+import subprocess
+
+from juju_okeanos.env import Environment
+from juju_okeanos.tests.base import Base
+
+
+class RegisterMachinesTest(Base):
+
+    def setUp(self):
+        self.config = mock.MagicMock()
+        self.config.series = 'trusty'
+        self.config.parallel = 2
+        self.client = mock.MagicMock()
+        self.client.register_machines.side_effect = lambda params: {
+            'Machines': [{'Machine': str(i + 1), 'Error': None}
+                         for i in range(len(params))]}
+        self.client.provisioning_script.side_effect = (
+            lambda machine_id, nonce: {'Script': 'echo %s' % machine_id})
+        self.env = Environment(self.config)
+        self.env.connect = mock.Mock(return_value=self.client)
+
+    @mock.patch('juju_okeanos.env.ssh')
+    def test_add_machines_single_login(self, mock_ssh):
+        # Create the child mock up front, workers racing to create it
+        # would each record calls on their own.
+        mock_ssh.run_script.return_value = ""
+        machine_ids = self.env.add_machines([
+            ('10.0.0.1', {'Mem': 2048}), ('10.0.0.2', None),
+            ('10.0.0.3', None)])
+        self.assertEqual(machine_ids, {
+            '10.0.0.1': '1', '10.0.0.2': '2', '10.0.0.3': '3'})
+        self.env.connect.assert_called_once_with()
+        self.assertEqual(self.client.register_machines.call_count, 1)
+        params = self.client.register_machines.call_args[0][0]
+        self.assertEqual(
+            [p['InstanceId'] for p in params],
+            ['manual:10.0.0.1', 'manual:10.0.0.2', 'manual:10.0.0.3'])
+        self.assertEqual(params[0]['HardwareCharacteristics'], {'Mem': 2048})
+        self.assertEqual(params[0]['Series'], 'trusty')
+        self.assertEqual(
+            sorted(mock_ssh.run_script.call_args_list),
+            [mock.call('10.0.0.1', 'echo 1'), mock.call('10.0.0.2', 'echo 2'),
+             mock.call('10.0.0.3', 'echo 3')])
+        self.env.close()
+        self.client.close.assert_called_once_with()
+
+    @mock.patch('juju_okeanos.env.ssh')
+    def test_add_machines_shares_connection(self, mock_ssh):
+        mock_ssh.run_script.return_value = ""
+        self.assertEqual(self.env.add_machines([('10.0.0.1', None)]),
+                         {'10.0.0.1': '1'})
+        self.assertEqual(self.env.add_machines([('10.0.0.2', None)]),
+                         {'10.0.0.2': '1'})
+        self.env.connect.assert_called_once_with()
+
+    @mock.patch('juju_okeanos.env.ssh')
+    def test_provision_failure_removes_machine(self, mock_ssh):
+        mock_ssh.run_script.side_effect = subprocess.CalledProcessError(
+            1, ['ssh'], 'no tools')
+        self.env.terminate_machines = mock.Mock()
+        self.assertEqual(self.env.add_machines([('10.0.0.1', None)]), {})
+        self.env.terminate_machines.assert_called_once_with(['1'])
+
+
+class StatusTest(Base):
+
+    def setUp(self):
+        self.config = mock.MagicMock()
+        self.config.get_env_name.return_value = 'okeanos'
+        self.client = mock.MagicMock()
+        self.client.status.return_value = {
+            'Machines': {
+                '0': {'InstanceId': 'manual:', 'DNSName': '10.0.1.2',
+                      'Series': 'trusty', 'Containers': {}},
+                '1': {'InstanceId': 'manual:10.0.1.3',
+                      'DNSName': '10.0.1.3'}},
+            'Services': {'mysql': {}}}
+        self.env = Environment(self.config)
+        self.env.connect = mock.Mock(return_value=self.client)
+
+    def test_status_api(self):
+        self.assertEqual(self.env.status(), {'machines': {
+            '0': {'instance-id': 'manual:', 'dns-name': '10.0.1.2'},
+            '1': {'instance-id': 'manual:10.0.1.3',
+                  'dns-name': '10.0.1.3'}}})
+
+    @mock.patch('subprocess.check_output')
+    def test_status_cached(self, check_output):
+        self.env.status()
+        self.env.status()
+        self.assertEqual(self.client.status.call_count, 1)
+        self.env.terminate_machines(['1'])
+        self.env.status()
+        self.assertEqual(self.client.status.call_count, 2)
+        self.env.status(refresh=True)
+        self.assertEqual(self.client.status.call_count, 3)
+
+    @mock.patch('subprocess.check_output')
+    def test_status_cli_fallback(self, check_output):
+        self.env.connect.side_effect = IOError("connection refused")
+        check_output.return_value = (
+            "environment: okeanos\n"
+            "machines:\n  '0':\n    dns-name: 10.0.1.2\n"
+            "    instance-id: 'manual:'\n    agent-state: started\n"
+            "    series: trusty\n"
+            "services:\n  mysql:\n    charm: cs:trusty/mysql-1\n")
+        self.assertEqual(self.env.status(), {'machines': {
+            '0': {'instance-id': 'manual:', 'dns-name': '10.0.1.2'}}})
@@ -0,0 +1,88 @@
+import random
+
+from juju_okeanos.constraints import (
+    FlavorIndex, parse_constraints, solve_flavor)
+from juju_okeanos.exceptions import ConstraintError
+from juju_okeanos.tests.base import Base
+
+
+def make_flavors(cpus, rams, disks):
+    flavors = []
+    for c in cpus:
+        for r in rams:
+            for d in disks:
+                flavors.append({
+                    'id': len(flavors) + 1,
+                    'name': 'C%dR%dD%d' % (c, r, d),
+                    'vcpus': c, 'ram': r, 'disk': d})
+    random.shuffle(flavors)
+    return flavors
+
+
+def linear_solve(flavors, cpus, memory, disk):
+    matches = [f for f in flavors if f['vcpus'] >= cpus and
+               f['ram'] >= memory and f['disk'] >= disk]
+    if matches:
+        return min(matches, key=lambda f: (f['vcpus'], f['ram'], f['disk']))
+
+
+class FlavorIndexTest(Base):
+
+    def setUp(self):
+        self.flavors = make_flavors(
+            [1, 2, 4, 8], [512, 1024, 2048, 4096, 8192], [5, 10, 20, 40])
+        # Sparse corner, big disk only on small ram.
+        self.flavors.append(
+            {'id': 1000, 'name': 'C16R1024D500',
+             'vcpus': 16, 'ram': 1024, 'disk': 500})
+        self.index = FlavorIndex(self.flavors)
+
+    def test_solve(self):
+        self.assertEqual(len(self.index), len(self.flavors))
+        self.assertEqual(self.index.solve()['name'], 'C1R512D5')
+        self.assertEqual(self.index.solve(2, 1500, 15)['name'], 'C2R2048D20')
+        self.assertEqual(self.index.solve(3, 8192, 40)['name'], 'C4R8192D40')
+        self.assertEqual(self.index.solve(9, 0, 100)['name'], 'C16R1024D500')
+        self.assertEqual(self.index.solve(1, 0, 100)['name'], 'C16R1024D500')
+        self.assertEqual(self.index.solve(1, 2048, 100), None)
+        self.assertEqual(self.index.solve(16, 2048, 0), None)
+
+    def test_solve_matches_linear_scan(self):
+        for i in range(500):
+            query = (random.randint(0, 17), random.randint(0, 9000),
+                     random.randint(0, 600))
+            self.assertEqual(self.index.solve(*query),
+                             linear_solve(self.flavors, *query), query)
+
+    def test_solve_every_level(self):
+        levels = lambda key: sorted(set(
+            v + d for f in self.flavors for v in [f[key]]
+            for d in (-1, 0, 1)))
+        for cpus in levels('vcpus'):
+            for memory in levels('ram'):
+                for disk in levels('disk'):
+                    query = (cpus, memory, disk)
+                    self.assertEqual(self.index.solve(*query),
+                                     linear_solve(self.flavors, *query),
+                                     query)
+
+    def test_duplicate_sizes(self):
+        flavors = [{'id': 2, 'name': 'b', 'vcpus': 1, 'ram': 512,
+                    'disk': 5},
+                   {'id': 1, 'name': 'a', 'vcpus': 1, 'ram': 512,
+                    'disk': 5}]
+        index = FlavorIndex(flavors)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.solve(1, 512, 5)['name'], 'a')
+        self.assertEqual(FlavorIndex([]).solve(), None)
+
+    def test_solve_flavor_constraints(self):
+        self.assertEqual(
+            solve_flavor(self.index, {})['name'], 'C1R2048D5')
+        self.assertEqual(
+            solve_flavor(self.index, parse_constraints(
+                "cpu-cores=2, mem=4G, root-disk=12G"))['name'],
+            'C2R4096D20')
+        self.assertRaises(
+            ConstraintError, solve_flavor, self.index,
+            parse_constraints("cpu-cores=32"))
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from juju_okeanos.inventory import Inventory
+from juju_okeanos.tests.base import Base
+
+
+class InventoryTest(Base):
+
+    def setUp(self):
+        self.inventory = Inventory()
+        self.addCleanup(self.inventory.close)
+        self.inventory.add_machine(42, 'env-abc', 'snf-42.example.com')
+        self.inventory.add_port(42, 'p1', 7, '192.168.1.3')
+        self.inventory.add_port(42, 'p2', 9, '83.212.1.3', 'fip-1')
+
+    def test_find(self):
+        self.assertEqual(self.inventory.find(machine_id='3'), None)
+        self.inventory.set_machine_id(42, '3')
+        record = self.inventory.find(machine_id='3')
+        self.assertEqual(record['server_id'], '42')
+        self.assertEqual(record['name'], 'env-abc')
+        for address in ('snf-42.example.com', '192.168.1.3', '83.212.1.3'):
+            self.assertEqual(
+                self.inventory.find(address=address)['server_id'], '42')
+        self.assertEqual(self.inventory.find(address='10.0.0.1'), None)
+
+    def test_machine_id_reused(self):
+        self.inventory.set_machine_id(42, '3')
+        self.inventory.add_machine(43, 'env-def')
+        self.inventory.set_machine_id(43, '3')
+        self.assertEqual(
+            self.inventory.find(machine_id='3')['server_id'], '43')
+        self.assertEqual(self.inventory.get(42)['machine_id'], None)
+
+    def test_clear(self):
+        self.inventory.clear()
+        self.assertEqual(self.inventory.machines(), [])
+        self.assertEqual(self.inventory.ports(42), [])
+
+    def test_ports_and_remove(self):
+        self.assertEqual(
+            sorted([(p['port_id'], p['floating_ip_id']) for p in
+                    self.inventory.ports(42)]),
+            [('p1', None), ('p2', 'fip-1')])
+        self.inventory.remove('42')
+        self.assertEqual(self.inventory.get(42), None)
+        self.assertEqual(self.inventory.ports(42), [])
+        self.assertEqual(self.inventory.machines(), [])
+
+    def test_threads(self):
+        def add(offset):
+            for i in range(offset, offset + 50):
+                self.inventory.add_machine(i, 'env-%d' % i)
+        threads = [threading.Thread(target=add, args=(i * 100,))
+                   for i in range(1, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.inventory.machines()), 201)
+
+
+class InventoryFileTest(Base):
+
+    def test_persistent(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'okeanos-env.db')
+        inventory = Inventory(path)
+        inventory.add_machine(42, 'env-abc')
+        inventory.set_machine_id(42, '0')
+        inventory.close()
+
+        inventory = Inventory(path)
+        self.addCleanup(inventory.close)
+        self.assertEqual(inventory.find(machine_id='0')['name'], 'env-abc')
@@ -0,0 +1,232 @@
+import mock
+import threading
+import time
+
+from juju_okeanos.client import Instance
+from juju_okeanos.commands import AddMachine, TerminateMachine
+from juju_okeanos.exceptions import MachineFailed, TimeoutError
+from juju_okeanos.inventory import Inventory
+from juju_okeanos.ops import MachineProvision
+from juju_okeanos.runner import Runner
+from juju_okeanos.tests.base import Base
+
+
+class MachineProvisionTest(Base):
+
+    def setUp(self):
+        self.provider = mock.MagicMock()
+        self.provider.terminate_instance = mock.Mock()
+        self.env = mock.MagicMock()
+        self.provider.add_machine.return_value = {
+            'id': 42, 'fqdn': 'snf-42.example.com',
+            'ip_address': ['192.168.1.3'], 'hardware': {'Mem': 2048}}
+
+    def test_provision(self):
+        op = MachineProvision(
+            self.provider, self.env, {'name': 'okeanos-abc'},
+            private_net={'id': 7})
+        instance = op.run()
+        self.assertEqual(instance['id'], 42)
+        self.provider.add_machine.assert_called_once_with(
+            {'name': 'okeanos-abc'}, private_net={'id': 7})
+        self.provider.set_internal_gw.assert_called_once_with(instance)
+        self.assertFalse(self.env.method_calls)
+
+    def test_provision_gateway_failure(self):
+        self.provider.set_internal_gw.side_effect = ValueError("ssh")
+        op = MachineProvision(self.provider, self.env, {'name': 'okeanos-abc'})
+        self.assertRaises(ValueError, op.run)
+        self.provider.terminate_instance.assert_called_once_with(42)
+
+    def test_provision_batch_failure_isolated(self):
+        self.provider.add_machine.side_effect = [
+            ValueError("quota"),
+            {'id': 43, 'fqdn': 'snf-43.example.com',
+             'ip_address': ['192.168.1.4']}]
+        runner = Runner(2)
+        for name in ('okeanos-a', 'okeanos-b'):
+            runner.queue_op(
+                MachineProvision(self.provider, self.env, {'name': name}))
+        results = list(runner.iter_results())
+        self.assertEqual([r['id'] for r in results], [43])
+
+    def test_provision_past_deadline_terminated(self):
+        gateway = threading.Event()
+        self.provider.set_internal_gw.side_effect = \
+            lambda instance: gateway.wait(5)
+        op = MachineProvision(self.provider, self.env, {'name': 'okeanos-a'})
+        op.deadline = 0.1
+        runner = Runner(1)
+        runner.queue_op(op)
+        results = list(runner.iter_outcomes())
+        self.assertIsInstance(results[0].exception, TimeoutError)
+        self.assertTrue(op.cancelled.is_set())
+        self.assertFalse(self.provider.terminate_instance.called)
+        # The abandoned run finishes late and deletes its server.
+        gateway.set()
+        for i in range(100):
+            if self.provider.terminate_instance.called:
+                break
+            time.sleep(0.01)
+        self.provider.terminate_instance.assert_called_once_with(42)
+
+
+class AddMachineReplaceTest(Base):
+
+    def setUp(self):
+        self.config = mock.MagicMock()
+        self.config.num_machines = 2
+        self.config.parallel = 2
+        self.config.get_env_name.return_value = 'okeanos'
+        self.config.constraints = ''
+        self.config.event_loop = False
+        self.provider = mock.MagicMock()
+        self.env = mock.MagicMock()
+        self.env.add_machines.side_effect = lambda machines: dict(
+            [(host, str(i)) for i, (host, hw) in enumerate(machines)])
+        self.calls = []
+
+        def add_machine(params, private_net=None):
+            self.calls.append(params['name'])
+            if len(self.calls) == 1:
+                raise MachineFailed("server entered ERROR state")
+            return {'id': len(self.calls),
+                    'fqdn': 'snf-%d.example.com' % len(self.calls),
+                    'ip_address': ['192.168.1.3']}
+        self.provider.add_machine.side_effect = add_machine
+
+    def run_command(self, replace_failed):
+        self.config.replace_failed = replace_failed
+        cmd = AddMachine(self.config, self.provider, self.env)
+        cmd.check_preconditions = mock.Mock()
+        cmd.run()
+
+    def test_replace_failed(self):
+        self.run_command(True)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(len(set(self.calls)), 3)
+        # Registered in one batch.
+        self.env.add_machines.assert_called_once_with(mock.ANY)
+        self.assertEqual(
+            sorted(self.env.add_machines.call_args[0][0]),
+            [('snf-2.example.com', None), ('snf-3.example.com', None)])
+        self.assertEqual(self.provider.register_machine.call_count, 2)
+
+    def test_event_loop_replace_failed(self):
+        self.config.event_loop = True
+        self.provider.async_provision_machine.side_effect = (
+            lambda params, private_net: params['name'])
+        instance = {'id': 2, 'fqdn': 'snf-2.example.com',
+                    'ip_address': ['192.168.1.3']}
+        self.provider.run_all.side_effect = [
+            [MachineFailed("ERROR"), instance],
+            [dict(instance, id=3, fqdn='snf-3.example.com')]]
+        self.run_command(True)
+        self.assertFalse(self.provider.add_machine.called)
+        self.assertEqual(self.provider.run_all.call_count, 2)
+        self.assertEqual(len(self.provider.run_all.call_args[0][0]), 1)
+        self.assertEqual(self.provider.register_machine.call_count, 2)
+
+    def test_unregistered_terminated(self):
+        self.env.add_machines.side_effect = lambda machines: {
+            'snf-2.example.com': '1'}
+        self.config.num_machines = 3
+        self.run_command(False)
+        self.provider.register_machine.assert_called_once_with(2, '1')
+        self.provider.terminate_instance.assert_called_once_with(3)
+
+    def test_register_failure_terminates(self):
+        self.env.add_machines.side_effect = IOError("connection refused")
+        self.provider.terminate_instance.side_effect = [
+            Exception("conflict"), None, None]
+        self.config.num_machines = 4
+        self.assertRaises(IOError, self.run_command, False)
+        self.assertEqual(
+            sorted(self.provider.terminate_instance.call_args_list),
+            [mock.call(2), mock.call(3), mock.call(4)])
+        self.assertFalse(self.provider.register_machine.called)
+        self.env.close.assert_called_once_with()
+
+    def test_no_replace(self):
+        self.run_command(False)
+        self.assertEqual(len(self.calls), 2)
+
+
+class TerminateMachinesTest(Base):
+
+    def setUp(self):
+        self.config = mock.MagicMock()
+        self.config.parallel = 4
+        self.provider = mock.MagicMock()
+        self.provider.wait_instances_gone.return_value = []
+        self.provider.watch_instances_gone.side_effect = lambda ids: [
+            mock.Mock(resource_id=i) for i in ids]
+        self.provider.inventory = Inventory()
+        # Created up front, runner threads would race creating it.
+        self.provider.terminate_instance = mock.Mock()
+        self.env = mock.MagicMock()
+        self.env.status.return_value = {'machines': dict(
+            [(str(i), {'dns-name': '10.0.1.%d' % i,
+                       'instance-id': 'manual:10.0.1.%d' % i})
+             for i in range(12)])}
+        # Machine 11 is gone from the provider already.
+        self.provider.get_instances.return_value = [
+            Instance(id=str(100 + i), name='okeanos-%d' % i,
+                     fqdn='snf-%d.example.com' % (100 + i),
+                     ip_addresses=['10.0.1.%d' % i]) for i in range(11)]
+
+    def test_batched_terminate(self):
+        cmd = TerminateMachine(self.config, self.provider, self.env)
+        cmd._terminate_machines(lambda mid, m: mid != '0')
+        self.env.terminate_machines.assert_called_once_with(
+            [str(i) for i in sorted(range(1, 12), key=str)])
+        self.assertEqual(
+            sorted([c[0][0] for c in
+                    self.provider.terminate_instance.call_args_list]),
+            map(str, range(101, 111)))
+        self.assertEqual(
+            sorted(self.provider.wait_instances_gone.call_args[0][0]),
+            map(str, range(101, 111)))
+        self.provider.forget_instances.assert_called_once_with(
+            self.provider.wait_instances_gone.call_args[0][0])
+
+    def test_deletes_watched_first(self):
+        order = []
+        self.provider.watch_instances_gone.side_effect = (
+            lambda ids: order.append('watch') or [mock.Mock() for i in ids])
+        self.provider.terminate_instance.side_effect = (
+            lambda instance_id: order.append('delete'))
+        cmd = TerminateMachine(self.config, self.provider, self.env)
+        cmd._terminate_machines(lambda mid, m: mid in ('1', '2'))
+        self.assertEqual(order, ['watch', 'delete', 'delete'])
+
+    def test_inventory_resolves(self):
+        inventory = self.provider.inventory
+        for i in range(1, 3):
+            inventory.add_machine(100 + i, 'okeanos-%d' % i)
+            inventory.set_machine_id(100 + i, str(i))
+        self.provider.wait_instances_gone.return_value = ['102']
+        cmd = TerminateMachine(self.config, self.provider, self.env)
+        cmd._terminate_machines(lambda mid, m: mid in ('1', '2'))
+        self.assertFalse(self.provider.get_instances.called)
+        self.assertEqual(
+            sorted([c[0][0] for c in
+                    self.provider.terminate_instance.call_args_list]),
+            ['101', '102'])
+        self.provider.forget_instances.assert_called_once_with(['101'])
+
+    def test_failed_delete_not_waited(self):
+
+        def terminate(instance_id):
+            if instance_id == '102':
+                raise ValueError("409 conflict")
+        self.provider.terminate_instance.side_effect = terminate
+        cmd = TerminateMachine(self.config, self.provider, self.env)
+        cmd._terminate_machines(lambda mid, m: mid in ('1', '2'))
+        discard = self.provider.delete_watcher.discard
+        discard.assert_called_once_with('102', mock.ANY)
+        self.assertEqual(discard.call_args[0][1].resource_id, '102')
+        args, kw = self.provider.wait_instances_gone.call_args
+        self.assertEqual(args, (['101'],))
+        self.assertEqual([w.resource_id for w in kw['waiters']], ['101'])
+        self.provider.forget_instances.assert_called_once_with(['101'])
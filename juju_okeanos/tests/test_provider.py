@@ -0,0 +1,301 @@
+import mock
+import subprocess
+import threading
+
+from kamaki.clients import ClientError
+
+from juju_okeanos.exceptions import (
+    MachineFailed, ProviderError, TimeoutError)
+from juju_okeanos.provider import Okeanos
+from juju_okeanos.tests.base import Base
+
+
+class ProviderBase(Base):
+
+    def setUp(self):
+        self.kamaki_config = mock.MagicMock()
+        self.kamaki_config.get_cloud.side_effect = lambda cloud, key: {
+            'url': 'https://accounts.example.com/identity/v2.0',
+            'token': 'secret'}[key]
+        patcher = mock.patch('juju_okeanos.provider.AstakosClient')
+        self.astakos = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.astakos.return_value.get_endpoint_url.side_effect = (
+            lambda service: 'https://%s.example.com/v2.0' % service)
+        self.astakos.return_value.user_info = {'id': 'user-1'}
+        mock.patch('juju_okeanos.provider.https').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def get_provider(self, **kw):
+        return Okeanos(self.kamaki_config, **kw)
+
+
+class ClientCacheTest(ProviderBase):
+
+    @mock.patch('juju_okeanos.provider.CycladesComputeClient')
+    def test_clients_built_once_per_thread(self, compute):
+        compute.service_type = 'compute'
+        provider = self.get_provider(pool_size=12)
+        self.assertEqual(self.astakos.call_count, 0)
+        client = provider.get_compute_client()
+        self.assertEqual(self.astakos.call_count, 1)
+        self.assertIs(provider.get_compute_client(), client)
+        compute.assert_called_once_with(
+            'https://compute.example.com/v2.0', 'secret')
+        self.assertEqual(client.poolsize, 12)
+        self.assertIs(
+            provider.get_identity_client().client, self.astakos.return_value)
+        # Endpoints are never looked up again.
+        self.assertEqual(
+            self.astakos.return_value.get_endpoint_url.call_count, 3)
+
+    @mock.patch('juju_okeanos.provider.CycladesComputeClient')
+    def test_clients_not_shared_across_threads(self, compute):
+        compute.side_effect = lambda url, token: mock.MagicMock()
+        provider = self.get_provider()
+        clients = []
+        thread = threading.Thread(
+            target=lambda: clients.append(provider.get_compute_client()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(provider.get_compute_client(), clients[0])
+
+
+class CatalogTest(ProviderBase):
+
+    def test_endpoints_cached_on_disk(self):
+        catalog_dir = self.mkdir()
+        provider = self.get_provider(catalog_dir=catalog_dir)
+        self.assertEqual(provider.user_id, 'user-1')
+        self.assertEqual(self.astakos.call_count, 1)
+
+        provider = self.get_provider(catalog_dir=catalog_dir)
+        self.assertEqual(self.astakos.call_count, 1)
+        self.assertEqual(
+            provider.endpoints['cyclades'], 'https://compute.example.com/v2.0')
+
+        self.get_provider(
+            catalog_dir=catalog_dir, refresh_catalog=True).endpoints
+        self.assertEqual(self.astakos.call_count, 2)
+
+    def test_discovery_deferred(self):
+        provider = self.get_provider()
+        self.assertFalse(self.astakos.called)
+        provider.get_identity_client()
+        self.astakos.assert_called_once_with(
+            'https://accounts.example.com/identity/v2.0', 'secret')
+        self.assertFalse(self.astakos.return_value.get_endpoint_url.called)
+
+
+class FailFastTest(ProviderBase):
+
+    def setUp(self):
+        super(FailFastTest, self).setUp()
+        mock.patch('juju_okeanos.provider.ssh.probe_banners',
+                   lambda hosts, **kw: dict.fromkeys(
+                       hosts, 'SSH-2.0-OpenSSH_6.6')).start()
+
+    @mock.patch('juju_okeanos.provider.ssh.check_ssh')
+    def test_wait_ssh_fatal(self, check_ssh):
+        check_ssh.side_effect = subprocess.CalledProcessError(
+            255, ['ssh'], "Permission denied (publickey).")
+        provider = self.get_provider()
+        self.assertRaises(
+            MachineFailed, provider.wait_ssh, {'fqdn': 'snf-1.example.com'})
+        self.assertEqual(check_ssh.call_count, 1)
+
+    @mock.patch('juju_okeanos.wait.time.sleep')
+    @mock.patch('juju_okeanos.provider.ssh.check_ssh')
+    def test_wait_ssh_retries_refused(self, check_ssh, sleep):
+        check_ssh.side_effect = [subprocess.CalledProcessError(
+            255, ['ssh'], "Connection refused"), True]
+        provider = self.get_provider()
+        self.assertTrue(provider.wait_ssh({'fqdn': 'snf-1.example.com'}))
+
+    def test_failed_server_discarded(self):
+        provider = self.get_provider()
+        compute = mock.MagicMock()
+        compute.create_server.return_value = {
+            'id': 7, 'name': 'env-1', 'status': 'BUILD'}
+        provider._server_args = mock.Mock(return_value=({}, {}))
+        provider.get_compute_client = mock.Mock(return_value=compute)
+        provider.wait_server_active = mock.Mock(
+            side_effect=MachineFailed("7 entered ERROR state"))
+        self.assertRaises(
+            MachineFailed, provider.add_machine, {'name': 'env-1'})
+        compute.delete_server.assert_called_once_with(7)
+
+
+class WaitInstancesGoneTest(ProviderBase):
+
+    def test_one_listing_per_tick(self):
+        provider = self.get_provider()
+        provider.delete_watcher.interval = 0.01
+        listings = []
+
+        def changed(since, ids):
+            listings.append(since)
+            status = len(listings) > 2 and 'DELETED' or 'ACTIVE'
+            return [dict(id=i, status=status) for i in (1, 2, 3)]
+        provider.delete_watcher.fetch = changed
+        self.assertEqual(provider.wait_instances_gone([1, 2, 3]), [])
+        self.assertEqual(len(listings), 3)
+
+    def test_timeout_reports_remaining(self):
+        provider = self.get_provider()
+        compute = mock.MagicMock()
+        provider.get_compute_client = mock.Mock(return_value=compute)
+        details = {2: dict(id=2, status='ACTIVE'),
+                   3: dict(id=3, status='DELETED')}
+
+        def get_server_details(server_id):
+            if server_id not in details:
+                raise ClientError("Not found", 404)
+            return details[server_id]
+        compute.get_server_details.side_effect = get_server_details
+        provider.delete_watcher.fetch = lambda since, ids: [
+            dict(id=1, status='DELETED'), dict(id=2, status='ACTIVE')]
+        # 3 and 4 were deleted before the listing's changes-since.
+        self.assertEqual(
+            provider.wait_instances_gone([1, 2, 3, 4], timeout=0.2), [2])
+        self.assertEqual(provider.delete_watcher.pending, {})
+
+    def test_already_deleted(self):
+        provider = self.get_provider()
+        compute = mock.MagicMock()
+        compute.delete_server.side_effect = ClientError("Not found", 404)
+        provider.get_compute_client = mock.Mock(return_value=compute)
+        provider.delete_watcher.fetch = lambda since, ids: []
+        waiters = provider.watch_instances_gone([5])
+        provider.terminate_instance(5)
+        self.assertEqual(
+            provider.wait_instances_gone([5], timeout=5, waiters=waiters), [])
+        self.assertFalse(compute.get_server_details.called)
+
+
+class TaggingTest(ProviderBase):
+
+    def setUp(self):
+        super(TaggingTest, self).setUp()
+        self.compute = mock.MagicMock()
+        mock.patch('juju_okeanos.provider.CycladesComputeClient',
+                   return_value=self.compute).start()
+
+    def test_servers_tagged(self):
+        provider = self.get_provider(env_name='env')
+        provider.get_flavor = mock.Mock(return_value={'id': 3})
+        provider.get_ubuntu_image = mock.Mock(return_value={'id': 'img'})
+        provider.get_project_id = mock.Mock(return_value='project')
+        with mock.patch('__builtin__.open', mock.mock_open(read_data='key')):
+            flv, args = provider._server_args({}, is_gateway=True)
+        self.assertEqual(
+            args['metadata'], {'juju-env': 'env', 'juju-role': 'gateway'})
+
+        provider.register_machine(42, '3')
+        self.compute.update_server_metadata.assert_called_once_with(
+            42, **{'juju-machine-id': '3'})
+        self.assertEqual(provider.inventory.machines(), [])
+
+    def test_list_env_instances(self):
+        self.compute.list_servers.return_value = [
+            {'id': 1, 'name': 'env-0', 'status': 'ACTIVE',
+             'metadata': {'juju-env': 'env', 'juju-machine-id': '0',
+                          'juju-role': 'gateway'}},
+            {'id': 2, 'name': 'env-x', 'status': 'ACTIVE', 'metadata': {}},
+            {'id': 4, 'name': 'envy-0', 'status': 'ACTIVE', 'metadata': {}},
+            {'id': 3, 'name': 'env-1', 'status': 'ACTIVE',
+             'metadata': {'juju-env': 'env2'}}]
+        provider = self.get_provider(env_name='env')
+        instances = provider.get_instances()
+        # Untagged servers of the environment match by name.
+        self.assertEqual([(i.id, i.machine_id, i.role) for i in instances],
+                         [('1', '0', 'gateway'), ('2', None, None)])
+        self.compute.list_servers.assert_called_once_with(
+            detail=True, marker=None, limit=500, name='env')
+        self.assertEqual(len(provider.get_instances(all_servers=True)), 4)
+        self.assertRaises(
+            ProviderError, self.get_provider().get_instances)
+
+
+class InstancesTest(ProviderBase):
+
+    def setUp(self):
+        super(InstancesTest, self).setUp()
+        self.compute = mock.MagicMock()
+        mock.patch('juju_okeanos.provider.CycladesComputeClient',
+                   return_value=self.compute).start()
+        self.provider = self.get_provider()
+        self.provider.page_size = 2
+
+    def test_paging(self):
+        servers = [{'id': i, 'name': 'env-%d' % i, 'status': 'ACTIVE'}
+                   for i in range(5)]
+
+        def list_servers(detail, marker, limit):
+            start = marker is not None and marker + 1 or 0
+            return servers[start:start + limit]
+        self.compute.list_servers.side_effect = list_servers
+        self.assertEqual(
+            [i.id for i in self.provider.iter_instances(all_servers=True)],
+            ['0', '1', '2', '3', '4'])
+        self.assertEqual(self.compute.list_servers.call_count, 3)
+
+    def test_paging_unsupported(self):
+        self.compute.list_servers.return_value = [
+            {'id': 1, 'name': 'env-1', 'status': 'ACTIVE'},
+            {'id': 2, 'name': 'env-2', 'status': 'ACTIVE'}]
+        self.assertEqual(
+            len(self.provider.get_instances(all_servers=True)), 2)
+        self.assertEqual(self.compute.list_servers.call_count, 2)
+
+    def test_instance_record(self):
+        self.compute.get_server_details.return_value = {
+            'id': 7, 'name': 'env-7', 'status': 'BUILD',
+            'SNF:fqdn': 'snf-7.example.com', 'flavor': {'id': 3},
+            'created': '2014-06-01T10:00:00+00:00',
+            'addresses': {
+                '2': [{'addr': '192.168.1.3', 'version': 4}],
+                '1': [{'addr': '83.212.1.3', 'version': 4},
+                      {'addr': '2001:648::1', 'version': 6}]}}
+        instance = self.provider.get_instance(7)
+        self.assertEqual(instance.to_json(), {
+            'id': '7', 'name': 'env-7', 'fqdn': 'snf-7.example.com',
+            'ip_addresses': ['83.212.1.3', '2001:648::1', '192.168.1.3'],
+            'status': 'BUILD', 'flavor_id': 3,
+            'created': '2014-06-01T10:00:00+00:00', 'machine_id': None,
+            'role': None})
+        self.assertEqual(instance.ip_address, '83.212.1.3')
+
+    def test_terminate_forgets_instance(self):
+        network = mock.MagicMock()
+        self.provider.get_network_client = mock.Mock(return_value=network)
+        inventory = self.provider.inventory
+        inventory.add_machine(7, 'env-7')
+        inventory.set_machine_id(7, '2')
+        inventory.add_port(7, 'p1', 1, '83.212.1.3', 'fip-1')
+        self.provider.terminate_instance(7)
+        self.assertEqual(inventory.find(machine_id='2'), None)
+        self.provider.forget_instances(['7'])
+        network.delete_floatingip.assert_called_once_with('fip-1')
+
+    def test_terminate_gone(self):
+        self.compute.delete_server.side_effect = ClientError(
+            "Not found", 404)
+        self.provider.terminate_instance(7)
+        self.compute.delete_server.side_effect = ClientError(
+            "Bad request", 400)
+        self.assertRaises(
+            ClientError, self.provider.terminate_instance, 7)
+
+    @mock.patch('juju_okeanos.wait.time.sleep')
+    def test_terminate_busy_retried(self, sleep):
+        self.compute.delete_server.side_effect = [
+            ClientError("Build in progress", 409), None]
+        self.provider.terminate_instance(7)
+        self.assertEqual(self.compute.delete_server.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+        self.compute.delete_server.side_effect = ClientError(
+            "Build in progress", 409)
+        self.provider.delete_conflict_timeout = 0
+        self.assertRaises(
+            TimeoutError, self.provider.terminate_instance, 7)
@@ -0,0 +1,141 @@
+import mock
+import threading
+import time
+
+from kamaki.clients import ClientError
+from requests import Response
+
+from juju_okeanos.exceptions import ProviderAPIError
+from juju_okeanos.ratelimit import (
+    RateLimiter, RateLimitedClient, throttle_info)
+from juju_okeanos.tests.base import Base
+
+
+def api_error(status, retry_after=None):
+    r = Response()
+    r.status_code = status
+    if retry_after is not None:
+        r.headers['Retry-After'] = str(retry_after)
+    return ProviderAPIError(r, "throttled")
+
+
+class FakeClientError(Exception):
+
+    def __init__(self, status):
+        self.status = status
+
+
+class RateLimiterTest(Base):
+
+    def test_throttle_info(self):
+        self.assertEqual(throttle_info(api_error(429, 3)), (429, 3))
+        self.assertEqual(throttle_info(FakeClientError('503')), (503, None))
+        self.assertEqual(throttle_info(ValueError()), (None, None))
+
+    @mock.patch('juju_okeanos.ratelimit.RateLimiter.pause')
+    def test_retry_throttled(self, pause):
+        limiter = RateLimiter(max_concurrency=8)
+        func = mock.Mock(side_effect=[
+            api_error(429, 2), FakeClientError(503), 'ok'])
+        self.assertEqual(limiter.call(func, 1, a=2), 'ok')
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(pause.call_args_list[0], mock.call(2))
+        # Multiplicative decrease on each throttle, then additive growth.
+        self.assertAlmostEqual(limiter.limit, 2 + 1 / 2.0)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_other_errors_raise(self):
+        limiter = RateLimiter()
+        func = mock.Mock(side_effect=api_error(404))
+        self.assertRaises(ProviderAPIError, limiter.call, func)
+        self.assertEqual(func.call_count, 1)
+        limiter = RateLimiter(max_retries=1, base_delay=0.01)
+        func = mock.Mock(side_effect=api_error(503))
+        self.assertRaises(ProviderAPIError, limiter.call, func)
+        self.assertEqual(func.call_count, 2)
+
+    @mock.patch('juju_okeanos.ratelimit.RateLimiter.pause')
+    def test_over_limit(self, pause):
+        limiter = RateLimiter()
+        quota = ClientError(
+            '{"overLimit": {"code": 413, "message": '
+            '"Resource Limit Exceeded for your account."}}', 413)
+        func = mock.Mock(side_effect=quota)
+        self.assertRaises(ClientError, limiter.call, func)
+        self.assertEqual(func.call_count, 1)
+        self.assertFalse(pause.called)
+
+        rate = ClientError(
+            '{"overLimit": {"code": 413, "message": "Rate limit '
+            'exceeded, retry after 7 seconds"}}', 413)
+        self.assertEqual(throttle_info(rate), (413, 7))
+        func = mock.Mock(side_effect=[rate, 'ok'])
+        self.assertEqual(limiter.call(func), 'ok')
+        pause.assert_called_once_with(7)
+
+    @mock.patch('juju_okeanos.ratelimit.RateLimiter.pause')
+    def test_call_once(self, pause):
+        limiter = RateLimiter()
+        func = mock.Mock(side_effect=[FakeClientError(503), 'ok'])
+        self.assertRaises(FakeClientError, limiter.call_once, func)
+        self.assertEqual(func.call_count, 1)
+        # Everyone else still backs off.
+        self.assertEqual(pause.call_count, 1)
+        self.assertEqual(limiter.limit, limiter.max_concurrency / 2.0)
+
+    def test_pause_applies_to_all_callers(self):
+        limiter = RateLimiter()
+        limiter.pause(0.2)
+        t = time.time()
+        limiter.call(lambda: None)
+        self.assertGreaterEqual(time.time() - t, 0.15)
+
+    def test_rate(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        t = time.time()
+        for i in range(6):
+            limiter.call(lambda: None)
+        self.assertGreaterEqual(time.time() - t, 0.09)
+
+    def test_concurrency_limit(self):
+        limiter = RateLimiter(max_concurrency=2)
+        lock = threading.Lock()
+        seen = []
+
+        def work():
+            with lock:
+                seen.append(limiter.in_flight)
+            time.sleep(0.05)
+
+        threads = [threading.Thread(target=limiter.call, args=(work,))
+                   for i in range(6)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(max(seen), 2)
+
+
+class RateLimitedClientTest(Base):
+
+    def test_proxy(self):
+        client = mock.Mock()
+        client.list_servers.return_value = ['a']
+        limiter = mock.Mock()
+        limiter.call.side_effect = lambda f, *a, **kw: f(*a, **kw)
+        proxy = RateLimitedClient(client, limiter)
+        self.assertEqual(proxy.list_servers(detail=True), ['a'])
+        client.list_servers.assert_called_once_with(detail=True)
+        self.assertEqual(limiter.call.call_count, 1)
+        proxy.wait_server(1)
+        self.assertEqual(limiter.call.call_count, 1)
+        proxy.poolsize = 8
+        self.assertEqual(client.poolsize, 8)
+
+    def test_creates_not_retried(self):
+        client = mock.Mock()
+        limiter = mock.Mock()
+        proxy = RateLimitedClient(client, limiter)
+        proxy.create_server('env-1', 1, 'img')
+        limiter.call_once.assert_called_once_with(
+            client.create_server, 'env-1', 1, 'img')
+        proxy.delete_server(1)
+        limiter.call.assert_called_once_with(client.delete_server, 1)
@@ -0,0 +1,65 @@
+import mock
+import subprocess
+
+from juju_okeanos.exceptions import RemoteScriptError
+from juju_okeanos.remote import RemoteScript, gateway_script, nat_script
+from juju_okeanos.tests.base import Base
+
+
+def run_locally(host, script, user="root"):
+    """Stand in for ssh.run_script, running the script with local bash."""
+    process = subprocess.Popen(
+        ["bash", "-s"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output, _ = process.communicate(script)
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, ["ssh", host], output)
+    return output
+
+
+class RemoteScriptTest(Base):
+
+    def setUp(self):
+        patcher = mock.patch(
+            'juju_okeanos.remote.ssh.run_script', side_effect=run_locally)
+        self.run_script = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_single_session(self):
+        work = self.mkdir()
+        script = RemoteScript("test")
+        script.add("write", "echo 'it''s' > %s/out" % work)
+        script.add("check", "grep -q its %s/out && echo done" % work)
+        results = script.run("snf-1.example.com")
+        self.assertEqual(self.run_script.call_count, 1)
+        self.assertEqual([(r.name, r.status) for r in results],
+                         [("write", 0), ("check", 0)])
+        self.assertTrue(all(r.duration >= 0 for r in results))
+
+    def test_run_stops_at_failure(self):
+        work = self.mkdir()
+        script = RemoteScript("test")
+        script.add("ok", "true")
+        script.add("fail", "false; touch %s/not-reached" % work)
+        script.add("after", "touch %s/after" % work)
+        try:
+            script.run("snf-1.example.com")
+        except RemoteScriptError, e:
+            self.assertEqual([(r.name, r.status) for r in e.results],
+                             [("ok", 0), ("fail", 1)])
+            self.assertIn("failed at step fail", str(e))
+        else:
+            self.fail("failing step should raise")
+
+    def test_configuration_scripts(self):
+        nat = nat_script("eth1").render()
+        self.assertIn("MASQUERADE", nat)
+        self.assertIn("if-pre-up.d/juju-okeanos-iptables", nat)
+        gateway = gateway_script("192.168.1.2", "eth1")
+        self.assertEqual(
+            [name for name, _ in gateway.steps],
+            ["route", "persist", "verify"])
+        self.assertIn(
+            "ip route replace default via 192.168.1.2 dev eth1",
+            gateway.render())
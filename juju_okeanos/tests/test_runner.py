@@ -1,5 +1,8 @@
 
-from juju_docean.runner import Runner
+import time
+
+from juju_okeanos.exceptions import OpCancelled, TimeoutError
+from juju_okeanos.runner import Runner
 from base import Base
 
 
@@ -34,3 +37,96 @@ class RunnerTest(Base):
         results = list(runner.iter_results())
         self.assertEqual(len(results), 2)
         runner.stop()
+
+
+class FakeSlowOp(object):
+
+    def __init__(self, delay, deadline=None):
+        self.delay = delay
+        self.deadline = deadline
+        self.cancelled = False
+
+    def run(self):
+        time.sleep(self.delay)
+        return self.delay
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __str__(self):
+        return "FakeSlowOp %s" % self.delay
+
+
+class FakeRaisingOp(object):
+
+    def run(self):
+        raise ValueError("Bad")
+
+
+class RunnerOutcomeTest(Base):
+
+    def test_outcomes(self):
+        runner = Runner(2)
+        good, bad = FakeOp(), FakeRaisingOp()
+        runner.queue_op(good)
+        runner.queue_op(bad)
+        results = dict(
+            [(r.op, r) for r in runner.iter_outcomes()])
+        self.assertTrue(results[good].ok)
+        self.assertEqual(results[good].value, 1)
+        self.assertFalse(results[bad].ok)
+        self.assertIsInstance(results[bad].exception, ValueError)
+        self.assertTrue(results[bad].duration >= 0)
+
+    def test_completion_order(self):
+        runner = Runner(2)
+        runner.queue_op(FakeSlowOp(0.3))
+        runner.queue_op(FakeSlowOp(0.01))
+        self.assertEqual(list(runner.iter_results()), [0.01, 0.3])
+
+    def test_deadline(self):
+        runner = Runner(1)
+        stuck = FakeSlowOp(5, deadline=0.1)
+        runner.queue_op(stuck)
+        runner.queue_op(FakeSlowOp(0.01))
+        t = time.time()
+        results = list(runner.iter_outcomes())
+        self.assertLess(time.time() - t, 2)
+        self.assertIsInstance(results[0].exception, TimeoutError)
+        self.assertTrue(stuck.cancelled)
+        # The stuck worker was replaced, the rest of the queue ran.
+        self.assertEqual(results[1].value, 0.01)
+
+    def test_runner_timeout(self):
+        runner = Runner(2, timeout=0.1)
+        runner.queue_op(FakeSlowOp(5))
+        results = list(runner.iter_outcomes())
+        self.assertIsInstance(results[0].exception, TimeoutError)
+
+    def test_cancel(self):
+        runner = Runner(1)
+        for i in range(3):
+            runner.queue_op(FakeSlowOp(0.1))
+        outcomes = runner.iter_outcomes()
+        first = outcomes.next()
+        self.assertTrue(first.ok)
+        runner.cancel()
+        rest = list(outcomes)
+        self.assertEqual(len(rest), 2)
+        self.assertTrue(
+            any(isinstance(r.exception, OpCancelled) for r in rest))
+
+
+class RunnerLateQueueTest(Base):
+
+    def test_queue_while_iterating(self):
+        runner = Runner(2)
+        runner.queue_op(FakeOp())
+        results = []
+        for result in runner.iter_outcomes():
+            results.append(result.value)
+            if len(results) == 1:
+                # The workers have gone idle by now.
+                time.sleep(0.05)
+                runner.queue_op(FakeOp())
+        self.assertEqual(results, [1, 1])
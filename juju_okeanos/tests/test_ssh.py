@@ -0,0 +1,159 @@
+import mock
+import os
+import select
+import socket
+import subprocess
+import threading
+import time
+
+from juju_okeanos.ssh import SessionManager, check_output, probe_banners
+from juju_okeanos.tests.base import Base
+
+
+class SessionManagerTest(Base):
+
+    def setUp(self):
+        self.sessions = SessionManager()
+        self.addCleanup(self.sessions.close)
+
+    def test_command_reuses_control_path(self):
+        cmd = self.sessions.command('snf-1.example.com')
+        self.assertEqual(cmd[-1], 'root@snf-1.example.com')
+        self.assertIn('ControlMaster=auto', cmd)
+        control_path = [o for o in cmd if o.startswith('ControlPath=')][0]
+        self.assertTrue(os.path.isdir(self.sessions.control_dir))
+        self.assertEqual(
+            control_path, 'ControlPath=%s/%%r@%%h:%%p' % (
+                self.sessions.control_dir))
+        self.assertIn(
+            control_path, self.sessions.command('snf-2.example.com', 'ubuntu'))
+
+    @mock.patch('subprocess.call')
+    def test_close(self, mock_call):
+        self.sessions.command('snf-1.example.com')
+        control_dir = self.sessions.control_dir
+        open(os.path.join(
+            control_dir, 'root@snf-1.example.com:22'), 'w').close()
+        self.sessions.close()
+        self.assertFalse(os.path.exists(control_dir))
+        cmd = mock_call.call_args[0][0]
+        self.assertEqual(cmd[-3:], ['-O', 'exit', 'root@snf-1.example.com'])
+        self.assertEqual(mock_call.call_count, 1)
+        # Closing again, or without sessions, is a no-op.
+        self.sessions.close()
+        self.assertEqual(mock_call.call_count, 1)
+
+
+class CheckOutputTest(Base):
+
+    def test_detached_child_holds_stderr(self):
+        # Like a forked ControlMaster, stdin and stdout on /dev/null.
+        t = time.time()
+        output = check_output([
+            'sh', '-c', 'echo out; echo err >&2; '
+            'sleep 2 </dev/null >/dev/null & exit 0'])
+        self.assertLess(time.time() - t, 1)
+        self.assertEqual(output, 'out\nerr\n')
+
+    def test_input_and_failure(self):
+        try:
+            check_output(['sh', '-c', 'cat; echo refused >&2; exit 255'],
+                         input='script\n')
+        except subprocess.CalledProcessError, e:
+            self.assertEqual(e.returncode, 255)
+            self.assertEqual(e.output, 'script\nrefused\n')
+        else:
+            self.fail("expected CalledProcessError")
+
+
+class BannerServer(object):
+    """Listeners on loopback addresses, sending banner on accept."""
+
+    def __init__(self, addresses, banner="SSH-2.0-OpenSSH_6.6.1\r\n"):
+        self.banner = banner
+        self.listeners = []
+        self.accepted = []
+        port = 0
+        for address in addresses:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, port))
+            port = sock.getsockname()[1]
+            sock.listen(128)
+            self.listeners.append(sock)
+        self.port = port
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            readable, _, _ = select.select(self.listeners, [], [], 0.05)
+            for sock in readable:
+                conn, _ = sock.accept()
+                if self.banner:
+                    conn.sendall(self.banner)
+                self.accepted.append(conn)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for sock in self.listeners + self.accepted:
+            sock.close()
+
+
+class ProbeBannersTest(Base):
+
+    def serve(self, addresses, **kw):
+        server = BannerServer(addresses, **kw)
+        self.addCleanup(server.close)
+        return server
+
+    def test_probe_many_hosts(self):
+        hosts = ['127.0.0.%d' % i for i in range(1, 101)]
+        server = self.serve(hosts[:60])
+        t = time.time()
+        with mock.patch('subprocess.Popen') as popen:
+            banners = probe_banners(hosts, port=server.port, timeout=0.5)
+        self.assertFalse(popen.called)
+        self.assertLess(time.time() - t, 0.5)
+        self.assertEqual(
+            banners, dict([(h, 'SSH-2.0-OpenSSH_6.6.1') for h in hosts[:60]] +
+                          [(h, None) for h in hosts[60:]]))
+
+    def test_probe_no_banner(self):
+        server = self.serve(['127.0.0.1'], banner=None)
+        t = time.time()
+        self.assertEqual(
+            probe_banners(['127.0.0.1'], port=server.port, timeout=0.2),
+            {'127.0.0.1': None})
+        self.assertGreaterEqual(time.time() - t, 0.2)
+
+    def test_probe_not_ssh(self):
+        server = self.serve(['127.0.0.1'], banner="220 smtp ready\r\n")
+        self.assertEqual(
+            probe_banners(['127.0.0.1'], port=server.port),
+            {'127.0.0.1': None})
+
+    def test_probe_resolves_once(self):
+        server = self.serve(['127.0.0.1'], banner=None)
+        addresses = {}
+        getaddrinfo = socket.getaddrinfo
+        with mock.patch('socket.getaddrinfo',
+                        side_effect=getaddrinfo) as lookup:
+            for _ in range(3):
+                probe_banners(['localhost'], port=server.port,
+                              timeout=0.05, addresses=addresses)
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(addresses['localhost'][1][1], server.port)
+
+    def test_probe_select_fallback(self):
+        hosts = ['127.0.0.1', '127.0.0.2']
+        server = self.serve(hosts[:1])
+        with mock.patch('juju_okeanos.ssh.select', mock.Mock(
+                spec=['select'], select=select.select)):
+            banners = probe_banners(hosts, port=server.port, timeout=0.5)
+        self.assertEqual(
+            banners, {'127.0.0.1': 'SSH-2.0-OpenSSH_6.6.1',
+                      '127.0.0.2': None})
@@ -0,0 +1,45 @@
+import mock
+
+from juju_okeanos.exceptions import TimeoutError
+from juju_okeanos.tests.base import Base
+from juju_okeanos import wait
+
+
+class WaitForTest(Base):
+
+    def setUp(self):
+        wait.stats.reset()
+        self.addCleanup(wait.stats.reset)
+
+    @mock.patch('juju_okeanos.wait.time.sleep')
+    def test_wait_for_backoff(self, mock_sleep):
+        check = mock.Mock(side_effect=[None, False, 'ACTIVE'])
+        self.assertEqual(
+            wait.wait_for(check, 'port', delay=1, jitter=0), 'ACTIVE')
+        self.assertEqual(
+            mock_sleep.call_args_list, [mock.call(1), mock.call(2)])
+        count, total, worst, polls, timeouts = wait.stats.timings['port']
+        self.assertEqual((count, polls, timeouts), (1, 3, 0))
+
+    @mock.patch('juju_okeanos.wait.time.sleep')
+    def test_wait_for_max_delay(self, mock_sleep):
+        check = mock.Mock(side_effect=[None] * 5 + [True])
+        wait.wait_for(check, 'ssh', delay=4, max_delay=10, jitter=0)
+        self.assertEqual(
+            [c[0][0] for c in mock_sleep.call_args_list],
+            [4, 8, 10, 10, 10])
+
+    @mock.patch('juju_okeanos.wait.time.sleep')
+    def test_wait_for_retry_on(self, mock_sleep):
+        check = mock.Mock(side_effect=[OSError("refused"), True])
+        self.assertTrue(wait.wait_for(check, 'ssh', retry_on=(OSError,)))
+        check = mock.Mock(side_effect=ValueError("bad"))
+        self.assertRaises(
+            ValueError, wait.wait_for, check, 'ssh', retry_on=(OSError,))
+
+    def test_wait_for_timeout(self):
+        check = mock.Mock(return_value=None)
+        self.assertRaises(
+            TimeoutError, wait.wait_for, check, 'route',
+            timeout=0.05, delay=0.01)
+        self.assertEqual(wait.stats.timings['route'][4], 1)
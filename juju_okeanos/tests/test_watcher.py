@@ -0,0 +1,75 @@
+import threading
+import time
+
+from juju_okeanos.exceptions import MachineFailed, TimeoutError
+from juju_okeanos.provider import Okeanos
+from juju_okeanos.tests.base import Base
+from juju_okeanos import wait
+from juju_okeanos.watcher import Watcher, changes_since
+
+
+class FakeServers(object):
+    """Servers going ACTIVE (or ERROR) at given times."""
+
+    def __init__(self):
+        self.servers = {}
+        self.calls = []
+
+    def add(self, server_id, after, status='ACTIVE'):
+        self.servers[server_id] = (time.time() + after, status)
+
+    def fetch(self, since, ids):
+        self.calls.append(since)
+        now = time.time()
+        return [dict(id=i, status=now >= ready and status or 'BUILD')
+                for i, (ready, status) in self.servers.items()]
+
+
+class WatcherTest(Base):
+
+    def setUp(self):
+        self.servers = FakeServers()
+        self.watcher = Watcher(
+            'server-active', self.servers.fetch, Okeanos._ready_status,
+            interval=0.05)
+        self.addCleanup(wait.stats.reset)
+
+    def test_one_call_per_tick(self):
+        for i in range(50):
+            self.servers.add(i, 0.1 + i * 0.002)
+        results = []
+        threads = [threading.Thread(
+            target=lambda i=i: results.append(self.watcher.wait(i, 5)))
+            for i in range(50)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['ACTIVE'] * 50)
+        # A few ticks for the whole batch, not a poll loop per server.
+        self.assertLess(len(self.servers.calls), 10)
+        self.assertEqual(wait.stats.timings['server-active'][0], 50)
+        time.sleep(0.1)
+        self.assertIs(self.watcher.thread, None)
+
+    def test_error_and_timeout(self):
+        self.servers.add('bad', 0, 'ERROR')
+        self.servers.add('gone', 0, 'DELETED')
+        t = time.time()
+        self.assertRaises(MachineFailed, self.watcher.wait, 'bad', 5)
+        self.assertRaises(MachineFailed, self.watcher.wait, 'gone', 5)
+        self.assertLess(time.time() - t, 1)
+        self.servers.add('slow', 10)
+        self.assertRaises(TimeoutError, self.watcher.wait, 'slow', 0.2)
+        self.assertEqual(self.watcher.pending, {})
+
+    def test_callback_and_since(self):
+        self.servers.add(1, 0)
+        done = threading.Event()
+        waiter = self.watcher.watch(1)
+        waiter.add_done_callback(lambda w: done.set())
+        done.wait(5)
+        self.assertEqual(waiter.result(), 'ACTIVE')
+        self.assertLessEqual(self.servers.calls[0],
+                             time.time() - Watcher.skew)
+        self.assertEqual(changes_since(0), "1970-01-01T00:00:00Z")
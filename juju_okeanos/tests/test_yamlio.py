@@ -0,0 +1,76 @@
+import mock
+import os
+import yaml
+
+from juju_okeanos.config import Config
+from juju_okeanos.tests.base import Base
+from juju_okeanos import yamlio
+
+
+def make_status(count):
+    machines = {}
+    for i in range(count):
+        machines[str(i)] = {
+            'agent-state': 'started',
+            'agent-version': '1.25.6',
+            'dns-name': '10.0.%d.%d' % (i // 250, i % 250),
+            'instance-id': 'manual:10.0.%d.%d' % (i // 250, i % 250),
+            'series': 'trusty',
+            'hardware': 'arch=amd64 cpu-cores=2 mem=4096M root-disk=40960M'}
+    services = {}
+    for i in range(count // 4):
+        services['service-%d' % i] = {
+            'charm': 'cs:trusty/service-%d' % i,
+            'exposed': False,
+            'units': dict([
+                ('service-%d/%d' % (i, u), {
+                    'agent-state': 'started',
+                    'machine': str(i * 4 + u),
+                    'public-address': '10.0.0.%d' % u})
+                for u in range(4)])}
+    return {'environment': 'okeanos', 'machines': machines,
+            'services': services}
+
+
+class YamlTest(Base):
+
+    def test_round_trip(self):
+        data = {'environments': {'okeanos': {
+            'type': 'manual', 'bootstrap-host': None}}}
+        self.assertEqual(yamlio.load(yamlio.dump(data)), data)
+
+    def test_status_matches_safe_load(self):
+        status = make_status(400)
+        doc = yaml.safe_dump(status)
+        self.assertEqual(yamlio.load(doc), status)
+        self.assertEqual(yamlio.load(yamlio.dump(status)), status)
+
+    def test_libyaml_loader(self):
+        with mock.patch('yaml.load', return_value={}) as load:
+            yamlio.load('{}')
+        if yaml.__with_libyaml__:
+            self.assertIs(load.call_args[1]['Loader'], yaml.CSafeLoader)
+        else:
+            self.assertIs(load.call_args[1]['Loader'], yaml.SafeLoader)
+
+
+class ConfigEnvDataTest(Base):
+
+    def setUp(self):
+        self.juju_home = self.mkdir()
+        self.change_environment(JUJU_HOME=self.juju_home, JUJU_ENV="")
+        with open(os.path.join(
+                self.juju_home, 'environments.yaml'), 'w') as fh:
+            fh.write(yaml.safe_dump({
+                'default': 'okeanos',
+                'environments': {'okeanos': {'type': 'manual'}}}))
+
+    def test_env_data_read_once(self):
+        config = Config(mock.Mock(environment=None))
+        with mock.patch('juju_okeanos.yamlio.load',
+                        side_effect=yamlio.load) as load:
+            self.assertEqual(config.get_env_name(), 'okeanos')
+            self.assertEqual(
+                config.get_env_data()['environments']['okeanos'],
+                {'type': 'manual'})
+            self.assertEqual(load.call_count, 1)
@@ -0,0 +1,120 @@
+"""
+Readiness polling with jittered exponential backoff and a deadline.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from juju_okeanos.exceptions import TimeoutError
+
+
+log = logging.getLogger("juju.okeanos")
+
+
+class WaitStats(object):
+    """Per wait name timings, so we can see where provisioning time goes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def record(self, name, duration, polls, timed_out=False):
+        with self.lock:
+            count, total, worst, total_polls, timeouts = self.timings.get(
+                name, (0, 0.0, 0.0, 0, 0))
+            self.timings[name] = (
+                count + 1, total + duration, max(worst, duration),
+                total_polls + polls, timeouts + int(timed_out))
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+
+    def report(self):
+        with self.lock:
+            timings = dict(self.timings)
+        for name in sorted(timings):
+            count, total, worst, polls, timeouts = timings[name]
+            log.debug(
+                "Wait %s: %d waits %0.2fs total %0.2fs max %d polls "
+                "%d timeouts", name, count, total, worst, polls, timeouts)
+
+
+stats = WaitStats()
+
+
+class Poll(object):
+    """Backoff, deadline and stats of one wait.
+
+    The loop shared by wait_for and aio.wait_for, which only differ in
+    how they run the check and sleep.
+    """
+
+    def __init__(self, name, target=None, timeout=300, delay=1.0,
+                 max_delay=15.0, factor=2.0, jitter=0.25):
+        self.name = name
+        self.target = target or ''
+        self.timeout = timeout
+        self.delay = delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.start = time.time()
+        self.deadline = self.start + timeout
+        self.polls = 0
+
+    def retry(self, e):
+        """A check raised an exception that counts as not ready yet."""
+        log.debug("Waiting on %s %s: %s", self.name, self.target, e)
+
+    def done(self, result):
+        """Count a poll, True once result is ready.
+
+        Raises TimeoutError once the deadline passes.
+        """
+        self.polls += 1
+        if result:
+            duration = time.time() - self.start
+            stats.record(self.name, duration, self.polls)
+            log.debug("Waited %0.2fs (%d polls) on %s %s",
+                      duration, self.polls, self.name, self.target)
+            return True
+        if self.deadline - time.time() <= 0:
+            stats.record(self.name, time.time() - self.start, self.polls,
+                         timed_out=True)
+            raise TimeoutError(
+                "Timed out after %ds waiting on %s %s" % (
+                    self.timeout, self.name, self.target))
+        return False
+
+    def next_delay(self):
+        """Seconds to sleep before the next poll."""
+        delay = min(self.deadline - time.time(), self.delay * random.uniform(
+            1 - self.jitter, 1 + self.jitter))
+        self.delay = min(self.delay * self.factor, self.max_delay)
+        return max(0, delay)
+
+
+def wait_for(check, name, target=None, timeout=300, delay=1.0,
+             max_delay=15.0, factor=2.0, jitter=0.25, retry_on=()):
+    """Poll check until it returns a true value and return that value.
+
+    The delay between polls grows exponentially up to max_delay with
+    random jitter, so concurrent waiters don't poll the api in lock
+    step. Exceptions in retry_on count as not ready yet, any other
+    exception aborts the wait. Raises TimeoutError once the deadline
+    passes.
+    """
+    poll = Poll(name, target, timeout, delay, max_delay, factor, jitter)
+    while True:
+        try:
+            result = check()
+        except retry_on, e:
+            poll.retry(e)
+            result = None
+        if poll.done(result):
+            return result
+        time.sleep(poll.next_delay())
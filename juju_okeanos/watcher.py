@@ -0,0 +1,177 @@
+"""
+One status poller for all pending servers (or ports) of a provider.
+"""
+
+import logging
+import threading
+import time
+
+from juju_okeanos.exceptions import TimeoutError
+from juju_okeanos.wait import stats
+
+
+log = logging.getLogger("juju.okeanos")
+
+
+def changes_since(timestamp):
+    """Format a unix timestamp for the cyclades changes-since filter."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+class Waiter(object):
+    """Outcome of watching one resource, safe to use across threads."""
+
+    def __init__(self, resource_id):
+        self.resource_id = resource_id
+        self.started = time.time()
+        self.value = None
+        self.exception = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def add_done_callback(self, callback):
+        """Call callback(waiter) once done, from the watcher thread."""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        deadline = timeout is not None and time.time() + timeout or None
+        while not self._event.is_set():
+            # Bounded, an event wait without timeout can't be interrupted
+            # in python 2.
+            remaining = deadline and deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(
+                    "Timed out after %ds waiting on %s" % (
+                        timeout, self.resource_id))
+            self._event.wait(min(remaining or 1.0, 1.0))
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def _resolve(self, value=None, exception=None):
+        with self._lock:
+            self.value = value
+            self.exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Watcher(object):
+    """Refresh every pending resource with one list call per tick.
+
+    fetch(since, ids) returns the resources (dicts with an id) changed
+    since the given unix time, or all of them if it can't filter, ids
+    are the pending ones for fetchers that probe each resource. ready
+    (resource) returns a true value once the resource is usable, which
+    resolves its waiters, or raises to fail them. The poll thread only
+    runs while something is pending, so api load is one call per tick
+    however many resources are in flight. Ids are compared as strings,
+    apis and the inventory don't agree on their types.
+    """
+
+    # Seconds subtracted from changes-since, covers clock skew with the
+    # api and changes landing while a tick's list call is in flight.
+    skew = 60
+
+    def __init__(self, name, fetch, ready, interval=3.0):
+        self.name = name
+        self.fetch = fetch
+        self.ready = ready
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.since = None
+        self.thread = None
+        self.ticks = 0
+
+    def watch(self, resource_id):
+        """Return a Waiter resolved once resource_id is ready."""
+        waiter = Waiter(resource_id)
+        with self.lock:
+            waiter.tick = self.ticks
+            if not self.pending:
+                self.since = time.time() - self.skew
+            self.pending.setdefault(str(resource_id), []).append(waiter)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        return waiter
+
+    def wait(self, resource_id, timeout=300):
+        waiter = self.watch(resource_id)
+        try:
+            return waiter.result(timeout)
+        except TimeoutError:
+            self.discard(resource_id, waiter)
+            stats.record(self.name, time.time() - waiter.started, 0,
+                         timed_out=True)
+            raise
+
+    def discard(self, resource_id, waiter):
+        """Stop waiting on resource_id for waiter."""
+        with self.lock:
+            waiters = self.pending.get(str(resource_id), [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self.pending.pop(str(resource_id), None)
+
+    def resolve(self, resource_id, value):
+        """Resolve resource_id's waiters, it's known to be ready."""
+        with self.lock:
+            waiters = self.pending.pop(str(resource_id), [])
+        for waiter in waiters:
+            waiter._resolve(value)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                since = self.since
+                ids = self.pending.keys()
+            self.ticks += 1
+            started = time.time()
+            try:
+                changed = self.fetch(since, ids)
+            except Exception, e:
+                log.warning("Polling %s failed: %s", self.name, e)
+                changed = ()
+            else:
+                self.since = started - self.skew
+            for resource in changed:
+                self._update(resource)
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    def _update(self, resource):
+        resource_id = str(resource['id'])
+        with self.lock:
+            if resource_id not in self.pending:
+                return
+            try:
+                value = self.ready(resource)
+            except Exception, e:
+                value, exception = None, e
+            else:
+                exception = None
+                if not value:
+                    return
+            waiters = self.pending.pop(resource_id)
+        for waiter in waiters:
+            duration = time.time() - waiter.started
+            stats.record(self.name, duration, self.ticks - waiter.tick)
+            log.debug("Waited %0.2fs on %s %s", duration, self.name,
+                      resource_id)
+            waiter._resolve(value, exception)
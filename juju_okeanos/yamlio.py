@@ -0,0 +1,23 @@
+"""
+Yaml parsing and serialization, using libyaml when it is available.
+"""
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+def load(stream):
+    """Parse a yaml string or file with the fastest safe loader.
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump(data, stream=None, **kw):
+    """Serialize data to yaml with the fastest safe dumper.
+    """
+    kw.setdefault('default_flow_style', False)
+    return yaml.dump(data, stream, Dumper=SafeDumper, **kw)